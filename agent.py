@@ -15,21 +15,30 @@ GNU General Public License for more details.
 You should have received a copy of the GNU General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
+import contextvars
 import datetime
+import functools
 import json
 import logging
 import os
-import re
-from typing import Any, Dict, List, Optional
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Any, Callable, Dict, List, Optional, Set
 
-import attr
 import pytz
 import requests
 from dotenv import load_dotenv
 
-from daisy import RoomTime
-from scheduler import Break
-from schemas import RoomCategory, RoomRestriction
+from breaker import CircuitBreaker
+from cache import DailyTTLCache, completion_key
+import fastpath
+import metrics
+import profiling
+import structured
+from llm import LLMClient
+from router import ModelRouter, classify
+from schemas import RoomCategory, RoomRequest
 
 load_dotenv()
 
@@ -39,29 +48,54 @@ API_TOKEN = os.getenv("CF_BEARER_TOKEN")
 if API_BASE_URL is None or API_TOKEN is None:
     raise ValueError("API_BASE_URL and CF_BEARER_TOKEN must be set in environment")
 
-ISO_WEEKDAYS = [None, "Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
+#"@cf/meta-llama/llama-2-7b-chat-hf-lora", # good but added restriction
+# "@cf/google/gemma-7b-it-lora", # didnt complete
+# "@cf/mistral/mistral-7b-instruct-v0.2-lora", # didnt complete
+LLM_MODEL = "@cf/meta/llama-3-8b-instruct" # generally good performance
+LLM_STREAM = bool(int(os.getenv("LLM_STREAM", "1")))
+
+LLM_CLIENT = LLMClient(API_BASE_URL, API_TOKEN, pool_size=int(os.getenv("LLM_POOL_SIZE", "4")), timeout=float(os.getenv("LLM_TIMEOUT", "30")))
+
+# Only transport errors and error statuses count, an unparsable answer is the model's fault and is retried instead
+LLM_BREAKER = CircuitBreaker(
+    "The language model",
+    window=float(os.getenv("LLM_BREAKER_WINDOW", "60")),
+    min_calls=int(os.getenv("LLM_BREAKER_MIN_CALLS", "5")),
+    failure_ratio=float(os.getenv("LLM_BREAKER_FAILURE_RATIO", "0.5")),
+    slow_call=float(os.getenv("LLM_BREAKER_SLOW_CALL", "20")),
+    max_backoff=float(os.getenv("LLM_BREAKER_MAX_BACKOFF", "300")),
+    is_failure=lambda e: isinstance(e, requests.RequestException) and not isinstance(e, ValueError),
+)
+
+# Hedged retries, another attempt is started if none has finished within the latency budget
+LLM_HEDGE_AFTER = float(os.getenv("LLM_HEDGE_AFTER", "8"))
+LLM_HEDGE_MAX_CONCURRENT = max(int(os.getenv("LLM_HEDGE_MAX_CONCURRENT", "3")), 1)
+# Models the router picks from, fastest / weakest first and strongest last
+LLM_MODELS = [m.strip() for m in (os.getenv("LLM_MODELS") or os.getenv("LLM_HEDGE_MODELS") or LLM_MODEL).split(",") if m.strip()] or [LLM_MODEL]
+LLM_ROUTER = ModelRouter(
+    LLM_MODELS,
+    window=int(os.getenv("LLM_ROUTER_WINDOW", "50")),
+    min_samples=int(os.getenv("LLM_ROUTER_MIN_SAMPLES", "5")),
+    min_success=float(os.getenv("LLM_ROUTER_MIN_SUCCESS", "0.9")),
+    explore=float(os.getenv("LLM_ROUTER_EXPLORE", "0.05")),
+)
+LLM_ROUTER_SIMPLE_MAX_WORDS = int(os.getenv("LLM_ROUTER_SIMPLE_MAX_WORDS", "20"))
+
+_HEDGE_EXECUTOR = ThreadPoolExecutor(max_workers=int(os.getenv("LLM_HEDGE_WORKERS", "8")), thread_name_prefix="llm-attempt")
+
+# Only completions that parsed successfully are stored, retries still get a fresh sample
+COMPLETION_CACHE: DailyTTLCache[Dict[str, Any]] = DailyTTLCache(
+    max_entries=int(os.getenv("LLM_CACHE_SIZE", "256")),
+    ttl=int(os.getenv("LLM_CACHE_TTL", "3600")),
+)
+
+# Approximate token budget for the conversation history sent to the LLM
+LLM_HISTORY_TOKEN_BUDGET = int(os.getenv("LLM_HISTORY_TOKEN_BUDGET", "1500"))
 
-@attr.s(auto_attribs=True, frozen=True, slots=True)
-class RoomRequest:
-    title: Optional[str]
-    date: datetime.date
-    from_time: RoomTime
-    duration: int
-    breaks: List[Break]
-    room_restrictions: List[RoomRestriction]
-    room_category: RoomCategory
-
-    @classmethod
-    def from_json(cls, data: Dict[str, Any]) -> "RoomRequest":
-        return cls(
-            title=data.get("title"),
-            date=datetime.datetime.strptime(data["date"], "%Y-%m-%d").date(),
-            from_time=RoomTime(data["from_time"]),
-            duration=data["duration"],
-            breaks=[Break(start_time=RoomTime(b["from_time"]), duration=b["duration"]) for b in data.get("breaks", [])],
-            room_restrictions=[RoomRestriction(r) for r in data.get("room_filters", [])],
-            room_category=RoomCategory(int(data.get("room_category", RoomCategory.BOOKABLE_GROUP_ROOMS.value)) if data.get("room_category") != 0 and isinstance(data.get("room_category"), int) else RoomCategory.BOOKABLE_GROUP_ROOMS),
-        )
+# Which path resolved each message, "fast" (rule based) or "llm"
+PATH_COUNTERS: Dict[str, int] = {"fast": 0, "llm": 0}
+
+ISO_WEEKDAYS = [None, "Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
 
 def generate_multi_week_calendar():
     # Set the timezone to Europe/Stockholm
@@ -94,39 +128,36 @@ def generate_multi_week_calendar():
 
     return " ".join(weeks_calendar)
 
-def generate_week_calendar():
-    today = datetime.datetime.now(pytz.timezone("Europe/Stockholm")).date()
+def generate_week_calendar(today: Optional[datetime.date] = None):
+    if today is None:
+        today = datetime.datetime.now(pytz.timezone("Europe/Stockholm")).date()
     extended_days = [(today + datetime.timedelta(days=i)).strftime("%A, %B %d, %Y")
                     for i in range(15) if (today + datetime.timedelta(days=i)).weekday() < 5]
     return " ".join(extended_days)
 
 
-def chat_completion(model: str, messages: List[Dict[str, str]]) -> Dict[str, str]:
-    response = requests.post(
-        f"{API_BASE_URL}{model}",
-        headers={"Authorization": f"Bearer {API_TOKEN}"},
-        json={"messages": messages},
-        timeout=180,
-    )
-    return response.json()
+def chat_completion(model: str, messages: List[Dict[str, str]], on_field: Optional[Callable[[str, Any], None]] = None, cancelled: Optional[threading.Event] = None) -> Dict[str, Any]:
+    with metrics.timed("llm"):
+        if LLM_STREAM:
+            return LLM_BREAKER.call(LLM_CLIENT.stream_completion, model, messages, on_field, cancelled)
+        return LLM_BREAKER.call(LLM_CLIENT.complete, model, messages)
 
 
-def handle_message(history: List[Dict[str, str]], message: str, staff: bool = False):
-    system_message: Dict[str, str] = {
-        "role": "system",
-        "content": f'''You assist with conversations and room scheduling
+@functools.lru_cache(maxsize=4)
+def _system_prompt_prefix(today: datetime.date, staff: bool) -> str:
+    """Everything in the system prompt that only changes per day, computed once per day and staff flag"""
+    return f'''You assist with conversations and room scheduling
 
-        Respond with JSON: {{"conversations_response": str, "requests": List[{{"date": "YYYY-MM-DD", "from_time": int 4 to 23 (hours), "duration": 1 to 4 (hours), breaks?: [{{"from_time": int 4 to 23 (hours), "duration": 1 to 4 (hours)}}], title?: str, {'room_category?: int, ' if staff else ''}room_filters?: List[int]}}]}} 
+        Respond with JSON: {{"requests": List[{{"date": "YYYY-MM-DD", "from_time": int 4 to 23 (hours), "duration": 1 to 4 (hours), breaks?: [{{"from_time": int 4 to 23 (hours), "duration": 1 to 4 (hours)}}], title?: str, {'room_category?: int, ' if staff else ''}room_filters?: List[int]}}], "conversations_response": str}} 
 
         Bookable dates/calender:
-        {generate_week_calendar()}
+        {generate_week_calendar(today)}
 
         Info:
         * All times are 24-hour.
         * The user may provide times in the format XX-YY, this equals to from_time=XX and duration=YY-XX.
         * Booking hours are limited to whole hours between 04:00 (4) and 23:00 (23).
-        * Current timestamp: {datetime.datetime.now(pytz.timezone("Europe/Stockholm")).strftime("%A, %B %d, %Y")}.
-        * Earliest bookable time: {datetime.datetime.now(pytz.timezone("Europe/Stockholm")).hour+1:02}:00 (only applied for today)
+        * Current timestamp: {today.strftime("%A, %B %d, %Y")}.
         * request.date=today if a date/day isn't given by the user.
         * Each booking can last from 1 to 4 hours, excluding breaks.
         * The user will see the requests with buttons to confirm the request(s).
@@ -136,46 +167,168 @@ def handle_message(history: List[Dict[str, str]], message: str, staff: bool = Fa
         {"* The user is staff, they may specify a room_category." if staff else ""}
         {f"Available room_categories: {', '.join([f'{c.name}={c.value}' for c in RoomCategory])}, Note: NON_BOOKABLE_GROUP_ROOMS are bookable by staff." if staff else ""}
         '''.replace("    ", "")
-    }
-    context = [system_message] + history + [{"role": "user", "content": message}]# + [{"role": "assistant", "content": "<invalid json>"}] + [{"role": "assistant", "content": "please provide valid json"}]
+
+
+def system_prompt(staff: bool = False) -> str:
+    now = datetime.datetime.now(pytz.timezone("Europe/Stockholm"))
+    return _system_prompt_prefix(now.date(), staff) + f"* Earliest bookable time: {now.hour+1:02}:00 (only applied for today)\n"
+
+
+def _estimate_tokens(message: Dict[str, str]) -> int:
+    # Rough estimate (~4 characters per token) plus per-message overhead, good enough for budgeting
+    return len(message.get("content", "")) // 4 + 4
+
+
+def assemble_history(history: List[Dict[str, str]], budget: int = LLM_HISTORY_TOKEN_BUDGET) -> List[Dict[str, str]]:
+    """
+    Fits the history into a token budget by keeping the newest turns
+
+    Dropped turns are replaced by a short summary of what the user asked for, if it still fits.
+    """
+    kept: List[Dict[str, str]] = []
+    used = 0
+    for turn in reversed(history):
+        cost = _estimate_tokens(turn)
+        if used + cost > budget:
+            break
+        kept.append(turn)
+        used += cost
+    kept.reverse()
+
+    dropped = history[:len(history) - len(kept)]
+    if not dropped:
+        return kept
+
+    asked = [" ".join(turn.get("content", "").split())[:60] for turn in dropped if turn.get("role") == "user"]
+    summary = {"role": "system", "content": f"Summary of {len(dropped)} earlier messages, the user asked: " + " | ".join(asked)}
+    if asked and used + _estimate_tokens(summary) <= budget:
+        return [summary] + kept
+    return kept
+
+
+def handle_message(history: List[Dict[str, str]], message: str, staff: bool = False, on_requests: Optional[Callable[[List[Dict[str, Any]]], None]] = None, model: str = LLM_MODEL, cancelled: Optional[threading.Event] = None, kind: Optional[str] = None):
+    """
+    Args:
+        history: Previous turns of the conversation
+        message: The user message
+        staff: Whether the user is staff
+        on_requests: Early hint, called (from the calling thread) with the raw requests as soon as they have been streamed.
+            The returned requests are authoritative, the hint may be skipped (e.g. cache hits) or be followed by a failed parse.
+        model: Model to use
+        cancelled: Stops reading a streamed completion once set
+        kind: Message class (router.SIMPLE / router.COMPLEX), when given the latency and validity of a fresh completion are
+            recorded for the router
+    """
+    system_message: Dict[str, str] = {"role": "system", "content": system_prompt(staff)}
+    context = [system_message] + assemble_history(history) + [{"role": "user", "content": message}]# + [{"role": "assistant", "content": "<invalid json>"}] + [{"role": "assistant", "content": "please provide valid json"}]
     logging.debug("Context: %s", context)
-    completion = chat_completion(
-        #"@cf/meta-llama/llama-2-7b-chat-hf-lora", # good but added restriction
-        # "@cf/google/gemma-7b-it-lora", # didnt complete
-        # "@cf/mistral/mistral-7b-instruct-v0.2-lora", # didnt complete
-        "@cf/meta/llama-3-8b-instruct", # generally good performance
-        context,
-    )
+    cache_key = completion_key(model, context)
+    completion = COMPLETION_CACHE.get(cache_key)
+    # Only fresh completions say something about the model
+    started: Optional[float] = None
+    if completion is None:
+        def on_field(key: str, value: Any):
+            if key == "requests" and isinstance(value, list) and on_requests is not None:
+                on_requests(value)
+        started = time.perf_counter()
+        completion = chat_completion(model, context, on_field, cancelled)
+    else:
+        logging.debug("Completion cache hit (hit rate %.2f)", COMPLETION_CACHE.hit_rate)
     logging.debug("Completion: %s", completion)
-    out_message: str = completion["result"]["response"]  # type: ignore
-    # Remove newlines/whitespace before and after json
-    out_message = re.sub(r"^\s+", "", out_message)
-    
-    out_json = json.loads(out_message)
-    if not isinstance(out_json, dict):
-        raise json.decoder.JSONDecodeError("Expected JSON object", out_message, 0)
+    try:
+        out_message: str = completion["result"]["response"]  # type: ignore
+        # Tolerates prose around the object and common syntax mistakes, only unrecoverable output is retried
+        out_json = structured.parse_response(out_message)
+        raw_requests = structured.validate_requests(out_json.get("requests", []))
 
-    parsed_requests = [RoomRequest.from_json(r) for r in out_json.get("requests", [])]
+        parsed_requests = [RoomRequest.from_json(r) for r in raw_requests]
+    except (json.JSONDecodeError, ValueError, KeyError):
+        # A completion cut short by a winning hedge is not the model's fault
+        if started is not None and kind is not None and not (cancelled is not None and cancelled.is_set()):
+            LLM_ROUTER.record(model, kind, time.perf_counter() - started, False)
+        raise
+    if started is not None and kind is not None:
+        LLM_ROUTER.record(model, kind, time.perf_counter() - started, True)
+    COMPLETION_CACHE.put(cache_key, completion)
 
-    return out_json.get("conversations_response", "<Empty response>"), out_json.get("requests", []), parsed_requests
+    return out_json.get("conversations_response", "<Empty response>"), raw_requests, parsed_requests
 
-def handle_message_retries(history: List[Dict[str, str]], message: str, staff: bool = False, retries: int = 5):
+def _attempt(history: List[Dict[str, str]], message: str, staff: bool, on_requests: Optional[Callable[[List[Dict[str, Any]]], None]], model: str, cancelled: threading.Event, kind: str):
+    with profiling.span(f"handle_message ({model})"):
+        return handle_message(history, message, staff, on_requests, model, cancelled, kind)
+
+def handle_message_retries(history: List[Dict[str, str]], message: str, staff: bool = False, retries: int = 5, on_requests: Optional[Callable[[List[Dict[str, Any]]], None]] = None):
+    """
+    Hedged retries of handle_message
+
+    A new attempt is started whenever an attempt fails or when no attempt has finished within LLM_HEDGE_AFTER seconds,
+    with at most LLM_HEDGE_MAX_CONCURRENT attempts in flight. The first attempt that validates wins, the rest are cancelled.
+    LLM_ROUTER picks the model of each attempt: by message class at first, a stronger one after a failed attempt and
+    preferably one not already in flight when hedging.
+    """
+    retries = max(retries, 1)
     prompt = message.strip()
-    for i in range(max(retries, 1)):
-        try:
-            return handle_message(history, prompt, staff)
-        except (json.JSONDecodeError, ValueError) as e:
-            if retries - 1 == i:
-                raise e
-            
-            # First retry nothing changes, due to to the randomness of LLM it could be result in the correct result on a later retry
-            logging.warning("LLM Encountered an error, %s: %s, retrying %s more times", type(e), e, retries - i - 1)
-            if i == 0:
-                continue
-
-            history += [{"role": "user", "content": prompt}]
-            history += [{"role": "assistant", "content": f"<invalid output, error: f{type(e)}: {e}>"}]
-            prompt = "<provide valid json without any other characters before or after it>"
+    feedback: List[Dict[str, str]] = []
+    failures = 0
+    attempts = 0
+    pending: Set[Future] = set()
+    cancelled = threading.Event()
+    last_error: Optional[Exception] = None
+    kind = classify(prompt, has_history=bool(history), max_words=LLM_ROUTER_SIMPLE_MAX_WORDS)
+    models: Dict[Future, str] = {}
+
+    def launch(failed: Optional[str] = None):
+        nonlocal attempts
+        model = LLM_ROUTER.choose(kind, exclude=[models[future] for future in pending], failed=failed)
+        attempts += 1
+        future = _HEDGE_EXECUTOR.submit(contextvars.copy_context().run, _attempt, history + feedback, prompt, staff, on_requests, model, cancelled, kind)
+        models[future] = model
+        pending.add(future)
+
+    try:
+        with profiling.span("handle_message_retries"):
+            launch()
+            while pending:
+                done, _ = wait(pending, timeout=LLM_HEDGE_AFTER, return_when=FIRST_COMPLETED)
+                if not done:
+                    if attempts < retries and len(pending) < LLM_HEDGE_MAX_CONCURRENT:
+                        logging.info("LLM exceeded latency budget of %ss, hedging with attempt %s", LLM_HEDGE_AFTER, attempts + 1)
+                        launch()
+                    continue
 
+                for future in done:
+                    pending.remove(future)
+                    try:
+                        return future.result()
+                    except (json.JSONDecodeError, ValueError, KeyError) as e:
+                        last_error = e
+                        failures += 1
+                        logging.warning("LLM Encountered an error, %s: %s, %s attempts left", type(e), e, retries - attempts)
+                        # First retry nothing changes, due to to the randomness of LLM it could be result in the correct result on a later retry
+                        if failures > 1:
+                            feedback = feedback + [
+                                {"role": "user", "content": prompt},
+                                {"role": "assistant", "content": f"<invalid output, error: {type(e)}: {e}>"},
+                            ]
+                            prompt = "<provide valid json without any other characters before or after it>"
+                        if attempts < retries and len(pending) < LLM_HEDGE_MAX_CONCURRENT:
+                            launch(failed=models[future])
+    finally:
+        cancelled.set()
+
+    if last_error is not None:
+        raise last_error
     # Would use Never type but not available in the python version I'm using 
     raise RuntimeError("Impossible outcome")
+
+def resolve_message(history: List[Dict[str, str]], message: str, staff: bool = False, on_requests: Optional[Callable[[List[Dict[str, Any]]], None]] = None):
+    """Resolves a message via the rule based fast path, falling back to the LLM for anything ambiguous"""
+    result = fastpath.parse_message(message.strip(), has_history=bool(history))
+    if result is not None:
+        PATH_COUNTERS["fast"] += 1
+        logging.info("Message resolved via fast path")
+        return result.response, result.requests, [RoomRequest.from_json(r) for r in result.requests]
+
+    PATH_COUNTERS["llm"] += 1
+    logging.info("Message resolved via LLM")
+    return handle_message_retries(history, message, staff, on_requests=on_requests)
@@ -0,0 +1,269 @@
+"""
+A discord bot capable of booking student group rooms and staff rooms via Daisy (administration tool for Department of Computer and Systems Sciences at Stockholm University)
+Copyright (C) 2024 Edwin Sundberg
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import argparse
+import asyncio
+import contextlib
+import datetime
+import itertools
+import json
+import math
+import os
+import random
+import tempfile
+import threading
+import time
+from types import ModuleType
+from typing import Any, AsyncIterator, Dict, List
+
+from standin import StandIn, add_config_arguments, config_from_arguments
+
+_ids = itertools.count(1)
+
+
+class _Author:
+    def __init__(self, user_id: int):
+        self.id = user_id
+        self.name = f"user-{user_id}"
+        self.mention = f"<@{user_id}>"
+
+
+class _Channel:
+    @contextlib.asynccontextmanager
+    async def typing(self) -> AsyncIterator[None]:
+        yield
+
+    async def fetch_message(self, message_id: int):
+        raise LookupError(f"Message {message_id} is not known to the benchmark")
+
+
+class _Message:
+    """The parts of a discord message the message pipeline uses"""
+    def __init__(self, author: _Author, content: str, channel: _Channel):
+        self.id = next(_ids)
+        self.author = author
+        self.content = content
+        self.channel = channel
+        self.reference = None
+        self.replies: List["_Message"] = []
+        self.view: Any = None
+
+    async def reply(self, content: str = "", view: Any = None, **kwargs: Any) -> "_Message":
+        sent = _Message(self.author, content, self.channel)
+        sent.view = view
+        self.replies.append(sent)
+        return sent
+
+    async def edit(self, **kwargs: Any):
+        pass
+
+
+def percentile(samples: List[float], q: float) -> float:
+    ordered = sorted(samples)
+    return ordered[max(math.ceil(q * len(ordered)) - 1, 0)]
+
+
+def _weekdays(today: datetime.date, count: int) -> List[datetime.date]:
+    days = []
+    day = today
+    while len(days) < count:
+        day += datetime.timedelta(days=1)
+        if day.weekday() < 5:
+            days.append(day)
+    return days
+
+
+def generate_messages(count: int, llm_share: float, seed: int, today: datetime.date) -> List[str]:
+    """
+    Booking requests, the rule based ones are resolved by the fast path and the rest need the LLM
+
+    Every message is different, so the completion cache does not hide the LLM.
+    """
+    rng = random.Random(seed)
+    days = _weekdays(today, 10)
+    messages = []
+    for i in range(count):
+        day = rng.choice(days)
+        start = rng.randint(8, 18)
+        end = min(start + rng.randint(1, 3), 21)
+        if rng.random() < llm_share:
+            messages.append(f"could you find somewhere for our project group #{i} to sit on {day.strftime('%A').lower()} between {start} and {end}")
+        else:
+            messages.append(f"{day.isoformat()} {start:02}-{end:02} {rng.choice(['g5', 'g10', 'green', 'red', ''])}".strip())
+    return messages
+
+
+def _prepare_environment(args: argparse.Namespace, stand_in: StandIn, directory: str):
+    users = [
+        {
+            "discord_id": 1000 + i,
+            "su_username": f"bench{i}",
+            "su_password": "bench",
+            "search_term": "bench",
+            "lagg_till_person_id": 1,
+        }
+        for i in range(args.users)
+    ]
+    users_file = os.path.join(directory, "users.json")
+    with open(users_file, "w", encoding="utf-8") as file:
+        json.dump(users, file)
+    # Explicit settings always win, the rest default to values that do not throttle the benchmark
+    defaults = {
+        "DISCORD_OWNER_ID": "1000",
+        "DISCORD_TOKEN": "benchmark",
+        "CF_BEARER_TOKEN": "benchmark",
+        "USERS_FILE": users_file,
+        "SERIES_DB_PATH": os.path.join(directory, "series.db"),
+        "HISTORY_DB_PATH": os.path.join(directory, "history.db"),
+        "DAISY_SESSION_POOL_SIZE": str(args.users),
+        "DAISY_RATE_LIMIT": "1000",
+        "DAISY_RATE_BURST": "1000",
+        "DAISY_ENDPOINT_RATE_LIMITS": "",
+        "CONFIRM_REFRESH_INTERVAL": "3600",
+    }
+    for key, value in defaults.items():
+        os.environ.setdefault(key, value)
+    if not args.llm_cache:
+        # Measures the LLM itself, the report shows the cache saw no hits
+        os.environ["LLM_CACHE_SIZE"] = "0"
+    os.environ.update(stand_in.env())
+
+
+async def run(client: ModuleType, messages: List[str], users: int, concurrency: int, book: bool) -> Dict[str, Any]:
+    import agent # pylint: disable=import-outside-toplevel
+    import metrics # pylint: disable=import-outside-toplevel
+    from utils import run_async # pylint: disable=import-outside-toplevel
+
+    samples: Dict[str, List[float]] = {}
+    lock = threading.Lock()
+
+    def record(stage: str, seconds: float):
+        with lock:
+            samples.setdefault(stage, []).append(seconds)
+
+    metrics.REGISTRY.observers.append(record)
+    channel = _Channel()
+    authors = [_Author(1000 + i) for i in range(users)]
+    semaphore = asyncio.Semaphore(concurrency)
+    outcomes: Dict[str, int] = {"planned": 0, "no_plan": 0, "failed": 0, "booked": 0, "booking_failed": 0}
+    # exception type -> count, for messages that failed
+    errors: Dict[str, int] = {}
+    views: List[Any] = []
+
+    async def send(index: int, content: str):
+        message = _Message(authors[index % len(authors)], content, channel)
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                await client.on_message(message)
+            except Exception as e: # pylint: disable=broad-except
+                outcomes["failed"] += 1
+                errors[type(e).__name__] = errors.get(type(e).__name__, 0) + 1
+                return
+            finally:
+                record("end_to_end", time.perf_counter() - start)
+        view = next((reply.view for reply in message.replies if reply.view is not None), None)
+        if view is None:
+            outcomes["no_plan"] += 1
+            return
+        outcomes["planned"] += 1
+        views.append(view)
+        if book:
+            request, slots = view.requests[0]
+            start = time.perf_counter()
+            try:
+                await run_async(view.daisy.book_slots, request.room_category, slots, request.date, "Benchmark")
+            except Exception: # pylint: disable=broad-except
+                outcomes["booking_failed"] += 1
+            else:
+                outcomes["booked"] += 1
+            record("book", time.perf_counter() - start)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(send(i, content) for i, content in enumerate(messages)))
+    elapsed = time.perf_counter() - started
+    for view in views:
+        view.stop()
+    metrics.REGISTRY.observers.remove(record)
+
+    return {
+        "messages": len(messages),
+        "seconds": elapsed,
+        "throughput": len(messages) / elapsed if elapsed else 0.0,
+        "outcomes": outcomes,
+        "errors": errors,
+        "llm_cache": agent.COMPLETION_CACHE.stats(),
+        "stages": {
+            stage: {
+                "n": len(values),
+                "p50": percentile(values, 0.5),
+                "p95": percentile(values, 0.95),
+                "p99": percentile(values, 0.99),
+                "max": max(values),
+            }
+            for stage, values in sorted(samples.items())
+        },
+    }
+
+
+def format_report(report: Dict[str, Any], stand_in: StandIn) -> str:
+    lines = [
+        f"{report['messages']} messages in {report['seconds']:.2f}s, {report['throughput']:.1f} messages/s",
+        "Outcomes: " + ", ".join(f"{key}={value}" for key, value in report["outcomes"].items()),
+        "Errors: " + (", ".join(f"{key}={value}" for key, value in report["errors"].items()) or "none"),
+        f"Stand-in: {sum(stand_in.requests.values())} requests, {stand_in.errors} injected errors, {stand_in.bookings} bookings",
+        f"LLM cache: {report['llm_cache']['hits']} hits, {report['llm_cache']['misses']} misses",
+        "",
+        f"{'stage':<32}{'n':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}",
+    ]
+    for stage, stats in report["stages"].items():
+        lines.append(
+            f"{stage:<32}{stats['n']:>7}{stats['p50'] * 1000:>10.1f}{stats['p95'] * 1000:>10.1f}{stats['p99'] * 1000:>10.1f}{stats['max'] * 1000:>10.1f}"
+        )
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Drives the message pipeline against the stand-in servers and reports latency per stage")
+    parser.add_argument("--messages", type=int, default=200, help="messages to send")
+    parser.add_argument("--users", type=int, default=8, help="simulated users, messages are spread over them")
+    parser.add_argument("--concurrency", type=int, default=32, help="messages in flight at once")
+    parser.add_argument("--llm-share", type=float, default=0.5, help="share of messages that need the LLM")
+    parser.add_argument("--book", action="store_true", help="also book the first planned request of every message")
+    parser.add_argument("--llm-cache", action="store_true", help="keep the LLM completion cache (LLM_CACHE_SIZE), disabled by default so every LLM message reaches the LLM")
+    parser.add_argument("--json", dest="json_path", help="also write the report as JSON to this file")
+    add_config_arguments(parser)
+    args = parser.parse_args()
+
+    stand_in = StandIn(config_from_arguments(args))
+    stand_in.start()
+    with tempfile.TemporaryDirectory() as directory:
+        _prepare_environment(args, stand_in, directory)
+        # Imported only now, the bot reads its configuration at import time
+        import client # pylint: disable=import-outside-toplevel
+
+        messages = generate_messages(args.messages, args.llm_share, args.seed, datetime.date.today())
+        report = asyncio.run(run(client, messages, args.users, args.concurrency, args.book))
+        print(format_report(report, stand_in))
+        if args.json_path:
+            with open(args.json_path, "w", encoding="utf-8") as file:
+                json.dump(report, file, indent=2)
+    stand_in.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+"""
+A discord bot capable of booking student group rooms and staff rooms via Daisy (administration tool for Department of Computer and Systems Sciences at Stockholm University)
+Copyright (C) 2024 Edwin Sundberg
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import logging
+import random
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Deque, Dict, Optional, Tuple, TypeVar, Union
+
+T = TypeVar("T")
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling a dependency that is currently considered unhealthy"""
+    def __init__(self, name: str, retry_in: float):
+        super().__init__(f"{name} is not responding properly at the moment, try again in {max(retry_in, 1):.0f} seconds")
+        self.name = name
+        self.retry_in = retry_in
+
+
+class CircuitBreaker:
+    """
+    Stops calling a dependency while too many recent calls failed or were slow
+
+    Calls within the last `window` seconds are kept. Once at least `min_calls` are recorded and the failure ratio reaches
+    `failure_ratio` (slow calls above `slow_call` seconds count as failures too), the circuit opens and calls fail fast
+    with CircuitOpenError. After a jittered backoff one probe call is let through (half-open). If it succeeds the circuit
+    closes, if it fails the circuit opens again with the backoff doubled, up to `max_backoff`.
+    """
+    def __init__(
+        self,
+        name: str,
+        window: float = 60,
+        min_calls: int = 5,
+        failure_ratio: float = 0.5,
+        slow_call: float = 10,
+        base_backoff: float = 5,
+        max_backoff: float = 300,
+        is_failure: Callable[[BaseException], bool] = lambda e: True,
+        clock: Callable[[], float] = time.monotonic,
+        rng: Optional[random.Random] = None,
+    ):
+        self.name = name
+        self.window = window
+        self.min_calls = max(min_calls, 1)
+        self.failure_ratio = failure_ratio
+        self.slow_call = slow_call
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.is_failure = is_failure
+        self._clock = clock
+        self._random = rng or random.Random()
+        self.state = CLOSED
+        self.opened = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+        # (finished at, failed)
+        self._calls: Deque[Tuple[float, bool]] = deque()
+        self._backoff = base_backoff
+        self._open_until = 0.0
+        self._probing = False
+
+    def _prune(self, now: float):
+        while self._calls and self._calls[0][0] < now - self.window:
+            self._calls.popleft()
+
+    def _open(self, now: float):
+        # Jittered so that callers recovering together do not probe in lockstep
+        delay = self._backoff * self._random.uniform(0.5, 1.0)
+        self._open_until = now + delay
+        if self.state != OPEN:
+            logging.warning("Circuit for %s opened for %.1fs", self.name, delay)
+            self.opened += 1
+        self.state = OPEN
+
+    def _before(self) -> bool:
+        """Returns whether the call is a half-open probe, raises CircuitOpenError if the call is not allowed"""
+        with self._lock:
+            now = self._clock()
+            if self.state == OPEN and now >= self._open_until:
+                self.state = HALF_OPEN
+            if self.state == OPEN or (self.state == HALF_OPEN and self._probing):
+                self.rejected += 1
+                raise CircuitOpenError(self.name, self._open_until - now)
+            if self.state == HALF_OPEN:
+                self._probing = True
+                return True
+            return False
+
+    def _after(self, probe: bool, failed: bool):
+        with self._lock:
+            now = self._clock()
+            if probe:
+                self._probing = False
+                if failed:
+                    self._backoff = min(self._backoff * 2, self.max_backoff)
+                    self._open(now)
+                else:
+                    logging.info("Circuit for %s closed", self.name)
+                    self.state = CLOSED
+                    self._backoff = self.base_backoff
+                    self._calls.clear()
+                return
+            if self.state != CLOSED:
+                # A call started before the circuit opened
+                return
+            self._calls.append((now, failed))
+            self._prune(now)
+            failures = sum(1 for _, call_failed in self._calls if call_failed)
+            if len(self._calls) >= self.min_calls and failures / len(self._calls) >= self.failure_ratio:
+                self._calls.clear()
+                self._open(now)
+
+    def call(self, func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+        probe = self._before()
+        start = self._clock()
+        try:
+            result = func(*args, **kwargs)
+        except BaseException as e:
+            self._after(probe, self.is_failure(e))
+            raise
+        self._after(probe, self._clock() - start > self.slow_call)
+        return result
+
+    def stats(self) -> Dict[str, Union[int, float]]:
+        with self._lock:
+            self._prune(self._clock())
+            failures = sum(1 for _, failed in self._calls if failed)
+            return {
+                "open": int(self.state != CLOSED),
+                "recent_calls": len(self._calls),
+                "recent_failures": failures,
+                "opened": self.opened,
+                "rejected": self.rejected,
+            }
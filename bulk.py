@@ -0,0 +1,393 @@
+"""
+A discord bot capable of booking student group rooms and staff rooms via Daisy (administration tool for Department of Computer and Systems Sciences at Stockholm University)
+Copyright (C) 2024 Edwin Sundberg
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import argparse
+import asyncio
+import csv
+import datetime
+import json
+import logging
+import sys
+from collections import OrderedDict
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import attr
+import pytz
+from dotenv import load_dotenv
+
+# Before the project imports, daisy, transport and utils read their settings when imported
+load_dotenv()
+
+from daisy import BookingError, Daisy # pylint: disable=wrong-import-position
+from ratelimit import Priority
+from schedules import fetch_schedule, plan_slots, reserve
+from schemas import BookingSlot, RoomCategory, RoomRequest, RoomRestriction, RoomTime, Schedule
+from tenants import SessionPool, UserProfile, load_profiles
+from utils import run_async
+
+TIMEZONE = pytz.timezone("Europe/Stockholm")
+
+FILTER_NAMES = {
+    "g10": RoomRestriction.G10_ROOM,
+    "g5": RoomRestriction.G5_ROOM,
+    "green": RoomRestriction.GREEN_AREA,
+    "red": RoomRestriction.RED_AREA,
+}
+
+
+@attr.s(auto_attribs=True, frozen=True, slots=True)
+class BulkEntry:
+    # Where the entry came from, e.x. "slots.csv:3"
+    source: str
+    request: RoomRequest
+
+
+@attr.s(auto_attribs=True, frozen=True, slots=True)
+class RejectedEntry:
+    """An input row or event that can not be booked, reported instead of being rounded to whole hours"""
+    source: str
+    error: str
+
+
+def _parse_hour(value: str) -> int:
+    value = value.strip()
+    if ":" in value:
+        hour, minute = value.split(":")[:2]
+        if int(minute):
+            raise ValueError(f"Bookings start and end on the hour, got {value}")
+        return int(hour)
+    return int(value)
+
+
+def _parse_category(value: Optional[str], default: RoomCategory) -> RoomCategory:
+    if not value or not value.strip():
+        return default
+    value = value.strip()
+    return RoomCategory(int(value)) if value.isdigit() else RoomCategory[value.upper()]
+
+
+def _parse_filters(value: Optional[str], default: List[RoomRestriction]) -> List[RoomRestriction]:
+    if not value or not value.strip():
+        return default
+    return [FILTER_NAMES[name.strip().lower()] for name in value.replace(",", ";").split(";") if name.strip()]
+
+
+def _csv_entry(source: str, row: Dict[str, Optional[str]], category: RoomCategory, filters: List[RoomRestriction]) -> BulkEntry:
+    for column in ("date", "from"):
+        if not (row.get(column) or "").strip():
+            raise ValueError(f"Missing {column}")
+    from_time = _parse_hour(row["from"]) # type: ignore
+    if (row.get("duration") or "").strip():
+        duration = int(row["duration"]) # type: ignore
+    elif (row.get("to") or "").strip():
+        duration = _parse_hour(row["to"]) - from_time # type: ignore
+    else:
+        raise ValueError("Missing to or duration")
+    if duration < 1:
+        raise ValueError(f"Expected a positive number of hours, got {duration}")
+    return BulkEntry(source, RoomRequest(
+        title=row.get("title") or None,
+        date=datetime.date.fromisoformat(row["date"].strip()), # type: ignore
+        from_time=RoomTime(from_time),
+        duration=duration,
+        breaks=[],
+        room_restrictions=_parse_filters(row.get("room_filters"), filters),
+        room_category=_parse_category(row.get("room_category"), category),
+    ))
+
+
+def read_csv(path: str, category: RoomCategory, filters: List[RoomRestriction]) -> Tuple[List[BulkEntry], List[RejectedEntry]]:
+    """
+    Reads slots from a CSV file with a header row
+
+    Columns: date (YYYY-MM-DD), from (hour or HH:00), to or duration, and optionally title,
+    room_category (name or id) and room_filters (g10/g5/green/red separated by ;).
+    Malformed rows and rows not on whole hours are rejected one by one, the rest are still read.
+    """
+    entries = []
+    rejected = []
+    with open(path, newline="", encoding="utf-8") as file:
+        for line, row in enumerate(csv.DictReader(file), start=2):
+            row = {key.strip().lower(): value for key, value in row.items() if key is not None}
+            try:
+                entries.append(_csv_entry(f"{path}:{line}", row, category, filters))
+            except (KeyError, ValueError) as e:
+                rejected.append(RejectedEntry(f"{path}:{line}", f"{type(e).__name__}: {e}"))
+    return entries, rejected
+
+
+def _unfold(text: str) -> Iterator[str]:
+    line = ""
+    for raw in text.splitlines():
+        if raw.startswith((" ", "\t")):
+            line += raw[1:]
+            continue
+        if line:
+            yield line
+        line = raw
+    if line:
+        yield line
+
+
+def _parse_ics_datetime(value: str, params: Dict[str, str]) -> datetime.datetime:
+    if params.get("VALUE") == "DATE" or "T" not in value:
+        raise ValueError(f"All-day events can not be booked, got {value}")
+    if value.endswith("Z"):
+        return pytz.utc.localize(datetime.datetime.strptime(value, "%Y%m%dT%H%M%SZ")).astimezone(TIMEZONE)
+    parsed = datetime.datetime.strptime(value, "%Y%m%dT%H%M%S")
+    # Floating times are taken to be local, like times with a TZID
+    return pytz.timezone(params["TZID"]).localize(parsed).astimezone(TIMEZONE) if "TZID" in params else TIMEZONE.localize(parsed)
+
+
+def _expand_rrule(start: datetime.datetime, rule: str) -> List[datetime.datetime]:
+    """Supports the FREQ=DAILY/WEEKLY rules with INTERVAL, COUNT and UNTIL that calendars export for recurring sessions"""
+    parts = dict(part.split("=", 1) for part in rule.split(";") if part)
+    freq = parts.get("FREQ")
+    if freq not in ("DAILY", "WEEKLY") or set(parts) - {"FREQ", "INTERVAL", "COUNT", "UNTIL", "WKST"}:
+        raise ValueError(f"Unsupported RRULE {rule}")
+    step = datetime.timedelta(days=int(parts.get("INTERVAL", "1")) * (7 if freq == "WEEKLY" else 1))
+    count = int(parts["COUNT"]) if "COUNT" in parts else None
+    until = datetime.datetime.strptime(parts["UNTIL"][:8], "%Y%m%d").date() if "UNTIL" in parts else None
+    if count is None and until is None:
+        raise ValueError(f"Unbounded RRULE {rule}")
+    occurrences: List[datetime.datetime] = []
+    # Stepped in local wall-clock time, a weekly 10:00 session stays at 10:00 across daylight saving changes
+    current = start.replace(tzinfo=None)
+    while (count is None or len(occurrences) < count) and (until is None or current.date() <= until):
+        occurrences.append(TIMEZONE.localize(current))
+        current += step
+    return occurrences
+
+
+def _ics_entries(path: str, event: Dict[str, Tuple[str, Dict[str, str]]], exdates: List[datetime.datetime], category: RoomCategory, filters: List[RoomRestriction]) -> List[BulkEntry]:
+    for name in ("DTSTART", "DTEND"):
+        if name not in event:
+            raise ValueError(f"Missing {name}")
+    start = _parse_ics_datetime(*event["DTSTART"])
+    end = _parse_ics_datetime(*event["DTEND"])
+    # Rooms are booked by the hour, rounding would book time that was not asked for or drop time that was
+    for value in (start, end):
+        if value.minute or value.second:
+            raise ValueError(f"Events must start and end on the hour, got {start.strftime('%H:%M')}-{end.strftime('%H:%M')}")
+    duration, remainder = divmod(int((end - start).total_seconds()), 3600)
+    if duration < 1 or remainder:
+        raise ValueError(f"Expected a positive number of hours, got {start.strftime('%H:%M')}-{end.strftime('%H:%M')}")
+    starts = _expand_rrule(start, event["RRULE"][0]) if "RRULE" in event else [start]
+    title = event["SUMMARY"][0].replace("\\,", ",") if "SUMMARY" in event else None
+    return [
+        BulkEntry(f"{path}:{event.get('UID', ('?', {}))[0]}@{occurrence.date()}", RoomRequest(
+            title=title,
+            date=occurrence.date(),
+            from_time=RoomTime(occurrence.hour),
+            duration=duration,
+            breaks=[],
+            room_restrictions=filters,
+            room_category=category,
+        ))
+        for occurrence in starts
+        if occurrence not in exdates
+    ]
+
+
+def read_ics(path: str, category: RoomCategory, filters: List[RoomRestriction]) -> Tuple[List[BulkEntry], List[RejectedEntry]]:
+    """
+    Reads every VEVENT (SUMMARY is used as the title), recurring events are expanded
+
+    All-day events, events not on whole hours and malformed events are rejected one by one.
+    """
+    with open(path, encoding="utf-8") as file:
+        lines = list(_unfold(file.read()))
+    entries: List[BulkEntry] = []
+    rejected: List[RejectedEntry] = []
+    event: Optional[Dict[str, Tuple[str, Dict[str, str]]]] = None
+    exdates: List[datetime.datetime] = []
+    # An EXDATE that can not be read rejects its event
+    exdate_error: Optional[str] = None
+    for line in lines:
+        if line == "BEGIN:VEVENT":
+            event, exdates, exdate_error = {}, [], None
+            continue
+        if line == "END:VEVENT" and event is not None:
+            source = f"{path}:{event.get('UID', ('?', {}))[0]}"
+            try:
+                if exdate_error is not None:
+                    raise ValueError(exdate_error)
+                entries.extend(_ics_entries(path, event, exdates, category, filters))
+            except (KeyError, ValueError) as e:
+                rejected.append(RejectedEntry(source, f"{type(e).__name__}: {e}"))
+            event = None
+            continue
+        if event is None or ":" not in line:
+            continue
+        name_and_params, value = line.split(":", 1)
+        name, *raw_params = name_and_params.split(";")
+        params = dict(param.split("=", 1) for param in raw_params if "=" in param)
+        if name == "EXDATE":
+            try:
+                exdates.extend(_parse_ics_datetime(v, params) for v in value.split(","))
+            except ValueError as e:
+                exdate_error = f"EXDATE: {e}"
+        else:
+            event[name] = (value, params)
+    return entries, rejected
+
+
+async def plan(daisy: Daisy, entries: List[BulkEntry], workers: int) -> List[List[BookingSlot]]:
+    """
+    Plans all entries jointly, each (date, category) schedule is fetched once
+
+    Entries sharing a schedule are planned in input order around the slots planned before them.
+    """
+    groups: "OrderedDict[Tuple[datetime.date, RoomCategory], List[int]]" = OrderedDict()
+    for i, entry in enumerate(entries):
+        groups.setdefault((entry.request.date, entry.request.room_category), []).append(i)
+
+    plans: List[List[BookingSlot]] = [[] for _ in entries]
+    semaphore = asyncio.Semaphore(workers)
+
+    async def plan_group(date: datetime.date, category: RoomCategory, indices: List[int]):
+        async with semaphore:
+            schedule = await fetch_schedule(daisy, date, category, Priority.BACKGROUND)
+        for i in indices:
+            request = entries[i].request
+            plans[i] = await plan_slots(schedule, request.from_time, request.duration, request.breaks, request.room_restrictions)
+            schedule = reserve(schedule, plans[i])
+
+    await asyncio.gather(*(plan_group(date, category, indices) for (date, category), indices in groups.items()))
+    return plans
+
+
+async def book(daisy: Daisy, entries: List[BulkEntry], plans: List[List[BookingSlot]], workers: int) -> List[List[Optional[str]]]:
+    """Books every planned slot with at most `workers` bookings in flight, returns an error (or None) per slot"""
+    categories = {entry.request.room_category for entry in entries}
+    if RoomCategory.BOOKABLE_GROUP_ROOMS in categories:
+        await run_async(daisy.ensure_booking_user, datetime.date.today(), Priority.BOOKING)
+    if categories - {RoomCategory.BOOKABLE_GROUP_ROOMS}:
+        await run_async(daisy.ensure_session, True, Priority.BOOKING)
+
+    errors: List[List[Optional[str]]] = [[None] * len(slots) for slots in plans]
+    semaphore = asyncio.Semaphore(workers)
+
+    async def book_entry(i: int):
+        request = entries[i].request
+        payloads = daisy.prepare_slots(request.room_category, plans[i], request.date, request.title or "Meeting")
+        for j, payload in enumerate(payloads):
+            async with semaphore:
+                try:
+                    await run_async(daisy.submit_booking, request.room_category, payload)
+                except BookingError as e:
+                    errors[i][j] = str(e)
+                except Exception as e: # pylint: disable=broad-except
+                    logging.exception("Booking %s failed", entries[i].source)
+                    errors[i][j] = repr(e)
+
+    await asyncio.gather(*(book_entry(i) for i in range(len(entries))))
+    return errors
+
+
+def build_report(entries: List[BulkEntry], plans: List[List[BookingSlot]], errors: Optional[List[List[Optional[str]]]], rejected: Optional[List[RejectedEntry]] = None) -> Dict[str, Any]:
+    results = []
+    for i, entry in enumerate(entries):
+        request = entry.request
+        slots = []
+        for j, slot in enumerate(plans[i]):
+            status = "planned" if errors is None else ("failed" if errors[i][j] is not None else "booked")
+            slots.append({
+                "room": slot.room.name,
+                "from_time": slot.from_time.value,
+                "to_time": slot.to_time.value,
+                "status": status,
+                "error": errors[i][j] if errors is not None else None,
+            })
+        planned_hours = sum(slot.to_time.value - slot.from_time.value for slot in plans[i])
+        results.append({
+            "source": entry.source,
+            "title": request.title,
+            "date": request.date.isoformat(),
+            "from_time": request.from_time.value,
+            "duration": request.duration,
+            "room_category": request.room_category.name,
+            "fully_planned": planned_hours >= request.duration,
+            "slots": slots,
+        })
+    statuses = [slot["status"] for result in results for slot in result["slots"]]
+    return {
+        "dry_run": errors is None,
+        "requests": results,
+        "rejected": [{"source": entry.source, "error": entry.error} for entry in rejected or []],
+        "summary": {
+            "requests": len(results),
+            "rejected": len(rejected or []),
+            "fully_planned": sum(result["fully_planned"] for result in results),
+            "slots": len(statuses),
+            "booked": statuses.count("booked"),
+            "failed": statuses.count("failed"),
+        },
+    }
+
+
+def exit_status(report: Dict[str, Any]) -> int:
+    """1 if anything was rejected, not fully planned or failed to book, a partial plan books less than was asked for"""
+    summary = report["summary"]
+    return 1 if summary["failed"] or summary["rejected"] or summary["fully_planned"] < summary["requests"] else 0
+
+
+def _select_profile(profiles: Dict[int, UserProfile], user: Optional[int]) -> UserProfile:
+    if user is not None:
+        return profiles[user]
+    return next(iter(profiles.values()))
+
+
+async def run(args: argparse.Namespace) -> Dict[str, Any]:
+    filters = _parse_filters(args.filters, [])
+    category = _parse_category(args.category, RoomCategory.BOOKABLE_GROUP_ROOMS)
+    reader = read_ics if args.input.lower().endswith(".ics") else read_csv
+    entries, rejected = reader(args.input, category, filters)
+
+    daisy = SessionPool(max_sessions=1).get(_select_profile(load_profiles(), args.user))
+    plans = await plan(daisy, entries, args.workers)
+    errors = None if args.dry_run else await book(daisy, entries, plans, args.workers)
+    return build_report(entries, plans, errors, rejected)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(
+        description="Plan and book many room slots from a CSV or ICS file",
+        epilog="Exits with 1 if any input was rejected, any entry could not be fully planned or any booking failed, also with --dry-run",
+    )
+    parser.add_argument("input", help="CSV (date,from,to|duration[,title,room_category,room_filters]) or ICS file")
+    parser.add_argument("--dry-run", action="store_true", help="only plan, nothing is booked")
+    parser.add_argument("--workers", type=int, default=4, help="schedule fetches and bookings in flight at once")
+    parser.add_argument("--report", help="write the JSON report here instead of stdout")
+    parser.add_argument("--category", help="room category for entries without one, defaults to BOOKABLE_GROUP_ROOMS")
+    parser.add_argument("--filters", help="room filters for entries without any, e.x. g10;green")
+    parser.add_argument("--user", type=int, help="discord id of the USERS_FILE profile to book as, defaults to the first")
+    args = parser.parse_args(argv)
+    args.workers = max(args.workers, 1)
+
+    report = asyncio.run(run(args))
+    output = json.dumps(report, indent=2)
+    if args.report:
+        with open(args.report, "w", encoding="utf-8") as file:
+            file.write(output + "\n")
+    else:
+        print(output)
+    return exit_status(report)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,115 @@
+"""
+A discord bot capable of booking student group rooms and staff rooms via Daisy (administration tool for Department of Computer and Systems Sciences at Stockholm University)
+Copyright (C) 2024 Edwin Sundberg
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import datetime
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Generic, List, Optional, Tuple, TypeVar
+
+import pytz
+
+TIMEZONE = pytz.timezone("Europe/Stockholm")
+
+V = TypeVar("V")
+
+
+def _end_of_day(now: datetime.datetime) -> datetime.datetime:
+    tomorrow = now.astimezone(TIMEZONE).date() + datetime.timedelta(days=1)
+    return TIMEZONE.localize(datetime.datetime.combine(tomorrow, datetime.time()))
+
+
+class DailyTTLCache(Generic[V]):
+    """
+    Bounded LRU cache where entries expire after `ttl` seconds or at the end of the
+    calendar day (Europe/Stockholm) they were stored on, whichever comes first.
+
+    Anything relative ("tomorrow", "next friday") resolved on one day must not be served on the next.
+    `max_entries` <= 0 disables the cache, nothing is stored and every lookup misses.
+    """
+    def __init__(self, max_entries: int = 256, ttl: int = 3600, clock: Callable[[], datetime.datetime] = lambda: datetime.datetime.now(TIMEZONE)):
+        self.max_entries = max(max_entries, 0)
+        self.ttl = datetime.timedelta(seconds=ttl)
+        self._clock = clock
+        self._entries: "OrderedDict[str, Tuple[datetime.datetime, V]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: str, now: Optional[datetime.datetime] = None) -> Optional[V]:
+        now = now or self._clock()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires_at, value = entry
+            if now >= expires_at:
+                del self._entries[key]
+                self.evictions += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: str, value: V, now: Optional[datetime.datetime] = None):
+        if self.max_entries == 0:
+            return
+        now = now or self._clock()
+        expires_at = min(now + self.ttl, _end_of_day(now))
+        with self._lock:
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hit_rate,
+        }
+
+
+def completion_key(model: str, messages: List[Dict[str, str]]) -> str:
+    """
+    Normalised hash of a chat completion request
+
+    Whitespace is collapsed so that trivially different phrasings (and the indentation of the system prompt) hash the same.
+    The system prompt carries the date context, so a new day (or hour) always yields a new key.
+    """
+    normalised = [(m.get("role", ""), " ".join(m.get("content", "").split())) for m in messages]
+    payload = json.dumps([model, normalised], ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
@@ -15,47 +15,205 @@ GNU General Public License for more details.
 You should have received a copy of the GNU General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
+import time
 
+# Measured from the very first line so that imports count towards time-to-ready
+STARTED_AT = time.perf_counter()
+
+import asyncio
+import datetime
+import importlib
 import json
+import logging
 import os
-from typing import List, Optional, Tuple, Union
+from types import ModuleType
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple, Union
+import attr
 import discord
 from dotenv import load_dotenv
 
-from agent import RoomRequest, handle_message_retries
-from daisy import BookingError, Daisy
-from scheduler import schedule_rooms
-from schemas import BookingSlot, RoomCategory
-from utils import run_async
-
+# Before the project imports, daisy, transport, utils and release read their settings when imported
 load_dotenv()
 
+import fastpath # pylint: disable=wrong-import-position
+import feeds
+from history import OccupancyHistory
+import metrics
+import profiling
+import webserver
+from breaker import CircuitOpenError
+from daisy import BOOKING_OBSERVERS, DAISY_BREAKER, DAISY_LOGIN_BREAKER, DAISY_RATE_LIMITER, DAISY_TRANSPORT, BookingError, Daisy
+from ratelimit import Priority
+from release import PlannedBooking, ReleaseQueue, ReleaseResult, opening_time
+from schedules import SCHEDULE_OBSERVERS, fetch_schedule, plan_is_free, plan_slots
+from scheduler import ROOM_PREFERENCE_ORDER
+from series import SeriesEngine, SeriesStore, parse_series
+from store import ConversationStore, Turn
+from schemas import BookingSlot, Room, RoomCategory, RoomRequest, RoomRestriction, RoomTime, Schedule
+from tenants import FairScheduler, SessionPool, UserProfile, load_profiles
+from structured import COUNTERS as STRUCTURED_OUTPUT_COUNTERS
+from utils import lane_stats, run_async, run_llm
+
+
+def _agent() -> ModuleType:
+    """
+    The agent (LLM client, prompts, pytz) is imported on first use rather than at startup
+
+    on_ready imports it in the background, so normally it is already loaded when the first message arrives.
+    """
+    return importlib.import_module("agent")
+
 OWNER_ID = int(os.getenv("DISCORD_OWNER_ID"))  # type: ignore
 TOKEN: str = os.getenv("DISCORD_TOKEN")  # type: ignore
 
+# Checked here as well as in agent, which is only imported after startup
+if os.getenv("CF_API_BASE_URL") is None or os.getenv("CF_BEARER_TOKEN") is None:
+    raise ValueError("CF_API_BASE_URL and CF_BEARER_TOKEN must be set in environment")
+
 intents = discord.Intents.default()
 
 client = discord.Client(intents=intents)
 
-daisy = Daisy(
-    os.getenv("SU_USERNAME"), # type: ignore
-    os.getenv("SU_PASSWORD"), # type: ignore
-    os.getenv("SECOND_USER_SEARCH_TERM"), # type: ignore
-    int(os.getenv("SECOND_USER_ID")), # type: ignore
-    staff = bool(int(os.getenv("SU_STAFF", "0"))), # type: ignore
+# Authorised users, without USERS_FILE only the owner
+profiles: Dict[int, UserProfile] = load_profiles()
+
+session_pool = SessionPool(
+    max_sessions=int(os.getenv("DAISY_SESSION_POOL_SIZE", "8")),
+    idle_timeout=int(os.getenv("DAISY_SESSION_IDLE_TIMEOUT", "3600")),
+)
+
+fair_scheduler = FairScheduler(
+    max_concurrent=int(os.getenv("MAX_CONCURRENT_MESSAGES", "4")),
+    per_user=int(os.getenv("MAX_CONCURRENT_MESSAGES_PER_USER", "1")),
 )
 
 # Discord UI element (YES/NO) with BookingSlot
+class ProgressMessage:
+    """
+    Edits a message with the latest content, coalescing updates so at most one edit is in flight
+
+    Keeps progress reporting within discord's edit rate limits however many updates arrive.
+    """
+    def __init__(self, message: Union[discord.Message, discord.WebhookMessage]):
+        self.message = message
+        self._latest: Optional[str] = None
+        self._editing: Optional["asyncio.Task[None]"] = None
+
+    def update(self, content: str):
+        self._latest = content
+        if self._editing is None or self._editing.done():
+            self._editing = asyncio.create_task(self._flush())
+
+    async def _flush(self):
+        while self._latest is not None:
+            content, self._latest = self._latest, None
+            try:
+                await self.message.edit(content=content[:2000])
+            except discord.HTTPException:
+                logging.warning("Failed to edit progress message", exc_info=True)
+
+    async def finish(self, content: str):
+        if self._editing is not None:
+            await self._editing
+        self._latest = content
+        await self._flush()
+
+
+# Seconds between re-checks of an open plan, for hours that are usually fully booked a quarter of it
+CONFIRM_REFRESH_INTERVAL = float(os.getenv("CONFIRM_REFRESH_INTERVAL", "45"))
+CONTENDED_REFRESH_FACTOR = 0.25
+# Slots booked at once by "Book all"
+BOOK_ALL_CONCURRENCY = max(int(os.getenv("BOOK_ALL_CONCURRENCY", "4")), 1)
+
+
 class Confirm(discord.ui.View):
-    def __init__(self, author: Union[discord.User, discord.Member], requests: List[Tuple[RoomRequest, List[BookingSlot]]]) -> None:
+    def __init__(self, author: Union[discord.User, discord.Member], daisy: Daisy, requests: List[Tuple[RoomRequest, List[BookingSlot]]], preference_order: Optional[List[Room]] = None) -> None:
         super().__init__()
         self.author = author
+        self.daisy = daisy
         self.requests = requests
+        self.preference_order = preference_order
         self.active = 0
+        self.message: Optional[discord.Message] = None
+        # request index -> booking payloads of its current plan, built ahead of the click
+        self.payloads: Dict[int, List[Dict[str, Any]]] = {}
+        self._refresher: Optional["asyncio.Task[None]"] = None
+
+    def _title(self, index: int) -> str:
+        request = self.requests[index][0]
+        return request.title if request.title is not None else 'Meeting'
+
+    def start_refreshing(self):
+        self._refresher = asyncio.create_task(self._keep_fresh())
+
+    def stop(self):
+        if self._refresher is not None:
+            self._refresher.cancel()
+        super().stop()
+
+    async def on_timeout(self):
+        if self._refresher is not None:
+            self._refresher.cancel()
+
+    async def _keep_fresh(self):
+        while not self.is_finished():
+            try:
+                await self.refresh()
+            except Exception: # pylint: disable=broad-except
+                logging.warning("Failed to refresh booking plan", exc_info=True)
+            await asyncio.sleep(await self._refresh_interval())
+
+    async def _refresh_interval(self) -> float:
+        """Plans for hours that are usually busy are re-checked more often, their rooms are the most likely to be taken"""
+        contention = 0.0
+        for request, _ in self.requests[self.active:]:
+            contention = max(contention, await run_async(
+                occupancy_history.busiest, request.date, request.from_time.value, request.from_time.value + request.duration, request.room_category,
+            ))
+        return CONFIRM_REFRESH_INTERVAL * (1 - (1 - CONTENDED_REFRESH_FACTOR) * contention)
+
+    async def refresh(self):
+        """
+        Keeps the session warm, re-checks the planned rooms and hours, re-plans stale requests and prebuilds their payloads
+
+        So that clicking Book only leads to the booking POSTs.
+        """
+        pending = range(self.active, len(self.requests))
+        categories = {self.requests[i][0].room_category for i in pending}
+        if RoomCategory.BOOKABLE_GROUP_ROOMS in categories:
+            await run_async(self.daisy.ensure_booking_user, datetime.date.today(), Priority.BACKGROUND)
+        if categories - {RoomCategory.BOOKABLE_GROUP_ROOMS}:
+            await run_async(self.daisy.ensure_session, True, Priority.BACKGROUND)
+
+        for i in pending:
+            request, slots = self.requests[i]
+            replanned = False
+            if i in self.payloads:
+                # The plan was fresh when it was made, later passes check whether it still is
+                schedule = await fetch_schedule(self.daisy, request.date, request.room_category, Priority.BACKGROUND)
+                if plan_is_free(schedule, slots):
+                    continue
+                slots = await plan_slots(schedule, request.from_time, request.duration, request.breaks, request.room_restrictions, self.preference_order)
+                replanned = True
+                metrics.inc("confirm_replans_total")
+            if i < self.active:
+                # Handled while we were checking
+                continue
+            # Swapped without awaiting in between, a click sees either the old plan or the new one
+            self.requests[i] = (request, slots)
+            self.payloads[i] = self.daisy.prepare_slots(request.room_category, slots, request.date, self._title(i))
+            if replanned and i == self.active and self.message is not None:
+                await self.generate_and_set_embed(message=self.message)
+
+    async def interaction_check(self, interaction: discord.Interaction) -> bool:
+        # Bookings are made with the author's credentials
+        return interaction.user.id == self.author.id
 
     async def generate_and_set_embed(self, message: Optional[discord.Message] = None, interaction: Optional[discord.Interaction] = None):
         if message is None and interaction is None:
             raise ValueError("Either message or interaction must be provided")
+        if message is not None:
+            self.message = message
         if self.active >= len(self.requests):
             embed = discord.Embed(title="All slots have been processed")
             if message is not None:
@@ -78,27 +236,238 @@ class Confirm(discord.ui.View):
 
     @discord.ui.button(label="Book", style=discord.ButtonStyle.green)
     async def yes(self, interaction: discord.Interaction, button: discord.ui.Button) -> None:
+        index = self.active
         self.active += 1
         await self.generate_and_set_embed(interaction=interaction)
-        request = self.requests[self.active-1]
+        request = self.requests[index]
+        payloads = self.payloads.pop(index, None)
         try:
-            await run_async(daisy.book_slots, request[0].room_category, request[1], request[0].date, request[0].title if request[0].title is not None else 'Meeting')
-        except BookingError as e:
+            if payloads is not None:
+                await run_async(self.daisy.book_prepared, request[0].room_category, request[0].date, payloads)
+            else:
+                await run_async(self.daisy.book_slots, request[0].room_category, request[1], request[0].date, self._title(index))
+        except (BookingError, CircuitOpenError) as e:
             await interaction.followup.send(f"Failed to book slot(s): {e}", ephemeral=True)
         else:
             await interaction.followup.send("Slot(s) have been booked", ephemeral=True)
 
+    @discord.ui.button(label="Book all", style=discord.ButtonStyle.blurple)
+    async def book_all(self, interaction: discord.Interaction, button: discord.ui.Button) -> None:
+        # Acknowledged straight away, the bookings themselves can take longer than discord waits for a response
+        await interaction.response.defer()
+        pending = list(range(self.active, len(self.requests)))
+        self.active = len(self.requests)
+        if self.message is not None:
+            await self.generate_and_set_embed(message=self.message)
+        else:
+            self.stop()
+
+        jobs: List[Tuple[RoomCategory, BookingSlot, datetime.date, Dict[str, Any]]] = []
+        for i in pending:
+            request, slots = self.requests[i]
+            payloads = self.payloads.pop(i, None) or self.daisy.prepare_slots(request.room_category, slots, request.date, self._title(i))
+            jobs.extend((request.room_category, slot, request.date, payload) for slot, payload in zip(slots, payloads))
+        if not jobs:
+            await interaction.followup.send("Nothing to book", ephemeral=True)
+            return
+
+        results: List[str] = [f"⏳ {slot.room.name} {date} {slot.from_time.to_string()}->{slot.to_time.to_string()}" for _, slot, date, _ in jobs]
+        status = await interaction.followup.send("\n".join(results), wait=True)
+        updater = ProgressMessage(status)
+
+        # Signed in once up front so the concurrent bookings do not race to do it
+        categories = {category for category, _, _, _ in jobs}
+        try:
+            if RoomCategory.BOOKABLE_GROUP_ROOMS in categories:
+                await run_async(self.daisy.ensure_booking_user, datetime.date.today(), Priority.BOOKING)
+            if categories - {RoomCategory.BOOKABLE_GROUP_ROOMS}:
+                await run_async(self.daisy.ensure_session, True, Priority.BOOKING)
+        except Exception as e: # pylint: disable=broad-except
+            logging.exception("Failed to sign in for Book all")
+            await status.edit(content=f"Failed to sign in: {e}")
+            return
+
+        semaphore = asyncio.Semaphore(BOOK_ALL_CONCURRENCY)
+
+        async def book(index: int, category: RoomCategory, slot: BookingSlot, date: datetime.date, payload: Dict[str, Any]):
+            label = f"{slot.room.name} {date} {slot.from_time.to_string()}->{slot.to_time.to_string()}"
+            async with semaphore:
+                try:
+                    await run_async(self.daisy.submit_booking, category, payload)
+                except BookingError as e:
+                    results[index] = f"❌ {label}: {e}"
+                except Exception as e: # pylint: disable=broad-except
+                    logging.exception("Booking %s failed", label)
+                    results[index] = f"❌ {label}: {e}"
+                else:
+                    results[index] = f"✅ {label}"
+            updater.update("\n".join(results))
+
+        with metrics.timed("book_all"):
+            await asyncio.gather(*(book(i, *job) for i, job in enumerate(jobs)))
+        booked = sum(result.startswith("✅") for result in results)
+        await updater.finish("\n".join(results) + f"\n{booked}/{len(results)} slot(s) booked")
+
     @discord.ui.button(label="Skip", style=discord.ButtonStyle.red)
     async def no(self, interaction: discord.Interaction, button: discord.ui.Button) -> None:
         self.active += 1
         await self.generate_and_set_embed(interaction=interaction)
 
 
-cache = {} # Memory leaks but for the scope of the project, it's fine
+series_engine = SeriesEngine(SeriesStore(os.getenv("SERIES_DB_PATH", "series.db")))
+SERIES_INTERVAL = float(os.getenv("SERIES_INTERVAL", "900"))
+
+release_queue = ReleaseQueue(prepare_ahead=float(os.getenv("RELEASE_PREPARE_AHEAD", "30")))
+
+conversation_store = ConversationStore(
+    max_turns=int(os.getenv("CONVERSATION_STORE_SIZE", "2048")),
+    path=os.getenv("CONVERSATION_DB_PATH") or None,
+)
+
+metrics.gauge("llm_cache", lambda: _agent().COMPLETION_CACHE.stats())
+metrics.gauge("resolved_messages", lambda: dict(_agent().PATH_COUNTERS))
+metrics.gauge("llm_router", lambda: _agent().LLM_ROUTER.stats())
+metrics.gauge("structured_output", lambda: dict(STRUCTURED_OUTPUT_COUNTERS))
+metrics.gauge("executor_lanes", lambda: {f"{lane}.{key}": value for lane, stats in lane_stats().items() for key, value in stats.items()})
+metrics.gauge("daisy_rate_limit_wait_seconds", lambda: {
+    priority: total / count for priority, (count, total, _) in DAISY_RATE_LIMITER.wait_stats.items() if count
+})
+metrics.gauge("daisy_rate_limit_queued", lambda: DAISY_RATE_LIMITER.queued)
+metrics.gauge("daisy_sessions", lambda: {"active": len(session_pool), "evictions": session_pool.evictions})
+metrics.gauge("messages", lambda: {"active": fair_scheduler.active, "waiting": fair_scheduler.waiting})
+metrics.gauge("conversation_turns", lambda: len(conversation_store))
+metrics.gauge("startup_seconds", lambda: dict(startup_timings))
+metrics.gauge("daisy_transport", DAISY_TRANSPORT.stats)
+metrics.gauge("circuit_breakers", lambda: {
+    f"{name}.{key}": value
+    for name, stats in (("daisy", DAISY_BREAKER.stats()), ("daisy_login", DAISY_LOGIN_BREAKER.stats()), ("llm", _agent().LLM_BREAKER.stats()))
+    for key, value in stats.items()
+})
+metrics.gauge("release_queue", lambda: len(release_queue.pending))
+metrics.gauge("series_occurrences", lambda: {"booked": series_engine.booked, "failed": series_engine.failed})
+
+
+calendar_feeds = feeds.CalendarFeeds(keep_days=int(os.getenv("CALENDAR_KEEP_DAYS", "30")))
+SCHEDULE_OBSERVERS.append(calendar_feeds.observe_schedule)
+BOOKING_OBSERVERS.append(calendar_feeds.observe_booking)
+
+metrics.gauge("calendar_day_renders", lambda: calendar_feeds.day_renders)
+
+occupancy_history = OccupancyHistory(os.getenv("HISTORY_DB_PATH", "history.db"), retention_days=int(os.getenv("HISTORY_RETENTION_DAYS", "180")))
+
+
+def _write_in_background(description: str, func: Callable[..., Any], *args: Any):
+    """Runs a blocking (SQLite) write on the IO lane without waiting for it, failures are logged"""
+    async def write():
+        try:
+            await run_async(func, *args)
+        except Exception: # pylint: disable=broad-except
+            logging.exception("%s failed", description)
+
+    task = asyncio.get_running_loop().create_task(write())
+    detached_tasks.add(task)
+    task.add_done_callback(detached_tasks.discard)
+
+
+def _record_occupancy(schedule: Schedule):
+    # Observers run on the event loop
+    _write_in_background("Recording occupancy", occupancy_history.record, schedule)
+
+
+SCHEDULE_OBSERVERS.append(_record_occupancy)
+metrics.gauge("occupancy_rows_written", lambda: occupancy_history.rows_written)
+
+
+def _calendar_response(feed: str, headers) -> webserver.Response:
+    body, etag = calendar_feeds.render(feed)
+    if headers.get("If-None-Match") == etag:
+        return webserver.Response(304, b"", "text/calendar; charset=utf-8", {"ETag": etag})
+    return webserver.Response(200, body, "text/calendar; charset=utf-8", {"ETag": etag, "Cache-Control": "no-cache"})
+
+
+@webserver.route("/calendar/bookings.ics")
+def bookings_calendar(headers) -> webserver.Response:
+    return _calendar_response(feeds.BOOKINGS, headers)
+
+
+@webserver.route("/calendar/free.ics")
+def free_calendar(headers) -> webserver.Response:
+    return _calendar_response(feeds.FREE, headers)
+
+
+@webserver.route("/metrics")
+def metrics_endpoint(headers) -> webserver.Response:
+    return webserver.Response(200, metrics.REGISTRY.render_prometheus().encode("utf-8"), "text/plain; version=0.0.4")
+
+
+background_tasks: List["asyncio.Task[None]"] = []
+
+# stage -> seconds since STARTED_AT
+startup_timings: Dict[str, float] = {}
+
+
+async def _warm_up_profile(profile: UserProfile):
+    daisy = session_pool.get(profile)
+    today = datetime.date.today()
+
+    async def student():
+        await run_async(daisy.ensure_session, False, Priority.BACKGROUND)
+        await run_async(daisy.ensure_booking_user, today, Priority.BACKGROUND)
+
+    steps = [student(), fetch_schedule(daisy, today, RoomCategory.BOOKABLE_GROUP_ROOMS, Priority.BACKGROUND)]
+    if profile.staff:
+        steps.append(run_async(daisy.ensure_session, True, Priority.BACKGROUND))
+    for result in await asyncio.gather(*steps, return_exceptions=True):
+        if isinstance(result, Exception):
+            # Not fatal, the first real request simply does the work itself
+            logging.warning("Warm-up for %s failed: %r", profile.discord_id, result)
+
+
+async def warm_up():
+    """Signs in, adds the booking user and fetches today's schedule for every user concurrently, while the agent is imported"""
+    started = time.perf_counter()
+    warmed = list(profiles.values())[:session_pool.max_sessions]
+    imported, *_ = await asyncio.gather(run_llm(_agent), *(_warm_up_profile(profile) for profile in warmed), return_exceptions=True)
+    if isinstance(imported, BaseException):
+        # Every chat message would fail on the same error, so it is not swallowed
+        logging.error("Importing the agent failed", exc_info=imported)
+        raise imported
+    startup_timings["warm_up"] = time.perf_counter() - started
+    startup_timings["ready"] = time.perf_counter() - STARTED_AT
+    print(f"Warm in {startup_timings['ready']:.2f}s (warm-up {startup_timings['warm_up']:.2f}s, {len(warmed)} user(s))")
+
 
 @client.event
 async def on_ready():
-    print(f"We have logged in as {client.user}")
+    startup_timings.setdefault("logged_in", time.perf_counter() - STARTED_AT)
+    print(f"We have logged in as {client.user} after {startup_timings['logged_in']:.2f}s")
+    if os.getenv("METRICS_PORT"):
+        webserver.start(os.getenv("METRICS_HOST", "127.0.0.1"), int(os.getenv("METRICS_PORT"))) # type: ignore
+    # on_ready fires again after reconnects
+    if not background_tasks:
+        background_tasks.append(asyncio.create_task(evict_idle_sessions()))
+        background_tasks.append(asyncio.create_task(book_series()))
+        background_tasks.append(asyncio.create_task(warm_up()))
+
+
+def _series_daisy(user_id: int) -> Optional[Daisy]:
+    profile = profiles.get(user_id)
+    return session_pool.get(profile) if profile is not None else None
+
+
+async def book_series():
+    while True:
+        try:
+            await series_engine.run_once(_series_daisy)
+        except Exception: # pylint: disable=broad-except
+            logging.exception("Booking series occurrences failed")
+        await asyncio.sleep(SERIES_INTERVAL)
+
+
+async def evict_idle_sessions():
+    while True:
+        await asyncio.sleep(60)
+        session_pool.evict_idle()
 
 
 @client.event
@@ -106,48 +475,216 @@ async def on_message(message: discord.Message):
     if message.author == client.user:
         return
 
-    if message.author.id != OWNER_ID:
+    if message.author.id == OWNER_ID and message.content.strip() == "!stats":
+        await message.reply(f"```\n{metrics.REGISTRY.summary()[:1900]}\n```")
+        return
+
+    profile = profiles.get(message.author.id)
+    if profile is None:
         return
 
     if not message.content:
         return
 
+    if message.content.startswith("!usually "):
+        await usually_free(message, message.content[len("!usually "):])
+        return
+
+    if message.content.startswith("!series"):
+        await handle_series_command(message, profile, message.content[len("!series"):].strip())
+        return
+
+    if message.content.startswith("!release "):
+        # Waits until the opening, so it does not hold on to a message slot
+        await queue_release(message, profile, message.content[len("!release "):])
+        return
+
+    async with fair_scheduler.slot(profile.discord_id):
+        if message.author.id == OWNER_ID and message.content.startswith("!profile "):
+            # Opt-in profiling of a single request, written to PROFILE_DIR and summarised in a reply
+            with profiling.profile_request(f"message-{message.id}") as request_profile:
+                with metrics.timed("message"):
+                    await handle_chat_message(message, profile, message.content[len("!profile "):])
+            await message.reply(f"```\n{request_profile.summary()[:1900]}\n```")
+            return
+
+        with metrics.timed("message"):
+            await handle_chat_message(message, profile, message.content)
+
+
+# Tasks that outlive the message that started them, referenced here so they are not garbage collected
+detached_tasks: Set["asyncio.Task[Any]"] = set()
+
+
+async def usually_free(message: discord.Message, content: str):
+    """Answers "<weekday> XX-YY [g10/g5/green/red]" with the rooms most often free then, from the occupancy history"""
+    words = fastpath.WORD_PATTERN.findall(fastpath.HOURS_PATTERN.sub(" ", content.lower()))
+    hours = fastpath.HOURS_PATTERN.findall(content)
+    weekdays = [fastpath.WEEKDAYS.index(word.rstrip("s")) for word in words if word.rstrip("s") in fastpath.WEEKDAYS]
+    filters = [fastpath.FILTER_WORDS[word] for word in words if word in fastpath.FILTER_WORDS]
+    if len(hours) != 1 or len(weekdays) != 1 or not 0 <= int(hours[0][0]) < int(hours[0][1]) <= 24:
+        await message.reply("Usage: !usually <weekday> XX-YY [g10/g5/green/red]")
+        return
+    rooms = await run_async(occupancy_history.usually_free, weekdays[0], int(hours[0][0]), int(hours[0][1]), room_restrictions=filters)
+    if not rooms:
+        await message.reply("No history for that time yet")
+        return
+    await message.reply("\n".join(f"{r.room.name}: free {r.free_ratio:.0%} of {r.samples} {fastpath.WEEKDAYS[weekdays[0]].capitalize()}s" for r in rooms[:10]))
+
+
+async def handle_series_command(message: discord.Message, profile: UserProfile, content: str):
+    """!series (list), !series remove <id> or !series <weekday> XX-YY until YYYY-MM-DD [filters] [room G10:2] ["title"]"""
+    if content in ("", "list"):
+        series = series_engine.store.list(profile.discord_id)
+        await message.reply("\n".join(s.describe() for s in series) if series else "No series")
+        return
+    if content.startswith("remove "):
+        series_id = content[len("remove "):].strip().lstrip("#")
+        removed = series_id.isdigit() and series_engine.store.remove(int(series_id), profile.discord_id)
+        await message.reply("Series removed" if removed else "No such series")
+        return
+    parsed = parse_series(content, profile.discord_id, datetime.date.today())
+    if parsed is None:
+        await message.reply('Usage: !series <weekday> XX-YY until YYYY-MM-DD [g10/g5/green/red] [room G10:2] ["title"], !series list or !series remove <id>')
+        return
+    if not parsed.room_restrictions and profile.preferences.room_filters:
+        parsed = attr.evolve(parsed, room_restrictions=profile.preferences.room_filters)
+    if parsed.title is None and profile.preferences.default_title is not None:
+        parsed = attr.evolve(parsed, title=profile.preferences.default_title)
+    added = series_engine.store.add(parsed)
+    await message.reply(f"Added {added.describe()}, occurrences are booked as they become bookable")
+    # Occurrences already within the window are booked right away
+    task = asyncio.create_task(series_engine.run_once(_series_daisy))
+    detached_tasks.add(task)
+    task.add_done_callback(detached_tasks.discard)
+
+
+async def queue_release(message: discord.Message, profile: UserProfile, content: str):
+    """Queues a "<date> XX-YY [filters] ["title"]" booking to be made the moment its date becomes bookable"""
+    parsed = fastpath.parse_message(content, bookable_days=366)
+    if parsed is None:
+        await message.reply('Usage: !release <date> XX-YY [g10/g5/green/red] ["title"]')
+        return
+    raw = parsed.requests[0]
+    date = datetime.date.fromisoformat(raw["date"])
+    if opening_time(date) <= datetime.datetime.now(datetime.timezone.utc):
+        await message.reply(f"{date.isoformat()} is already bookable, just ask for it")
+        return
+    booking = PlannedBooking(
+        user_id=profile.discord_id,
+        date=date,
+        from_time=RoomTime(raw["from_time"]),
+        to_time=RoomTime(raw["from_time"] + raw["duration"]),
+        title=raw.get("title") or profile.preferences.default_title or "Meeting",
+        room_restrictions=[RoomRestriction(value) for value in raw.get("room_filters", [])] or profile.preferences.room_filters,
+        preference_order=profile.preferences.preference_order(),
+    )
+
+    async def run():
+        try:
+            result: ReleaseResult = await release_queue.run(session_pool.get(profile), booking)
+        except Exception as e: # pylint: disable=broad-except
+            logging.exception("Release booking failed")
+            await message.reply(f"Failed to book {parsed.response}: {e}")
+            return
+        if result.room is None:
+            await message.reply(f"Could not book {parsed.response} after {result.attempts} attempt(s): {result.error}")
+        else:
+            await message.reply(f"Booked {result.room.name} for {parsed.response}, {result.latency * 1000:.0f}ms after it opened") # type: ignore
+
+    task = asyncio.create_task(run())
+    detached_tasks.add(task)
+    task.add_done_callback(detached_tasks.discard)
+    await message.reply(f"{parsed.response} will be booked when it opens at {opening_time(date).strftime('%Y-%m-%d %H:%M')}")
+
+
+async def handle_chat_message(message: discord.Message, profile: UserProfile, content: str):
+    try:
+        await _handle_chat_message(message, profile, content)
+    except CircuitOpenError as e:
+        # Daisy or the model is failing, answered right away instead of after a timeout
+        await message.reply(str(e))
+
+
+def _store_turn(turn: Turn):
+    """Remembered right away so the thread can be walked, persisted on the IO lane"""
+    conversation_store.remember(turn)
+    _write_in_background("Storing a conversation turn", conversation_store.persist, turn)
+
+
+async def _handle_chat_message(message: discord.Message, profile: UserProfile, content: str):
+    daisy = session_pool.get(profile)
+    preferences = profile.preferences
+
+    parent_id = message.reference.message_id if message.reference is not None else None
+    _store_turn(Turn(message.id, parent_id, "user", content, []))
+
     async with message.channel.typing():
-        history = []
-        prev_message = message.reference
-        while prev_message is not None:
-            ref = prev_message.cached_message
-            if ref is None:
-                if prev_message.message_id is None:
-                    break
-                ref = await message.channel.fetch_message(prev_message.message_id)
-            if ref.author.id == client.user.id: # type: ignore
-                history.append(
-                    {
-                        "role": "assistant",
-                        "content": json.dumps({"conversations_response": ref.content, "requests": cache.get(ref.id, [])}),
-                    }
-                )
-            else:
-                history.append({"role": "user", "content": ref.content})
-            prev_message = ref.reference
-        history.reverse()
+        turns: List[Turn] = []
+        next_id = parent_id
+        while next_id is not None:
+            # Turns evicted from memory are read back from SQLite
+            known, next_id = await run_async(conversation_store.thread, next_id)
+            turns = known + turns
+            if next_id is None:
+                break
+            # Only messages from before the store (or evicted from it) have to be fetched from discord
+            ref = discord.utils.get(client.cached_messages, id=next_id) or await message.channel.fetch_message(next_id)
+            _store_turn(Turn(
+                ref.id,
+                ref.reference.message_id if ref.reference is not None else None,
+                "assistant" if ref.author.id == client.user.id else "user", # type: ignore
+                ref.content,
+                [],
+            ))
+        history = [turn.to_history() for turn in turns]
+
+        agent = await run_llm(_agent)
+
+        # Schedules are fetched as soon as the requests have been streamed, while the model is still writing its reply
+        loop = asyncio.get_running_loop()
+        schedules: Dict[Tuple[datetime.date, RoomCategory], "asyncio.Future[Schedule]"] = {}
+
+        def get_schedule(date: datetime.date, room_category: RoomCategory) -> "asyncio.Future[Schedule]":
+            key = (date, room_category)
+            if key not in schedules:
+                schedules[key] = asyncio.ensure_future(fetch_schedule(daisy, date, room_category))
+            return schedules[key]
+
+        def on_requests(raw_requests: List[Dict[str, Any]]):
+            for raw in raw_requests:
+                try:
+                    request = RoomRequest.from_json(raw)
+                except (KeyError, ValueError, TypeError):
+                    continue
+                loop.call_soon_threadsafe(get_schedule, request.date, request.room_category)
+
         try:
-            response = await run_async(handle_message_retries, history, message.content, staff=daisy.staff)
+            response = await run_llm(agent.resolve_message, history, content, staff=profile.staff, on_requests=on_requests)
         except (json.decoder.JSONDecodeError, ValueError):
             await message.reply("I'm sorry, I'm having trouble understanding you")
             return
         requests = []
         for request in response[2]:
-            schedule = await run_async(daisy.get_schedule_for_category, request.date, request.room_category)
-            requests.append((request, schedule_rooms(schedule, request.from_time, request.duration, request.breaks, request.room_restrictions)))
+            if request.title is None and preferences.default_title is not None:
+                request = attr.evolve(request, title=preferences.default_title)
+            if not request.room_restrictions and preferences.room_filters:
+                request = attr.evolve(request, room_restrictions=preferences.room_filters)
+            schedule = await get_schedule(request.date, request.room_category)
+            # Rooms that are usually free at these hours first, they are the least likely to be taken before the booking
+            order = await run_async(
+                occupancy_history.rank, preferences.preference_order() or ROOM_PREFERENCE_ORDER, request.date, request.from_time.value,
+                request.from_time.value + request.duration, request.room_category, pinned=len(preferences.preferred_rooms),
+            )
+            requests.append((request, await plan_slots(schedule, request.from_time, request.duration, request.breaks, request.room_restrictions, order)))
         view = None
         if requests:
-            view = Confirm(message.author, requests)
+            view = Confirm(message.author, daisy, requests, preferences.preference_order())
         sent = await message.reply(str(response[0]), view=view) # type: ignore
         if view is not None:
             await view.generate_and_set_embed(message=sent)
-        cache[sent.id] = response[1]
+            view.start_refreshing()
+        _store_turn(Turn(sent.id, message.id, "assistant", str(response[0]), response[1]))
         return
 
 
@@ -16,24 +16,32 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 import datetime
-from typing import List, Optional
+import logging
+import os
+from typing import Any, Callable, Dict, List, Optional
+from urllib.parse import urlsplit
 
 import requests
 
 
+import metrics
+from breaker import CircuitBreaker
 from login import daisy_login
 from parse import parse_booking_completion, parse_daisy_schedule
+from ratelimit import Priority, RateLimiter, parse_budgets
 from schemas import BookingSlot, Schedule, RoomCategory, Room, RoomTime
+from singleflight import SingleFlight
+from transport import ACCEPT_ENCODING, DAISY_BASE_URL, Transport
 
 STANDARD_HEADERS = {
     "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3;q=0.7",
-    "Accept-Encoding": "gzip, deflate, br, zstd",
+    "Accept-Encoding": ACCEPT_ENCODING,
     "Accept-Language": "en-GB,en;q=0.9,en-US;q=0.8,sv;q=0.7",
     "Cache-Control": "max-age=0",
     "Connection": "keep-alive",
-    "Host": "daisy.dsv.su.se",
-    "Origin": "https://daisy.dsv.su.se",
-    "Referer": "https://daisy.dsv.su.se/common/schema/bokning.jspa",
+    "Host": urlsplit(DAISY_BASE_URL).netloc,
+    "Origin": DAISY_BASE_URL,
+    "Referer": f"{DAISY_BASE_URL}/common/schema/bokning.jspa",
     "Sec-Fetch-Dest": "document",
     "Sec-Fetch-Mode": "navigate",
     "Sec-Fetch-Site": "same-origin",
@@ -46,9 +54,60 @@ STANDARD_HEADERS = {
     "X-Powered-By": "dsv-daisy-booker (https://github.com/Edwinexd/dsv-daisy-booker); Contact (edwin.sundberg@dsv.su.se)",
 }
 
+# Shared by all clients, they all talk to the same server
+DAISY_RATE_LIMITER = RateLimiter(
+    rate=float(os.getenv("DAISY_RATE_LIMIT", "5")),
+    burst=float(os.getenv("DAISY_RATE_BURST", "10")),
+    endpoint_budgets=parse_budgets(os.getenv("DAISY_ENDPOINT_RATE_LIMITS", "login=0.2:2,validate=1:3,schedule=3:6,booking=5:10")),
+)
+
+# (connect, read) seconds, without them a hanging Daisy holds an io worker forever
+DAISY_TIMEOUT = (float(os.getenv("DAISY_CONNECT_TIMEOUT", "3.05")), float(os.getenv("DAISY_READ_TIMEOUT", "15")))
+
+DAISY_TRANSPORT = Transport(
+    pool_size=int(os.getenv("DAISY_POOL_SIZE", "16")),
+    cache_size=int(os.getenv("DAISY_CONDITIONAL_CACHE_SIZE", "64")),
+)
+
+# Network errors, timeouts and 5xx responses count as failures, a rejected booking does not
+DAISY_BREAKER = CircuitBreaker(
+    "Daisy",
+    window=float(os.getenv("DAISY_BREAKER_WINDOW", "60")),
+    min_calls=int(os.getenv("DAISY_BREAKER_MIN_CALLS", "5")),
+    failure_ratio=float(os.getenv("DAISY_BREAKER_FAILURE_RATIO", "0.5")),
+    slow_call=float(os.getenv("DAISY_BREAKER_SLOW_CALL", "10")),
+    max_backoff=float(os.getenv("DAISY_BREAKER_MAX_BACKOFF", "300")),
+    is_failure=lambda e: isinstance(e, requests.RequestException),
+)
+
+# The Shibboleth login is several requests to Daisy and the IdP, a slow IdP is judged against a higher threshold and
+# does not open the circuit for every other Daisy request
+DAISY_LOGIN_BREAKER = CircuitBreaker(
+    "Daisy login",
+    window=DAISY_BREAKER.window,
+    min_calls=DAISY_BREAKER.min_calls,
+    failure_ratio=DAISY_BREAKER.failure_ratio,
+    slow_call=float(os.getenv("DAISY_LOGIN_BREAKER_SLOW_CALL", "60")),
+    max_backoff=DAISY_BREAKER.max_backoff,
+    is_failure=lambda e: isinstance(e, requests.RequestException),
+)
+
+# Called with the form payload of every successful booking
+BOOKING_OBSERVERS: List[Callable[[Dict[str, Any]], None]] = []
+
 class BookingError(Exception):
     pass
 
+def _request(method: str, url: str, endpoint: str, session: Optional[requests.Session] = None, **kwargs) -> requests.Response:
+    response = DAISY_TRANSPORT.request(method, url, endpoint, session, timeout=DAISY_TIMEOUT, **kwargs)
+    if response.status_code >= 500:
+        response.raise_for_status()
+    return response
+
+def _send(method: str, url: str, endpoint: str, session: Optional[requests.Session] = None, **kwargs) -> requests.Response:
+    """A request to Daisy through its circuit breaker, raises CircuitOpenError while Daisy is failing"""
+    return DAISY_BREAKER.call(_request, method, url, endpoint, session, **kwargs)
+
 class Daisy:
     def __init__(self, su_username: str, su_password: str, search_term: str, lagg_till_person_id: int, initial_jsessionid: Optional[str] = None, last_validated: Optional[datetime.datetime] = None, booking_user_added: bool = False, staff: bool = False, staff_jsessionid: Optional[str] = None, staff_last_validated: Optional[datetime.datetime] = None):
         self.__su_username: str = su_username
@@ -61,33 +120,54 @@ class Daisy:
         self.staff = staff
         self.staff_jsessionid = staff_jsessionid
         self.staff_last_validated = staff_last_validated
+        # Concurrent identical schedule fetches and (re-)logins share one in-flight request
+        self._flights = SingleFlight()
+
+    @staticmethod
+    def _recently_validated(last_validated: Optional[datetime.datetime]) -> bool:
+        now = datetime.datetime.now()
+        return last_validated is not None and now.date() == last_validated.date() and now.hour == last_validated.hour
+
+    def _ensure_valid_jsessionid(self, priority: Priority = Priority.INTERACTIVE):
+        if self.jsessionid is not None and self._recently_validated(self.last_validated):
+            return
+        self._flights.do("session", self._refresh_jsessionid, priority)
 
-    def _ensure_valid_jsessionid(self):
-        if self.jsessionid is not None and self.last_validated is not None and datetime.datetime.now().date == self.last_validated.date and self.last_validated.hour != datetime.datetime.now().hour:
+    def _refresh_jsessionid(self, priority: Priority):
+        if self.jsessionid is not None and self._recently_validated(self.last_validated):
             # Token does not need to be rechecked at the moment
             return
         
-        if self.jsessionid is not None and self._is_token_valid():
+        if self.jsessionid is not None and self._is_token_valid(priority):
             self.last_validated = datetime.datetime.now()
             return
         
-        self.jsessionid = daisy_login(self.__su_username, self.__su_password)
+        DAISY_RATE_LIMITER.acquire("login", priority)
+        with metrics.timed("daisy_login"):
+            self.jsessionid = DAISY_LOGIN_BREAKER.call(daisy_login, self.__su_username, self.__su_password, timeout=DAISY_TIMEOUT)
         self.booking_user_added = False
         self.last_validated = datetime.datetime.now()
 
-    def _ensure_valid_staff_jsessionid(self):
-        if self.staff_jsessionid is not None and self.staff_last_validated is not None and datetime.datetime.now().date == self.staff_last_validated.date and self.staff_last_validated.hour != datetime.datetime.now().hour:
+    def _ensure_valid_staff_jsessionid(self, priority: Priority = Priority.INTERACTIVE):
+        if self.staff_jsessionid is not None and self._recently_validated(self.staff_last_validated):
+            return
+        self._flights.do("staff_session", self._refresh_staff_jsessionid, priority)
+
+    def _refresh_staff_jsessionid(self, priority: Priority):
+        if self.staff_jsessionid is not None and self._recently_validated(self.staff_last_validated):
             # Token does not need to be rechecked at the moment
             return
         
-        if self.staff_jsessionid is not None and self._is_staff_token_valid():
+        if self.staff_jsessionid is not None and self._is_staff_token_valid(priority):
             self.staff_last_validated = datetime.datetime.now()
             return
 
         if not self.staff:
             raise ValueError("Staff token requested but staff is not enabled")
         
-        self.staff_jsessionid = daisy_login(self.__su_username, self.__su_password, staff=True)
+        DAISY_RATE_LIMITER.acquire("login", priority)
+        with metrics.timed("daisy_login"):
+            self.staff_jsessionid = DAISY_LOGIN_BREAKER.call(daisy_login, self.__su_username, self.__su_password, staff=True, timeout=DAISY_TIMEOUT)
         self.staff_last_validated = datetime.datetime.now()
 
     # Before request function wrapper
@@ -97,29 +177,33 @@ class Daisy:
             return func(self, *args, **kwargs)
         return wrapper
 
-    def _is_token_valid(self) -> bool:
-        url = "https://daisy.dsv.su.se/servlet/schema.LokalSchema"
+    def _is_token_valid(self, priority: Priority = Priority.INTERACTIVE) -> bool:
+        url = f"{DAISY_BASE_URL}/servlet/schema.LokalSchema"
         headers = {
             "Cookie": f"JSESSIONID={self.jsessionid};",
-            "Referer": "https://daisy.dsv.su.se/student/aktuellt.jspa"
+            "Referer": f"{DAISY_BASE_URL}/student/aktuellt.jspa"
         }
 
-        response = requests.get(url, headers=STANDARD_HEADERS | headers)
+        DAISY_RATE_LIMITER.acquire("validate", priority)
+        with metrics.timed("session_validate"):
+            response = _send("GET", url, "validate", headers=STANDARD_HEADERS | headers)
         return "Log in" not in response.text
 
-    def _is_staff_token_valid(self) -> bool:
-        url = "https://daisy.dsv.su.se/servlet/schema.LokalSchema"
+    def _is_staff_token_valid(self, priority: Priority = Priority.INTERACTIVE) -> bool:
+        url = f"{DAISY_BASE_URL}/servlet/schema.LokalSchema"
         headers = {
             "Cookie": f"JSESSIONID={self.staff_jsessionid};",
-            "Referer": "https://daisy.dsv.su.se/anstalld/aktuellt.jspa"
+            "Referer": f"{DAISY_BASE_URL}/anstalld/aktuellt.jspa"
         }
 
-        response = requests.get(url, headers=STANDARD_HEADERS | headers)
+        DAISY_RATE_LIMITER.acquire("validate", priority)
+        with metrics.timed("session_validate"):
+            response = _send("GET", url, "validate", headers=STANDARD_HEADERS | headers)
         return "Log in" not in response.text
 
-    def _add_booking_user(self, date: datetime.date):
-        self._ensure_valid_jsessionid()
-        url = "https://daisy.dsv.su.se/common/schema/bokning.jspa"
+    def _add_booking_user(self, date: datetime.date, priority: Priority = Priority.BOOKING):
+        self._ensure_valid_jsessionid(priority)
+        url = f"{DAISY_BASE_URL}/common/schema/bokning.jspa"
         headers = {
             "Content-Type": "application/x-www-form-urlencoded",
             "Cookie": f"JSESSIONID={self.jsessionid};"
@@ -138,14 +222,36 @@ class Daisy:
             "laggTillPersonID": self.lagg_till_person_id,
         }
         
-        response = requests.post(url, headers=STANDARD_HEADERS | headers, data=data)
+        DAISY_RATE_LIMITER.acquire("booking", priority)
+        response = _send("POST", url, "booking", headers=STANDARD_HEADERS | headers, data=data)
         return response
 
-    def _get_raw_schedule_for_category(self, date: datetime.date, room_category: RoomCategory):
+    def _add_booking_user_once(self, date: datetime.date, priority: Priority = Priority.BOOKING):
+        if not self.booking_user_added:
+            self._add_booking_user(date, priority)
+            self.booking_user_added = True
+
+    def ensure_session(self, staff: bool = False, priority: Priority = Priority.INTERACTIVE):
+        """Signs in (or revalidates the existing session) ahead of the first request that needs it"""
+        if staff:
+            self._ensure_valid_staff_jsessionid(priority)
+        else:
+            self._ensure_valid_jsessionid(priority)
+
+    def ensure_booking_user(self, date: datetime.date, priority: Priority = Priority.BOOKING):
+        """Bookable group rooms require a secondary participant to be added once per session"""
+        self._ensure_valid_jsessionid(priority)
+        if not self.booking_user_added:
+            self._flights.do("booking_user", self._add_booking_user_once, date, priority)
+
+    def get_raw_schedule_for_category(self, date: datetime.date, room_category: RoomCategory, priority: Priority = Priority.INTERACTIVE) -> str:
+        return self._flights.do(("schedule", date, room_category), self._fetch_raw_schedule_for_category, date, room_category, priority)
+
+    def _fetch_raw_schedule_for_category(self, date: datetime.date, room_category: RoomCategory, priority: Priority) -> str:
         if room_category == RoomCategory.BOOKABLE_GROUP_ROOMS:
-            self._ensure_valid_jsessionid()
+            self._ensure_valid_jsessionid(priority)
         else:
-            self._ensure_valid_staff_jsessionid()
+            self._ensure_valid_staff_jsessionid(priority)
         # https://daisy.dsv.su.se/servlet/schema.LokalSchema
         # url-en
         # lokalkategori: 68
@@ -153,7 +259,7 @@ class Daisy:
         # month: 04
         # day: 17
         # datumSubmit: Visa
-        url = "https://daisy.dsv.su.se/servlet/schema.LokalSchema"
+        url = f"{DAISY_BASE_URL}/servlet/schema.LokalSchema"
         headers = {
             "Content-Type": "application/x-www-form-urlencoded",
             "Cookie": f"JSESSIONID={self.jsessionid if room_category == RoomCategory.BOOKABLE_GROUP_ROOMS else self.staff_jsessionid};"
@@ -165,24 +271,14 @@ class Daisy:
             "day": f"{date.day:02d}",
             "datumSubmit": "Visa"
         }
-        response = requests.post(url, headers=STANDARD_HEADERS | headers, data=data)
+        DAISY_RATE_LIMITER.acquire("schedule", priority)
+        with metrics.timed("schedule_fetch"):
+            response = _send("POST", url, "schedule", conditional=True, headers=STANDARD_HEADERS | headers, data=data)
         return response.text
 
-    def create_booking(self, date: datetime.date, from_time: RoomTime, to_time: RoomTime, room_category: RoomCategory, room_id: int, name: str, description: Optional[str] = None):
-        if room_category == RoomCategory.BOOKABLE_GROUP_ROOMS:
-            self._ensure_valid_jsessionid()
-            # Bookable group rooms require a secondary participant to be added
-            if not self.booking_user_added:
-                self._add_booking_user(date)
-                self.booking_user_added = True
-        else:
-            self._ensure_valid_staff_jsessionid()
-        url = "https://daisy.dsv.su.se/common/schema/bokning.jspa"
-        headers = {
-            "Content-Type": "application/x-www-form-urlencoded",
-            "Cookie": f"JSESSIONID={self.jsessionid if room_category == RoomCategory.BOOKABLE_GROUP_ROOMS else self.staff_jsessionid};"
-        }
-        data = {
+    def booking_payload(self, date: datetime.date, from_time: RoomTime, to_time: RoomTime, room_category: RoomCategory, room_id: int, name: str, description: Optional[str] = None) -> Dict[str, Any]:
+        """Form data for a booking, can be built ahead of time and submitted later with submit_booking"""
+        return {
             "year": date.year,
             "month": f"{date.month:02d}",
             "day": f"{date.day:02d}",
@@ -196,25 +292,58 @@ class Daisy:
             "laggTillPersonID": "",
             "bokning": ""
         }
-        response = requests.post(url, headers=STANDARD_HEADERS | headers, data=data)
-        error = parse_booking_completion(response.text)
-        if error is not None:
-            raise BookingError(error)
+
+    def submit_booking(self, room_category: RoomCategory, payload: Dict[str, Any], session: Optional[requests.Session] = None) -> requests.Response:
+        """
+        POSTs a prebuilt booking payload, the session (and booking user) must already be valid
+
+        Passing a requests.Session reuses its (already open) connection.
+        """
+        url = f"{DAISY_BASE_URL}/common/schema/bokning.jspa"
+        headers = {
+            "Content-Type": "application/x-www-form-urlencoded",
+            "Cookie": f"JSESSIONID={self.jsessionid if room_category == RoomCategory.BOOKABLE_GROUP_ROOMS else self.staff_jsessionid};"
+        }
+        DAISY_RATE_LIMITER.acquire("booking", Priority.BOOKING)
+        with metrics.timed("create_booking"):
+            response = _send("POST", url, "booking", session, headers=STANDARD_HEADERS | headers, data=payload)
+            error = parse_booking_completion(response.text)
+            if error is not None:
+                raise BookingError(error)
+        for observer in BOOKING_OBSERVERS:
+            try:
+                observer(payload)
+            except Exception: # pylint: disable=broad-except
+                logging.exception("Booking observer failed")
         return response
 
+    def create_booking(self, date: datetime.date, from_time: RoomTime, to_time: RoomTime, room_category: RoomCategory, room_id: int, name: str, description: Optional[str] = None):
+        if room_category == RoomCategory.BOOKABLE_GROUP_ROOMS:
+            self.ensure_booking_user(date)
+        else:
+            self._ensure_valid_staff_jsessionid(Priority.BOOKING)
+        return self.submit_booking(room_category, self.booking_payload(date, from_time, to_time, room_category, room_id, name, description))
+
+    def prepare_slots(self, room_category: RoomCategory, times: List[BookingSlot], date: datetime.date, title: str) -> List[Dict[str, Any]]:
+        """Booking payloads for each slot, submitted later by book_prepared"""
+        description = f"Booked via dsv-daisy-booker (https://github.com/Edwinexd/dsv-daisy-booker) at {datetime.datetime.now().isoformat()}"
+        return [
+            self.booking_payload(date, entry.from_time, entry.to_time, room_category, entry.room.value, title, description)
+            for entry in times
+        ]
+
+    def book_prepared(self, room_category: RoomCategory, date: datetime.date, payloads: List[Dict[str, Any]]):
+        # Free when the session was validated (and the booking user added) within the hour
+        if room_category == RoomCategory.BOOKABLE_GROUP_ROOMS:
+            self.ensure_booking_user(date)
+        else:
+            self._ensure_valid_staff_jsessionid(Priority.BOOKING)
+        for payload in payloads:
+            self.submit_booking(room_category, payload)
+
     def book_slots(self, room_category: RoomCategory, times: List[BookingSlot], date: datetime.date, title: str):
-        for entry in times:
-            # Book each room
-            self.create_booking(
-                date=date,
-                from_time=entry.from_time,
-                to_time=entry.to_time,
-                room_category=room_category,
-                room_id=entry.room.value,
-                name=title,
-                description=f"Booked via dsv-daisy-booker (https://github.com/Edwinexd/dsv-daisy-booker) at {datetime.datetime.now().isoformat()}"
-            )
-
-    def get_schedule_for_category(self, date: datetime.date, room_category: RoomCategory) -> Schedule:
-        raw = self._get_raw_schedule_for_category(date, room_category)
+        self.book_prepared(room_category, date, self.prepare_slots(room_category, times, date, title))
+
+    def get_schedule_for_category(self, date: datetime.date, room_category: RoomCategory, priority: Priority = Priority.INTERACTIVE) -> Schedule:
+        raw = self.get_raw_schedule_for_category(date, room_category, priority)
         return parse_daisy_schedule(raw)
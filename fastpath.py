@@ -0,0 +1,142 @@
+"""
+A discord bot capable of booking student group rooms and staff rooms via Daisy (administration tool for Department of Computer and Systems Sciences at Stockholm University)
+Copyright (C) 2024 Edwin Sundberg
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import datetime
+import re
+from typing import Any, Dict, List, Optional
+
+import attr
+import pytz
+
+from schemas import RoomRestriction
+
+WEEKDAYS = ["monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday"]
+
+# Same window as the calendar given to the LLM
+BOOKABLE_DAYS = 15
+
+FILTER_WORDS = {
+    "g10": RoomRestriction.G10_ROOM,
+    "g5": RoomRestriction.G5_ROOM,
+    "green": RoomRestriction.GREEN_AREA,
+    "red": RoomRestriction.RED_AREA,
+}
+
+# Words that carry no meaning for the request, anything else makes the message ambiguous
+FILLER_WORDS = {
+    "a", "an", "the", "book", "booking", "reserve", "room", "rooms", "group", "grouproom", "area", "please", "pls",
+    "on", "at", "in", "for", "from", "me", "us", "i", "we", "need", "want", "would", "like", "to", "can", "you",
+    "hi", "hey", "hello", "thanks", "h", "hours", "o'clock",
+}
+
+TITLE_PATTERN = re.compile(r"\"([^\"]+)\"|(?<!\w)'([^']+)'(?!\w)")
+HOURS_PATTERN = re.compile(r"\b(\d{1,2})(?::00)?\s*-\s*(\d{1,2})(?::00)?\b")
+DATE_PATTERN = re.compile(r"\b(\d{4})-(\d{1,2})-(\d{1,2})\b")
+WORD_PATTERN = re.compile(r"[\w':]+")
+
+
+@attr.s(auto_attribs=True, frozen=True, slots=True)
+class FastPathResult:
+    response: str
+    requests: List[Dict[str, Any]]
+
+
+def _resolve_day(word: str, today: datetime.date) -> Optional[datetime.date]:
+    if word == "today":
+        return today
+    if word == "tomorrow":
+        return today + datetime.timedelta(days=1)
+    if word in WEEKDAYS:
+        return today + datetime.timedelta(days=(WEEKDAYS.index(word) - today.weekday()) % 7)
+    return None
+
+
+def parse_message(message: str, now: Optional[datetime.datetime] = None, has_history: bool = False, bookable_days: int = BOOKABLE_DAYS) -> Optional[FastPathResult]:
+    """
+    Rule-based parser for the common "<day> XX-YY [G10/G5/green/red] ["title"]" requests
+
+    Args:
+        message: The user message
+        now: Current time, defaults to now in Europe/Stockholm
+        has_history: Whether the message is a reply, replies without an explicit date are left to the LLM
+        bookable_days: Dates this many days ahead or more are rejected
+
+    Returns:
+        FastPathResult with requests in the same format as the LLM produces, None if the message is ambiguous
+    """
+    now = now or datetime.datetime.now(pytz.timezone("Europe/Stockholm"))
+    today = now.date()
+
+    title: Optional[str] = None
+    titles = TITLE_PATTERN.findall(message)
+    if len(titles) > 1:
+        return None
+    if titles:
+        title = (titles[0][0] or titles[0][1]).strip() or None
+    rest = TITLE_PATTERN.sub(" ", message).lower()
+
+    # Dates first, "2024-05-02" would otherwise be read as the hours 05-02
+    dates: List[datetime.date] = []
+    for match in DATE_PATTERN.findall(rest):
+        try:
+            dates.append(datetime.date(int(match[0]), int(match[1]), int(match[2])))
+        except ValueError:
+            return None
+    rest = DATE_PATTERN.sub(" ", rest)
+
+    hours = HOURS_PATTERN.findall(rest)
+    if len(hours) != 1:
+        return None
+    from_time, to_time = int(hours[0][0]), int(hours[0][1])
+    if not 4 <= from_time < to_time <= 23 or to_time - from_time > 4:
+        return None
+    rest = HOURS_PATTERN.sub(" ", rest)
+
+    filters: List[RoomRestriction] = []
+    for word in WORD_PATTERN.findall(rest):
+        day = _resolve_day(word, today)
+        if day is not None:
+            dates.append(day)
+        elif word in FILTER_WORDS:
+            if FILTER_WORDS[word] not in filters:
+                filters.append(FILTER_WORDS[word])
+        elif word not in FILLER_WORDS:
+            return None
+
+    if len(dates) > 1 or (not dates and has_history):
+        return None
+    date = dates[0] if dates else today
+
+    if not 0 <= (date - today).days < bookable_days or date.weekday() >= 5:
+        return None
+    if date == today and from_time <= now.hour:
+        return None
+    if {RoomRestriction.G10_ROOM, RoomRestriction.G5_ROOM} <= set(filters) or {RoomRestriction.GREEN_AREA, RoomRestriction.RED_AREA} <= set(filters):
+        return None
+
+    request: Dict[str, Any] = {
+        "date": date.strftime("%Y-%m-%d"),
+        "from_time": from_time,
+        "duration": to_time - from_time,
+    }
+    if title is not None:
+        request["title"] = title
+    if filters:
+        request["room_filters"] = [f.value for f in filters]
+
+    response = f"{title if title is not None else 'Room'} on {date.strftime('%A')} {date.isoformat()}, {from_time:02}:00-{to_time:02}:00"
+    return FastPathResult(response, [request])
@@ -0,0 +1,198 @@
+"""
+A discord bot capable of booking student group rooms and staff rooms via Daisy (administration tool for Department of Computer and Systems Sciences at Stockholm University)
+Copyright (C) 2024 Edwin Sundberg
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import datetime
+import hashlib
+import threading
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from schemas import Room, RoomCategory, Schedule
+
+BOOKINGS = "bookings"
+FREE = "free"
+
+# Free blocks are only listed within these hours
+DAY_START = 8
+DAY_END = 21
+
+# Events use TZID=Europe/Stockholm, strict clients need its definition in the calendar (EU rules since 1996)
+VTIMEZONE = (
+    "BEGIN:VTIMEZONE\r\n"
+    "TZID:Europe/Stockholm\r\n"
+    "BEGIN:DAYLIGHT\r\n"
+    "TZOFFSETFROM:+0100\r\n"
+    "TZOFFSETTO:+0200\r\n"
+    "TZNAME:CEST\r\n"
+    "DTSTART:19700329T020000\r\n"
+    "RRULE:FREQ=YEARLY;BYMONTH=3;BYDAY=-1SU\r\n"
+    "END:DAYLIGHT\r\n"
+    "BEGIN:STANDARD\r\n"
+    "TZOFFSETFROM:+0200\r\n"
+    "TZOFFSETTO:+0100\r\n"
+    "TZNAME:CET\r\n"
+    "DTSTART:19701025T030000\r\n"
+    "RRULE:FREQ=YEARLY;BYMONTH=10;BYDAY=-1SU\r\n"
+    "END:STANDARD\r\n"
+    "END:VTIMEZONE\r\n"
+)
+
+# (room, from hour, to hour, title)
+Booking = Tuple[Room, int, int, str]
+
+
+def _escape(text: str) -> str:
+    return text.replace("\\", "\\\\").replace(";", "\\;").replace(",", "\\,").replace("\n", "\\n")
+
+
+def _event(uid: str, date: datetime.date, from_hour: int, to_hour: int, summary: str, location: str, stamp: str) -> str:
+    day = date.strftime("%Y%m%d")
+    return (
+        "BEGIN:VEVENT\r\n"
+        f"UID:{uid}@dsv-daisy-booker\r\n"
+        f"DTSTAMP:{stamp}\r\n"
+        f"DTSTART;TZID=Europe/Stockholm:{day}T{from_hour:02}0000\r\n"
+        f"DTEND;TZID=Europe/Stockholm:{day}T{to_hour:02}0000\r\n"
+        f"SUMMARY:{_escape(summary)}\r\n"
+        f"LOCATION:{_escape(location)}\r\n"
+        "END:VEVENT\r\n"
+    )
+
+
+def _busy_hours(schedule: Schedule) -> Dict[Room, Set[int]]:
+    busy: Dict[Room, Set[int]] = {}
+    for name, activities in schedule.activities.items():
+        hours = busy.setdefault(Room.from_name(name), set())
+        for activity in activities:
+            hours.update(range(activity.time_slot_start.value, activity.time_slot_end.value))
+    return busy
+
+
+class CalendarFeeds:
+    """
+    ICS feeds of our bookings and of free blocks per room, built from schedules and bookings the bot already saw
+
+    Only the days whose schedules or bookings changed are re-rendered, a feed is re-assembled from the rendered days
+    when any of them changed, and its ETag changes only then.
+    """
+    def __init__(self, keep_days: int = 30):
+        self.keep_days = keep_days
+        self._lock = threading.Lock()
+        self._schedules: Dict[Tuple[datetime.date, RoomCategory], Schedule] = {}
+        self._fingerprints: Dict[Tuple[datetime.date, RoomCategory], int] = {}
+        self._bookings: Dict[datetime.date, Set[Booking]] = {}
+        self._dirty: Set[datetime.date] = set()
+        # feed -> date -> rendered events of that day
+        self._days: Dict[str, Dict[datetime.date, str]] = {BOOKINGS: {}, FREE: {}}
+        # feed -> (body, etag)
+        self._rendered: Dict[str, Tuple[bytes, str]] = {}
+        self.day_renders = 0
+
+    def observe_schedule(self, schedule: Schedule):
+        key = (schedule.datetime.date(), schedule.room_category)
+        fingerprint = hash(repr(sorted(
+            (name, [(a.time_slot_start.value, a.time_slot_end.value, a.event) for a in activities])
+            for name, activities in schedule.activities.items()
+        )))
+        with self._lock:
+            self._schedules[key] = schedule
+            if self._fingerprints.get(key) != fingerprint:
+                self._fingerprints[key] = fingerprint
+                self._dirty.add(key[0])
+
+    def observe_booking(self, payload: Dict[str, Any]):
+        """Records a successful booking from its Daisy form payload"""
+        date = datetime.date(int(payload["year"]), int(payload["month"]), int(payload["day"]))
+        booking = (Room(int(payload["lokalID"])), int(payload["from"][:2]), int(payload["to"][:2]), str(payload["namn"]))
+        with self._lock:
+            self._bookings.setdefault(date, set()).add(booking)
+            self._dirty.add(date)
+
+    def _render_bookings(self, date: datetime.date, stamp: str) -> str:
+        """
+        Only the bookings recorded through observe_booking
+
+        Schedule entries are not matched by title, other people book rooms under the same titles ("Meeting"). An entry
+        with our room, hours and title is the recorded booking itself, listed hour by hour, so it adds nothing.
+        """
+        unique = {(room, from_hour, to_hour): title for room, from_hour, to_hour, title in sorted(self._bookings.get(date, set()), key=lambda b: (b[0].name, b[1], b[2], b[3]))}
+        return "".join(
+            _event(f"booking-{date.isoformat()}-{room.name}-{from_hour}", date, from_hour, to_hour, title, room.name, stamp)
+            for (room, from_hour, to_hour), title in sorted(unique.items(), key=lambda item: (item[0][1], item[0][0].name))
+        )
+
+    def _render_free(self, date: datetime.date, stamp: str) -> str:
+        events: List[str] = []
+        for (day, _), schedule in sorted(self._schedules.items(), key=lambda item: item[0][1].value):
+            if day != date:
+                continue
+            for room, busy in sorted(_busy_hours(schedule).items(), key=lambda item: item[0].name):
+                start: Optional[int] = None
+                for hour in range(DAY_START, DAY_END + 1):
+                    free = hour < DAY_END and hour not in busy
+                    if free and start is None:
+                        start = hour
+                    elif not free and start is not None:
+                        events.append(_event(f"free-{date.isoformat()}-{room.name}-{start}", date, start, hour, f"Free: {room.name}", room.name, stamp))
+                        start = None
+        return "".join(events)
+
+    def _refresh(self, today: datetime.date):
+        cutoff = today - datetime.timedelta(days=self.keep_days)
+        for key in [key for key in self._schedules if key[0] < cutoff]:
+            del self._schedules[key]
+            del self._fingerprints[key]
+        for date in [date for date in self._bookings if date < cutoff]:
+            del self._bookings[date]
+        changed = set()
+        for days in self._days.values():
+            for date in [date for date in days if date < cutoff]:
+                del days[date]
+                changed.update(self._days)
+
+        stamp = datetime.datetime.now(datetime.timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+        for date in self._dirty:
+            if date < cutoff:
+                continue
+            for feed, render in ((BOOKINGS, self._render_bookings), (FREE, self._render_free)):
+                events = render(date, stamp)
+                self.day_renders += 1
+                # Compared without DTSTAMP so an unchanged day keeps its ETag
+                if _strip_stamp(events) != _strip_stamp(self._days[feed].get(date, "")):
+                    self._days[feed][date] = events
+                    changed.add(feed)
+        self._dirty.clear()
+        for feed in changed:
+            self._rendered.pop(feed, None)
+
+    def render(self, feed: str, today: Optional[datetime.date] = None) -> Tuple[bytes, str]:
+        """The feed body and its ETag"""
+        with self._lock:
+            self._refresh(today or datetime.date.today())
+            if feed not in self._rendered:
+                body = (
+                    "BEGIN:VCALENDAR\r\nVERSION:2.0\r\nPRODID:-//dsv-daisy-booker//EN\r\nCALSCALE:GREGORIAN\r\n"
+                    f"X-WR-CALNAME:Daisy {'bookings' if feed == BOOKINGS else 'free rooms'}\r\n"
+                    + VTIMEZONE
+                    + "".join(events for _, events in sorted(self._days[feed].items()))
+                    + "END:VCALENDAR\r\n"
+                ).encode("utf-8")
+                self._rendered[feed] = (body, f'"{hashlib.sha256(body).hexdigest()[:32]}"')
+            return self._rendered[feed]
+
+
+def _strip_stamp(events: str) -> str:
+    return "".join(line for line in events.splitlines(keepends=True) if not line.startswith("DTSTAMP:"))
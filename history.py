@@ -0,0 +1,182 @@
+"""
+A discord bot capable of booking student group rooms and staff rooms via Daisy (administration tool for Department of Computer and Systems Sciences at Stockholm University)
+Copyright (C) 2024 Edwin Sundberg
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import datetime
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+import attr
+
+from schemas import Room, RoomCategory, RoomRestriction, Schedule
+
+
+def hours_mask(from_hour: int, to_hour: int) -> int:
+    """Bit i set for every hour i in [from_hour, to_hour)"""
+    return ((1 << to_hour) - 1) ^ ((1 << from_hour) - 1)
+
+
+@attr.s(auto_attribs=True, frozen=True, slots=True)
+class RoomAvailability:
+    room: Room
+    # Dates observed for this weekday
+    samples: int
+    # Share of those dates the hours were free
+    free_ratio: float
+
+
+class OccupancyHistory:
+    """
+    Every observed schedule as one row per room, the busy hours packed into a bitmask
+
+    A row is only written when a room's occupancy for a date changed since it was last seen, rows for dates older than
+    `retention_days` are deleted.
+    """
+    def __init__(self, path: str, retention_days: int = 180):
+        self.retention_days = retention_days
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS occupancy ("
+            "date TEXT NOT NULL, weekday INTEGER NOT NULL, category INTEGER NOT NULL, room TEXT NOT NULL, "
+            "observed_at REAL NOT NULL, busy INTEGER NOT NULL)"
+        )
+        # Latest snapshot of a room on a date, and the weekday/room and date range queries
+        self._db.execute("CREATE INDEX IF NOT EXISTS occupancy_snapshot ON occupancy (date, category, room, observed_at)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS occupancy_weekday ON occupancy (weekday, category, room, date)")
+        self._db.commit()
+        # (date, category, room) -> last written mask
+        self._last: Dict[Tuple[str, int, str], int] = {
+            (row[0], row[1], row[2]): row[3] for row in self._db.execute(
+                "SELECT date, category, room, busy FROM occupancy o WHERE observed_at = "
+                "(SELECT MAX(observed_at) FROM occupancy WHERE date = o.date AND category = o.category AND room = o.room)"
+            )
+        }
+        self._pruned_at = 0.0
+        self.rows_written = 0
+        # category -> (computed at, contention), contention scans the whole history
+        self._contention: Dict[RoomCategory, Tuple[float, Dict[Tuple[int, int], float]]] = {}
+
+    def record(self, schedule: Schedule):
+        date = schedule.datetime.date()
+        now = time.time()
+        rows = []
+        with self._lock:
+            for name, activities in schedule.activities.items():
+                busy = 0
+                for activity in activities:
+                    busy |= hours_mask(activity.time_slot_start.value, activity.time_slot_end.value)
+                key = (date.isoformat(), schedule.room_category.value, Room.from_name(name).name)
+                if self._last.get(key) != busy:
+                    self._last[key] = busy
+                    rows.append((key[0], date.weekday(), key[1], key[2], now, busy))
+            if rows:
+                self._db.executemany("INSERT INTO occupancy (date, weekday, category, room, observed_at, busy) VALUES (?, ?, ?, ?, ?, ?)", rows)
+                self._db.commit()
+                self.rows_written += len(rows)
+            if now - self._pruned_at > 3600:
+                self._prune(datetime.date.today())
+                self._pruned_at = now
+
+    def _prune(self, today: datetime.date):
+        cutoff = (today - datetime.timedelta(days=self.retention_days)).isoformat()
+        self._db.execute("DELETE FROM occupancy WHERE date < ?", (cutoff,))
+        self._db.commit()
+        for key in [key for key in self._last if key[0] < cutoff]:
+            del self._last[key]
+
+    def usually_free(self, weekday: int, from_hour: int, to_hour: int, category: RoomCategory = RoomCategory.BOOKABLE_GROUP_ROOMS, room_restrictions: Optional[List[RoomRestriction]] = None, since: Optional[datetime.date] = None) -> List[RoomAvailability]:
+        """
+        How often each room was free during the hours on past dates falling on `weekday`, most often free first
+
+        The last snapshot taken of a date counts, that is the closest to what was actually booked.
+        """
+        since = since or datetime.date.today() - datetime.timedelta(days=self.retention_days)
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT room, busy FROM occupancy o WHERE weekday = ? AND category = ? AND date >= ? AND date < ? AND observed_at = "
+                "(SELECT MAX(observed_at) FROM occupancy WHERE date = o.date AND category = o.category AND room = o.room)",
+                (weekday, category.value, since.isoformat(), datetime.date.today().isoformat()),
+            ).fetchall()
+        mask = hours_mask(from_hour, to_hour)
+        counts: Dict[str, List[int]] = {}
+        for room, busy in rows:
+            count = counts.setdefault(room, [0, 0])
+            count[0] += 1
+            count[1] += not busy & mask
+        result = []
+        for name, (samples, free) in counts.items():
+            room = Room[name]
+            if room_restrictions and not all(restriction.to_filter()(room) for restriction in room_restrictions):
+                continue
+            result.append(RoomAvailability(room, samples, free / samples))
+        return sorted(result, key=lambda availability: (-availability.free_ratio, -availability.samples, availability.room.name))
+
+    def rank(self, order: List[Room], date: datetime.date, from_hour: int, to_hour: int, category: RoomCategory, pinned: int = 0, min_samples: int = 3) -> List[Room]:
+        """
+        `order` with the rooms that have history re-ranked by how often they were free at these hours on the same weekday
+
+        The first `pinned` rooms (a user's preferred rooms) keep their places, as do rooms with fewer than `min_samples`
+        observations. Only the remaining rooms swap places among themselves.
+        """
+        ratios = {
+            availability.room: availability.free_ratio
+            for availability in self.usually_free(date.weekday(), from_hour, to_hour, category)
+            if availability.samples >= min_samples
+        }
+        positions = [i for i, room in enumerate(order) if i >= pinned and room in ratios]
+        # Stable, so equally free rooms keep the preference order
+        ranked = sorted((order[i] for i in positions), key=lambda room: -ratios[room])
+        result = list(order)
+        for i, room in zip(positions, ranked):
+            result[i] = room
+        return result
+
+    def contention(self, category: RoomCategory = RoomCategory.BOOKABLE_GROUP_ROOMS, since: Optional[datetime.date] = None) -> Dict[Tuple[int, int], float]:
+        """
+        (weekday, hour) -> share of rooms busy, the slots where prefetching and polling pay off the most
+        """
+        since = since or datetime.date.today() - datetime.timedelta(days=self.retention_days)
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT weekday, busy FROM occupancy o WHERE category = ? AND date >= ? AND observed_at = "
+                "(SELECT MAX(observed_at) FROM occupancy WHERE date = o.date AND category = o.category AND room = o.room)",
+                (category.value, since.isoformat()),
+            ).fetchall()
+        totals: Dict[Tuple[int, int], List[int]] = {}
+        for weekday, busy in rows:
+            for hour in range(24):
+                total = totals.setdefault((weekday, hour), [0, 0])
+                total[0] += 1
+                total[1] += bool(busy & (1 << hour))
+        return {key: busy / count for key, (count, busy) in totals.items() if count}
+
+    def busiest(self, date: datetime.date, from_hour: int, to_hour: int, category: RoomCategory, max_age: float = 3600) -> float:
+        """
+        Highest share of rooms usually busy during the hours on the same weekday, 0 without history
+
+        Based on contention, recomputed at most every `max_age` seconds.
+        """
+        now = time.time()
+        computed_at, contention = self._contention.get(category, (0.0, {}))
+        if now - computed_at > max_age:
+            contention = self.contention(category)
+            self._contention[category] = (now, contention)
+        return max((contention.get((date.weekday(), hour), 0.0) for hour in range(from_hour, to_hour)), default=0.0)
@@ -0,0 +1,173 @@
+"""
+A discord bot capable of booking student group rooms and staff rooms via Daisy (administration tool for Department of Computer and Systems Sciences at Stockholm University)
+Copyright (C) 2024 Edwin Sundberg
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import json
+import threading
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class JSONStreamScanner:
+    """
+    Incrementally scans a JSON object as it is streamed and reports each top-level field once its value is complete
+
+    Anything before the first "{" (models like to prepend prose) is ignored.
+    """
+    def __init__(self, on_field: Callable[[str, Any], None]):
+        self.on_field = on_field
+        self.text = ""
+        self._index = 0
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._string_start = 0
+        self._key: Optional[str] = None
+        self._awaiting_value = False
+        self._value_start: Optional[int] = None
+        self._done = False
+
+    def _emit(self, end: int):
+        key, start = self._key, self._value_start
+        self._key = None
+        self._value_start = None
+        if key is None or start is None:
+            return
+        try:
+            value = json.loads(self.text[start:end])
+        except json.JSONDecodeError:
+            # Leave it to the full parse to deal with
+            return
+        self.on_field(key, value)
+
+    def feed(self, chunk: str):
+        self.text += chunk
+        while self._index < len(self.text) and not self._done:
+            i = self._index
+            char = self.text[i]
+            self._index += 1
+
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif char == "\\":
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+                    if self._depth == 1 and self._value_start is None:
+                        try:
+                            self._key = json.loads(self.text[self._string_start:i + 1])
+                        except json.JSONDecodeError:
+                            self._key = None
+                    elif self._depth == 1:
+                        self._emit(i + 1)
+                continue
+
+            if self._depth == 0:
+                if char == "{":
+                    self._depth = 1
+                continue
+
+            if self._depth == 1 and self._awaiting_value and not char.isspace():
+                self._awaiting_value = False
+                self._value_start = i
+
+            if char == '"':
+                self._in_string = True
+                self._string_start = i
+            elif char == ":" and self._depth == 1:
+                self._awaiting_value = True
+            elif char in "[{":
+                self._depth += 1
+            elif char in "]}":
+                self._depth -= 1
+                if self._depth == 1:
+                    self._emit(i + 1)
+                elif self._depth == 0:
+                    self._emit(i)
+                    self._done = True
+            elif char == "," and self._depth == 1:
+                self._emit(i)
+
+    @property
+    def done(self) -> bool:
+        return self._done
+
+
+class LLMClient:
+    """Chat completion client with a pooled keep-alive session and support for streamed responses"""
+    def __init__(self, base_url: str, token: str, pool_size: int = 4, timeout: float = 180):
+        self.base_url = base_url
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers["Authorization"] = f"Bearer {token}"
+
+    def complete(self, model: str, messages: List[Dict[str, str]]) -> Dict[str, Any]:
+        response = self.session.post(
+            f"{self.base_url}{model}",
+            json={"messages": messages},
+            timeout=self.timeout,
+        )
+        response.raise_for_status()
+        return response.json()
+
+    def stream(self, model: str, messages: List[Dict[str, str]], cancelled: Optional[threading.Event] = None) -> Iterator[str]:
+        """Yields response tokens as they arrive (server-sent events), stops early and drops the connection once `cancelled` is set"""
+        with self.session.post(
+            f"{self.base_url}{model}",
+            json={"messages": messages, "stream": True},
+            timeout=self.timeout,
+            stream=True,
+        ) as response:
+            response.raise_for_status()
+            for line in response.iter_lines(decode_unicode=True):
+                if cancelled is not None and cancelled.is_set():
+                    return
+                if not line or not line.startswith("data:"):
+                    continue
+                data = line[len("data:"):].strip()
+                if data == "[DONE]":
+                    return
+                try:
+                    event = json.loads(data)
+                except json.JSONDecodeError:
+                    continue
+                token = event.get("response")
+                if token:
+                    yield token
+
+    def stream_completion(self, model: str, messages: List[Dict[str, str]], on_field: Optional[Callable[[str, Any], None]] = None, cancelled: Optional[threading.Event] = None) -> Dict[str, Any]:
+        """
+        Streams a completion while scanning it for top-level JSON fields
+
+        Args:
+            model: Model to use
+            messages: Chat context
+            on_field: Called from the calling thread as soon as a top-level field of the response object is complete
+            cancelled: Stops the stream early, the partial response is returned
+
+        Returns:
+            The completion in the same shape as `complete`
+        """
+        scanner = JSONStreamScanner(on_field if on_field is not None else lambda key, value: None)
+        for token in self.stream(model, messages, cancelled):
+            scanner.feed(token)
+        return {"result": {"response": scanner.text}, "success": True}
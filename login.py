@@ -15,12 +15,15 @@ GNU General Public License for more details.
 You should have received a copy of the GNU General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
+from typing import Optional, Tuple, Union
+
 import requests
-from bs4 import BeautifulSoup
 import dotenv, os
 
+from transport import ACCEPT_ENCODING, DAISY_BASE_URL, IDP_BASE_URL, instrument
+
 
-def daisy_login(su_username: str, su_password: str, staff: bool = False) -> str:
+def daisy_login(su_username: str, su_password: str, staff: bool = False, timeout: Optional[Union[float, Tuple[float, float]]] = None) -> str:
     """
     Signs in to Daisy via SU login flow and returns the JSESSIONID cookie value
 
@@ -30,13 +33,17 @@ def daisy_login(su_username: str, su_password: str, staff: bool = False) -> str:
         su_username: SU username
         su_password: SU password
         staff: Whether to sign in as staff. Defaults to False.
+        timeout: Timeout passed to every request of the flow. Defaults to None (wait forever).
     """
+    # Imported on first use, bs4 is slow to import and only needed once we actually sign in
+    from bs4 import BeautifulSoup # pylint: disable=import-outside-toplevel
+
     # Start a session to keep cookies
     session = requests.Session()
 
     headers = {
         "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3;q=0.7",
-        "Accept-Encoding": "gzip, deflate, br, zstd",
+        "Accept-Encoding": ACCEPT_ENCODING,
         "Accept-Language": "en-GB,en;q=0.9,en-US;q=0.8,sv;q=0.7",
         "Cache-Control": "max-age=0",
         "Connection": "keep-alive",
@@ -56,14 +63,16 @@ def daisy_login(su_username: str, su_password: str, staff: bool = False) -> str:
     }
     for key, value in headers.items():
         session.headers[key] = value
+    instrument(session, "login")
 
     # 1. Get the initial session cookie by visiting the main page
-    session.get("https://daisy.dsv.su.se/index.jspa")
+    session.get(f"{DAISY_BASE_URL}/index.jspa", timeout=timeout)
     # 2. Navigate to the login URL which may be needed to retrieve further login form details
     login_response = session.get(
-        "https://daisy.dsv.su.se/Shibboleth.sso/Login?entityID=https://idp.it.su.se/idp/shibboleth&target=https://daisy.dsv.su.se/login_sso_student.jspa"
+        f"{DAISY_BASE_URL}/Shibboleth.sso/Login?entityID={IDP_BASE_URL}/idp/shibboleth&target={DAISY_BASE_URL}/login_sso_student.jspa"
         if not staff
-        else "https://daisy.dsv.su.se/Shibboleth.sso/Login?entityID=https://idp.it.su.se/idp/shibboleth&target=https://daisy.dsv.su.se/login_sso_employee.jspa"
+        else f"{DAISY_BASE_URL}/Shibboleth.sso/Login?entityID={IDP_BASE_URL}/idp/shibboleth&target={DAISY_BASE_URL}/login_sso_employee.jspa",
+        timeout=timeout,
     )
 
     # find form
@@ -87,7 +96,7 @@ def daisy_login(su_username: str, su_password: str, staff: bool = False) -> str:
 
     # Submit the midstep form manually (this mimics JavaScript auto-submit)
     intermediate_response = session.post(
-        "https://idp.it.su.se" + action_url, data=form_data
+        IDP_BASE_URL + action_url, data=form_data, timeout=timeout
     )
 
     soup = BeautifulSoup(intermediate_response.text, "html.parser")
@@ -112,7 +121,7 @@ def daisy_login(su_username: str, su_password: str, staff: bool = False) -> str:
     # 3. Submit the login form
     action_url = form["action"]
     post_response = session.post(
-        "https://idp.it.su.se" + action_url, data=form_data
+        IDP_BASE_URL + action_url, data=form_data, timeout=timeout
     )
 
     assert post_response.ok
@@ -135,9 +144,10 @@ def daisy_login(su_username: str, su_password: str, staff: bool = False) -> str:
         data=form_data,
         headers={
             "Content-Type": "application/x-www-form-urlencoded",
-            "Origin": "https://idp.it.su.se",
-            "Referer": "https://idp.it.su.se/",
+            "Origin": IDP_BASE_URL,
+            "Referer": f"{IDP_BASE_URL}/",
         },
+        timeout=timeout,
     )  # type: ignore
 
     j_session_id = [
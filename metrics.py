@@ -0,0 +1,154 @@
+"""
+A discord bot capable of booking student group rooms and staff rooms via Daisy (administration tool for Department of Computer and Systems Sciences at Stockholm University)
+Copyright (C) 2024 Edwin Sundberg
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import bisect
+import contextlib
+import logging
+import threading
+import time
+from typing import Callable, Dict, Iterator, List, Optional, Tuple, Union
+
+import profiling
+
+# Seconds, covers everything from a cached lookup to a slow LLM completion
+BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 180]
+
+GaugeValue = Union[float, Dict[str, float]]
+
+
+class Histogram:
+    def __init__(self, buckets: List[float] = BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> Optional[float]:
+        """Upper bound of the bucket containing the q-quantile, None without observations"""
+        if not self.count:
+            return None
+        target = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= target:
+                return self.buckets[i] if i < len(self.buckets) else float("inf")
+        return float("inf")
+
+
+class Registry:
+    """Per-stage latency histograms, counters and gauges (gauges are callbacks evaluated on read)"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.histograms: Dict[str, Histogram] = {}
+        # (name, label name, label value) -> value
+        self.counters: Dict[Tuple[str, str, str], float] = {}
+        self.gauges: Dict[str, Callable[[], GaugeValue]] = {}
+        # Called with every raw observation, the load benchmark keeps exact samples this way
+        self.observers: List[Callable[[str, float], None]] = []
+
+    def observe(self, stage: str, seconds: float):
+        with self._lock:
+            self.histograms.setdefault(stage, Histogram()).observe(seconds)
+        for observer in self.observers:
+            observer(stage, seconds)
+
+    def inc(self, name: str, label: str = "", value: float = 1, label_name: str = "stage"):
+        """Adds to a counter, `label` is exported as `label_name` (e.x. endpoint="schedule")"""
+        key = (name, label_name, label)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def gauge(self, name: str, func: Callable[[], GaugeValue]):
+        self.gauges[name] = func
+
+    def read_gauges(self) -> Dict[str, GaugeValue]:
+        values = {}
+        for name, func in list(self.gauges.items()):
+            try:
+                values[name] = func()
+            except Exception: # pylint: disable=broad-except
+                logging.exception("Failed to read gauge %s", name)
+        return values
+
+    @contextlib.contextmanager
+    def timed(self, stage: str) -> Iterator[None]:
+        """Records the latency of the block, and a span if the request is being profiled"""
+        start = time.perf_counter()
+        try:
+            with profiling.span(stage):
+                yield
+        except BaseException:
+            self.inc("stage_errors_total", stage)
+            raise
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+            self.inc("stage_calls_total", stage)
+
+    def render_prometheus(self) -> str:
+        lines: List[str] = []
+        with self._lock:
+            histograms = list(self.histograms.items())
+            counters = list(self.counters.items())
+        for stage, histogram in histograms:
+            cumulative = 0
+            for bound, count in zip(histogram.buckets + [float("inf")], histogram.counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else str(bound)
+                lines.append(f'stage_latency_seconds_bucket{{stage="{stage}",le="{le}"}} {cumulative}')
+            lines.append(f'stage_latency_seconds_sum{{stage="{stage}"}} {histogram.sum}')
+            lines.append(f'stage_latency_seconds_count{{stage="{stage}"}} {histogram.count}')
+        for (name, label_name, label), value in counters:
+            lines.append(f'{name}{{{label_name}="{label}"}} {value}' if label else f"{name} {value}")
+        for name, value in self.read_gauges().items():
+            if isinstance(value, dict):
+                for label, sub_value in value.items():
+                    lines.append(f'{name}{{key="{label}"}} {sub_value}')
+            else:
+                lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> str:
+        """Short human readable summary, used by the stats command"""
+        lines = []
+        with self._lock:
+            histograms = sorted(self.histograms.items())
+            counters = dict(self.counters)
+        for stage, histogram in histograms:
+            errors = counters.get(("stage_errors_total", "stage", stage), 0)
+            lines.append(
+                f"{stage}: n={histogram.count} avg={histogram.sum / histogram.count:.3f}s "
+                f"p50<={histogram.quantile(0.5)}s p95<={histogram.quantile(0.95)}s errors={errors / histogram.count:.1%}"
+            )
+        for name, value in sorted(self.read_gauges().items()):
+            if isinstance(value, dict):
+                value = ", ".join(f"{k}={v:.3g}" if isinstance(v, float) else f"{k}={v}" for k, v in value.items())
+            lines.append(f"{name}: {value}")
+        return "\n".join(lines) if lines else "No metrics recorded yet"
+
+
+REGISTRY = Registry()
+
+timed = REGISTRY.timed
+observe = REGISTRY.observe
+inc = REGISTRY.inc
+gauge = REGISTRY.gauge
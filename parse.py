@@ -19,8 +19,6 @@ import datetime
 import re
 from typing import List, Optional, Tuple
 
-from bs4 import BeautifulSoup
-
 from schemas import RoomCategory, RoomTime, Schedule, RoomActivity
 
 def parse_daisy_schedule(html_content: str) -> Schedule:
@@ -33,6 +31,9 @@ def parse_daisy_schedule(html_content: str) -> Schedule:
     Returns:
         Schedule object containing the parsed schedule
     """
+    # Imported on first use, bs4 is slow to import and only needed once a schedule arrives
+    from bs4 import BeautifulSoup # pylint: disable=import-outside-toplevel
+
     # Initialize BeautifulSoup
     soup = BeautifulSoup(html_content, "html.parser")
 
@@ -110,6 +111,8 @@ def parse_daisy_schedule(html_content: str) -> Schedule:
     )
 
 def parse_booking_completion(html_content: str) -> Optional[str]:
+    from bs4 import BeautifulSoup # pylint: disable=import-outside-toplevel
+
     soup = BeautifulSoup(html_content, "html.parser")
     # <ul class="errorMessage">
     # <li><span>Du måste ange en titel.</span></li>	</ul>
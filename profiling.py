@@ -0,0 +1,178 @@
+"""
+A discord bot capable of booking student group rooms and staff rooms via Daisy (administration tool for Department of Computer and Systems Sciences at Stockholm University)
+Copyright (C) 2024 Edwin Sundberg
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import collections
+import contextlib
+import contextvars
+import os
+import sys
+import threading
+import time
+from typing import Counter, Dict, Iterator, List, Optional
+
+_PROFILE: "contextvars.ContextVar[Optional[Profile]]" = contextvars.ContextVar("profile", default=None)
+_CURRENT_SPAN: "contextvars.ContextVar[Optional[Span]]" = contextvars.ContextVar("current_span", default=None)
+
+
+class Span:
+    __slots__ = ("name", "start", "end", "children", "thread")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.start = time.perf_counter()
+        self.end: Optional[float] = None
+        self.children: List["Span"] = []
+        self.thread = threading.current_thread().name
+
+    @property
+    def duration(self) -> float:
+        return (self.end if self.end is not None else time.perf_counter()) - self.start
+
+
+class Profile:
+    """
+    Wall-clock span tree plus a sampled CPU profile of the threads working on one request
+
+    Samples are stored as folded stacks ("frame;frame;frame count"), the format used by flamegraph.pl and speedscope.
+
+    Samples are taken per thread, not per request. The event loop thread is shared, so while the request is awaiting,
+    its samples include whatever other requests run on the loop. Work on the CPU lane runs in separate processes and is
+    not sampled at all, it only shows up as the span waiting for it. The span tree is exact, the samples are a hint.
+    """
+    def __init__(self, name: str, interval: float = 0.005):
+        self.root = Span(name)
+        self.interval = interval
+        self.samples: Counter[str] = collections.Counter()
+        self._threads: Dict[int, int] = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._sampler = threading.Thread(target=self._sample, name="profiler", daemon=True)
+
+    def enter_thread(self):
+        ident = threading.get_ident()
+        with self._lock:
+            self._threads[ident] = self._threads.get(ident, 0) + 1
+
+    def exit_thread(self):
+        ident = threading.get_ident()
+        with self._lock:
+            self._threads[ident] -= 1
+            if not self._threads[ident]:
+                del self._threads[ident]
+
+    def add_span(self, parent: Optional[Span], span: Span):
+        with self._lock:
+            (parent if parent is not None else self.root).children.append(span)
+
+    def _sample(self):
+        while not self._stopped.wait(self.interval):
+            frames = sys._current_frames() # pylint: disable=protected-access
+            with self._lock:
+                threads = list(self._threads)
+            for ident in threads:
+                frame = frames.get(ident)
+                stack = []
+                while frame is not None:
+                    stack.append(f"{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)})")
+                    frame = frame.f_back
+                if stack:
+                    self.samples[";".join(reversed(stack))] += 1
+
+    def start(self):
+        self._sampler.start()
+
+    def stop(self):
+        self.root.end = time.perf_counter()
+        self._stopped.set()
+        self._sampler.join()
+
+    def folded(self) -> str:
+        return "\n".join(f"{stack} {count}" for stack, count in self.samples.most_common()) + "\n"
+
+    def span_tree(self) -> str:
+        lines = []
+        def walk(span: Span, depth: int):
+            lines.append(f"{'  ' * depth}{span.name}: {span.duration * 1000:.1f}ms [{span.thread}]")
+            for child in sorted(span.children, key=lambda s: s.start):
+                walk(child, depth + 1)
+        walk(self.root, 0)
+        return "\n".join(lines)
+
+    def summary(self, top: int = 5) -> str:
+        leaves: Counter[str] = collections.Counter()
+        for stack, count in self.samples.items():
+            leaves[stack.rsplit(";", 1)[-1]] += count
+        total = sum(leaves.values())
+        hot = [f"{count / total:.0%} {frame}" for frame, count in leaves.most_common(top)] if total else []
+        return self.span_tree() + ("\nHottest frames:\n" + "\n".join(hot) if hot else "")
+
+
+class span:
+    """
+    Records a span in the active profile, a no-op (one context variable lookup) when no request is being profiled
+
+    Usable as a context manager in both threads and coroutines.
+    """
+    __slots__ = ("name", "_profile", "_span", "_token")
+
+    def __init__(self, name: str):
+        self.name = name
+        self._profile: Optional[Profile] = None
+
+    def __enter__(self) -> "span":
+        self._profile = _PROFILE.get()
+        if self._profile is None:
+            return self
+        self._span = Span(self.name)
+        self._profile.add_span(_CURRENT_SPAN.get(), self._span)
+        self._profile.enter_thread()
+        self._token = _CURRENT_SPAN.set(self._span)
+        return self
+
+    def __exit__(self, *exc_info):
+        if self._profile is None:
+            return
+        self._span.end = time.perf_counter()
+        _CURRENT_SPAN.reset(self._token)
+        self._profile.exit_thread()
+
+
+@contextlib.contextmanager
+def profile_request(name: str, directory: Optional[str] = None) -> Iterator[Profile]:
+    """
+    Profiles everything run within the block (and in executor threads started from it)
+
+    The folded stacks are written to `directory`/<name>.folded once the block exits.
+    """
+    profile = Profile(name)
+    profile_token = _PROFILE.set(profile)
+    span_token = _CURRENT_SPAN.set(profile.root)
+    profile.enter_thread()
+    profile.start()
+    try:
+        yield profile
+    finally:
+        profile.exit_thread()
+        profile.stop()
+        _CURRENT_SPAN.reset(span_token)
+        _PROFILE.reset(profile_token)
+        directory = directory or os.getenv("PROFILE_DIR", "profiles")
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, f"{name}.folded"), "w", encoding="utf-8") as file:
+            file.write(profile.folded())
+        with open(os.path.join(directory, f"{name}.spans.txt"), "w", encoding="utf-8") as file:
+            file.write(profile.span_tree() + "\n")
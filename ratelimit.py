@@ -0,0 +1,116 @@
+"""
+A discord bot capable of booking student group rooms and staff rooms via Daisy (administration tool for Department of Computer and Systems Sciences at Stockholm University)
+Copyright (C) 2024 Edwin Sundberg
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import itertools
+import threading
+import time
+from enum import IntEnum
+from typing import Dict, List, Optional, Tuple
+
+
+class Priority(IntEnum):
+    """Lower value is served first"""
+    BOOKING = 0
+    INTERACTIVE = 1
+    BACKGROUND = 2
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = max(capacity, 1)
+        self.tokens = self.capacity
+        self._last = time.monotonic()
+
+    def refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def time_until_available(self) -> float:
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+def parse_budgets(value: str) -> Dict[str, Tuple[float, float]]:
+    """Parses "endpoint=rate:burst,..." e.x. "schedule=2:4,booking=5:10" """
+    budgets = {}
+    for entry in value.split(","):
+        if not entry.strip():
+            continue
+        endpoint, budget = entry.split("=")
+        rate, burst = budget.split(":")
+        budgets[endpoint.strip()] = (float(rate), float(burst))
+    return budgets
+
+
+class RateLimiter:
+    """
+    Token bucket rate limiter with a global budget, per-endpoint budgets and priority classes
+
+    Waiting callers are served in priority order (then arrival order), a caller is only held back by a higher
+    priority caller if that caller can actually proceed, so a throttled endpoint does not block the others.
+    """
+    def __init__(self, rate: float, burst: float, endpoint_budgets: Optional[Dict[str, Tuple[float, float]]] = None):
+        self._global = TokenBucket(rate, burst)
+        self._endpoints = {endpoint: TokenBucket(r, b) for endpoint, (r, b) in (endpoint_budgets or {}).items()}
+        self._cond = threading.Condition()
+        self._waiters: List[Tuple[int, int, str]] = []
+        self._sequence = itertools.count()
+        # priority name -> [requests, total wait seconds, max wait seconds]
+        self.wait_stats: Dict[str, List[float]] = {priority.name: [0, 0.0, 0.0] for priority in Priority}
+
+    def _can_proceed(self, endpoint: str) -> bool:
+        bucket = self._endpoints.get(endpoint)
+        return self._global.tokens >= 1 and (bucket is None or bucket.tokens >= 1)
+
+    def _wait_time(self, endpoint: str) -> float:
+        bucket = self._endpoints.get(endpoint)
+        return max(self._global.time_until_available(), bucket.time_until_available() if bucket is not None else 0)
+
+    def acquire(self, endpoint: str, priority: Priority = Priority.INTERACTIVE) -> float:
+        """Blocks until the request may be sent, returns the time waited in seconds"""
+        start = time.monotonic()
+        entry = (int(priority), next(self._sequence), endpoint)
+        with self._cond:
+            self._waiters.append(entry)
+            self._waiters.sort()
+            while True:
+                now = time.monotonic()
+                self._global.refill(now)
+                for bucket in self._endpoints.values():
+                    bucket.refill(now)
+                first = next((waiter for waiter in self._waiters if self._can_proceed(waiter[2])), None)
+                if first is entry:
+                    break
+                self._cond.wait(timeout=max(self._wait_time(endpoint), 0.01))
+            self._waiters.remove(entry)
+            self._global.tokens -= 1
+            if endpoint in self._endpoints:
+                self._endpoints[endpoint].tokens -= 1
+            self._cond.notify_all()
+
+        waited = time.monotonic() - start
+        stats = self.wait_stats[priority.name]
+        stats[0] += 1
+        stats[1] += waited
+        stats[2] = max(stats[2], waited)
+        return waited
+
+    @property
+    def queued(self) -> int:
+        return len(self._waiters)
@@ -0,0 +1,191 @@
+"""
+A discord bot capable of booking student group rooms and staff rooms via Daisy (administration tool for Department of Computer and Systems Sciences at Stockholm University)
+Copyright (C) 2024 Edwin Sundberg
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import asyncio
+import datetime
+import logging
+import os
+import statistics
+import time
+from email.utils import parsedate_to_datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+import attr
+import pytz
+import requests
+
+import metrics
+from daisy import DAISY_RATE_LIMITER, DAISY_TIMEOUT, STANDARD_HEADERS, BookingError, Daisy
+from ratelimit import Priority
+from scheduler import ROOM_PREFERENCE_ORDER
+from schedules import fetch_schedule, taken_rooms
+from schemas import Room, RoomCategory, RoomRestriction, RoomTime, Schedule
+from transport import DAISY_BASE_URL
+from utils import run_async
+
+TIMEZONE = pytz.timezone("Europe/Stockholm")
+
+# A date becomes bookable BOOKING_WINDOW_DAYS days ahead, at BOOKING_WINDOW_OPENS_AT local time
+BOOKING_WINDOW_DAYS = int(os.getenv("BOOKING_WINDOW_DAYS", "14"))
+BOOKING_WINDOW_OPENS_AT = datetime.time.fromisoformat(os.getenv("BOOKING_WINDOW_OPENS_AT", "00:00"))
+
+DAISY_URL = f"{DAISY_BASE_URL}/servlet/schema.LokalSchema"
+
+# Group rooms are the only ones that open for everyone at the same time
+GROUP_ROOMS = [room for room in ROOM_PREFERENCE_ORDER if room.name.startswith(("G10_", "G5_"))]
+
+
+@attr.s(auto_attribs=True, frozen=True, slots=True)
+class PlannedBooking:
+    user_id: int
+    date: datetime.date
+    from_time: RoomTime
+    to_time: RoomTime
+    title: str
+    room_restrictions: List[RoomRestriction] = attr.Factory(list)
+    preference_order: Optional[List[Room]] = None
+
+
+@attr.s(auto_attribs=True, frozen=True, slots=True)
+class ReleaseResult:
+    booking: PlannedBooking
+    room: Optional[Room]
+    # Seconds from the (server side) opening until the booking was confirmed
+    latency: Optional[float]
+    attempts: int
+    error: Optional[str] = None
+
+
+def opening_time(date: datetime.date) -> datetime.datetime:
+    """When `date` becomes bookable"""
+    return TIMEZONE.localize(datetime.datetime.combine(date - datetime.timedelta(days=BOOKING_WINDOW_DAYS), BOOKING_WINDOW_OPENS_AT))
+
+
+def candidate_rooms(booking: PlannedBooking, schedule: Optional[Schedule] = None) -> List[Room]:
+    """
+    Rooms to try in order, the first choice followed by the fallbacks
+
+    With a schedule for the date rooms that are already taken during the booking are left out.
+    """
+    order = booking.preference_order or ROOM_PREFERENCE_ORDER
+    rooms = [room for room in order if room in GROUP_ROOMS] + [room for room in GROUP_ROOMS if room not in order]
+    for restriction in booking.room_restrictions:
+        rooms = [room for room in rooms if restriction.to_filter()(room)]
+    if schedule is not None:
+        taken = taken_rooms(schedule, booking.from_time, booking.to_time)
+        rooms = [room for room in rooms if room not in taken]
+    return rooms
+
+
+def measure_clock_skew(session: requests.Session, samples: int = 3) -> float:
+    """
+    Seconds the Daisy clock is ahead of ours, from the Date header of a few requests
+
+    Also opens (and keeps open) the connection used for the booking. The header has a one second resolution,
+    half a second is added to every sample as its expected truncation.
+    """
+    skews = []
+    for _ in range(samples):
+        DAISY_RATE_LIMITER.acquire("validate", Priority.BACKGROUND)
+        sent = time.time()
+        response = session.head(DAISY_URL, headers=STANDARD_HEADERS, timeout=DAISY_TIMEOUT)
+        received = time.time()
+        if "Date" not in response.headers:
+            continue
+        server = parsedate_to_datetime(response.headers["Date"]).timestamp() + 0.5
+        skews.append(server - (sent + received) / 2)
+    return statistics.median(skews) if skews else 0.0
+
+
+def fire(daisy: Daisy, session: requests.Session, booking: PlannedBooking, payloads: List[Tuple[Room, Dict[str, Any]]], opens_at: float, skew: float, retry_for: float) -> ReleaseResult:
+    """
+    Blocks until the opening (on the Daisy clock) and submits the payloads in order until one is accepted
+
+    If every room is rejected the round is repeated for `retry_for` seconds, in case we fired marginally early.
+    """
+    fire_at = opens_at - skew
+    # Keep the connection from idling out and refresh the skew just before the opening
+    if fire_at - time.time() > 1.5:
+        time.sleep(fire_at - time.time() - 1.5)
+        skew = measure_clock_skew(session, samples=1)
+        fire_at = opens_at - skew
+    # Sleep most of the way, then spin for the last few milliseconds
+    if fire_at - time.time() > 0.005:
+        time.sleep(fire_at - time.time() - 0.005)
+    while time.time() < fire_at:
+        pass
+
+    attempts = 0
+    error: Optional[str] = None
+    while True:
+        for room, payload in payloads:
+            attempts += 1
+            try:
+                daisy.submit_booking(RoomCategory.BOOKABLE_GROUP_ROOMS, payload, session=session)
+            except BookingError as e:
+                error = str(e)
+                continue
+            return ReleaseResult(booking, room, time.time() + skew - opens_at, attempts)
+        if not payloads or time.time() + skew - opens_at > retry_for:
+            return ReleaseResult(booking, None, None, attempts, error or "No candidate rooms")
+        time.sleep(0.2)
+
+
+class ReleaseQueue:
+    """
+    Planned bookings that are made the moment their date becomes bookable
+
+    `prepare_ahead` seconds before the opening the session is validated, the booking user added, the payloads built and the
+    connection opened, so the opening itself only costs the booking POST.
+    """
+    def __init__(self, prepare_ahead: float = 30, retry_for: float = 5):
+        self.prepare_ahead = prepare_ahead
+        self.retry_for = retry_for
+        self.pending: List[PlannedBooking] = []
+
+    async def _prepare(self, daisy: Daisy, booking: PlannedBooking, session: requests.Session) -> Tuple[List[Tuple[Room, Dict[str, Any]]], float]:
+        await run_async(daisy.ensure_booking_user, datetime.date.today(), Priority.BOOKING)
+        schedule: Optional[Schedule] = None
+        try:
+            # Daisy may not show schedules for dates that are not bookable yet, the fallback is the full preference order
+            schedule = await fetch_schedule(daisy, booking.date, RoomCategory.BOOKABLE_GROUP_ROOMS, Priority.BOOKING)
+        except Exception: # pylint: disable=broad-except
+            logging.info("No schedule for %s ahead of its opening", booking.date)
+        description = f"Booked via dsv-daisy-booker (https://github.com/Edwinexd/dsv-daisy-booker) at release of {booking.date.isoformat()}"
+        payloads = [
+            (room, daisy.booking_payload(booking.date, booking.from_time, booking.to_time, RoomCategory.BOOKABLE_GROUP_ROOMS, room.value, booking.title, description))
+            for room in candidate_rooms(booking, schedule)
+        ]
+        skew = await run_async(measure_clock_skew, session)
+        return payloads, skew
+
+    async def run(self, daisy: Daisy, booking: PlannedBooking) -> ReleaseResult:
+        opens_at = opening_time(booking.date).timestamp()
+        self.pending.append(booking)
+        try:
+            await asyncio.sleep(max(opens_at - self.prepare_ahead - time.time(), 0))
+            with requests.Session() as session:
+                payloads, skew = await self._prepare(daisy, booking, session)
+                logging.info("Release of %s prepared, %d rooms, clock skew %.3fs", booking.date, len(payloads), skew)
+                result = await run_async(fire, daisy, session, booking, payloads, opens_at, skew, self.retry_for)
+        finally:
+            self.pending.remove(booking)
+
+        metrics.inc("release_bookings_total", "booked" if result.room is not None else "failed", label_name="outcome")
+        if result.latency is not None:
+            metrics.observe("release_booking", result.latency)
+        return result
@@ -0,0 +1,128 @@
+"""
+A discord bot capable of booking student group rooms and staff rooms via Daisy (administration tool for Department of Computer and Systems Sciences at Stockholm University)
+Copyright (C) 2024 Edwin Sundberg
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import random
+import re
+import statistics
+import threading
+from collections import deque
+from typing import Deque, Dict, Iterable, List, Optional, Tuple
+
+SIMPLE = "simple"
+COMPLEX = "complex"
+
+# Words that usually mean several requests, breaks or a follow-up that depends on earlier turns
+MULTI_REQUEST_PATTERN = re.compile(r"\b(and|also|then|plus|every|each|break|breaks|pause|lunch|both|except|instead|same|another)\b|[,;&+]")
+NUMBER_PATTERN = re.compile(r"\d+")
+
+
+def classify(message: str, has_history: bool = False, max_words: int = 20) -> str:
+    """
+    SIMPLE for a short single request, COMPLEX for replies, long messages and anything that looks like several requests
+
+    A wrong SIMPLE only costs an escalation, a wrong COMPLEX only the faster model.
+    """
+    text = message.lower()
+    if has_history or len(text.split()) > max_words or MULTI_REQUEST_PATTERN.search(text):
+        return COMPLEX
+    # A date and one time range at most
+    if len(NUMBER_PATTERN.findall(text)) > 5:
+        return COMPLEX
+    return SIMPLE
+
+
+class ModelRouter:
+    """
+    Picks the model for an LLM attempt from rolling per-model latency and validation statistics
+
+    `models` are ordered from the fastest / weakest to the strongest. Simple messages go to the fastest model that
+    produced valid output for at least `min_success` of its recent simple messages, complex messages to the most reliable
+    model for complex messages (the strongest while there is too little data). A failed attempt escalates to the next
+    stronger model. A share (`explore`) of attempts goes to the least sampled other model, so that statistics are built
+    up for new models and kept current for the ones that are not picked.
+    """
+    def __init__(self, models: List[str], window: int = 50, min_samples: int = 5, min_success: float = 0.9, explore: float = 0.05, rng: Optional[random.Random] = None):
+        if not models:
+            raise ValueError("At least one model is required")
+        self.models = list(dict.fromkeys(models))
+        self.window = window
+        self.min_samples = min_samples
+        self.min_success = min_success
+        self.explore = explore
+        self._random = rng or random.Random()
+        self._lock = threading.Lock()
+        # (model, kind) -> recent (seconds, valid)
+        self._outcomes: Dict[Tuple[str, str], Deque[Tuple[float, bool]]] = {}
+        self.escalations = 0
+
+    def record(self, model: str, kind: str, seconds: float, valid: bool):
+        with self._lock:
+            self._outcomes.setdefault((model, kind), deque(maxlen=self.window)).append((seconds, valid))
+
+    def _stats(self, model: str, kind: str) -> Tuple[int, float, Optional[float]]:
+        """Recent samples, success rate and median latency of valid outputs"""
+        outcomes = list(self._outcomes.get((model, kind), ()))
+        if not outcomes:
+            return 0, 0.0, None
+        latencies = [seconds for seconds, valid in outcomes if valid]
+        return len(outcomes), len(latencies) / len(outcomes), statistics.median(latencies) if latencies else None
+
+    def choose(self, kind: str, exclude: Iterable[str] = (), failed: Optional[str] = None) -> str:
+        """
+        Model for the next attempt
+
+        Args:
+            kind: SIMPLE or COMPLEX, see classify
+            exclude: Models already in flight, avoided if another one is available
+            failed: Model whose output just failed validation, the next stronger one is used
+        """
+        excluded = set(exclude)
+        candidates = [model for model in self.models if model not in excluded] or self.models
+        if failed is not None and failed in self.models:
+            with self._lock:
+                self.escalations += 1
+            stronger = [model for model in self.models[self.models.index(failed) + 1:] if model in candidates]
+            return stronger[0] if stronger else candidates[-1]
+
+        with self._lock:
+            stats = {model: self._stats(model, kind) for model in candidates}
+        reliable = [model for model in candidates if stats[model][0] >= self.min_samples and stats[model][1] >= self.min_success]
+        if kind == SIMPLE and reliable:
+            best = min(reliable, key=lambda model: stats[model][2] or float("inf"))
+        elif kind == COMPLEX and reliable:
+            # Stronger models win ties
+            best = max(reliable, key=lambda model: (stats[model][1], self.models.index(model)))
+        else:
+            best = candidates[-1]
+
+        others = [model for model in candidates if model != best]
+        if others and self._random.random() < self.explore:
+            # The least sampled model, so that models that were not picked recently get a chance to show they recovered
+            return min(others, key=lambda model: stats[model][0])
+        return best
+
+    def stats(self) -> Dict[str, float]:
+        values: Dict[str, float] = {"escalations": self.escalations}
+        with self._lock:
+            for (model, kind) in list(self._outcomes):
+                samples, success, latency = self._stats(model, kind)
+                name = model.rsplit("/", 1)[-1]
+                values[f"{name}.{kind}.samples"] = samples
+                values[f"{name}.{kind}.success"] = success
+                if latency is not None:
+                    values[f"{name}.{kind}.p50_seconds"] = latency
+        return values
@@ -133,8 +133,10 @@ def schedule(rooms: List[BookableRoom], start_time: RoomTime, hours: int, shift:
 
     return result
 
-def schedule_rooms(category_schedule: Schedule, from_time: RoomTime, duration: int, breaks: List[Break], room_restrictions: List[RoomRestriction]) -> List[BookingSlot]:
-    """Higher level function to schedule rooms with support for breaks"""
+def schedule_rooms(category_schedule: Schedule, from_time: RoomTime, duration: int, breaks: List[Break], room_restrictions: List[RoomRestriction], preference_order: Optional[List[Room]] = None) -> List[BookingSlot]:
+    """Higher level function to schedule rooms with support for breaks, preference_order defaults to ROOM_PREFERENCE_ORDER"""
+    if preference_order is None:
+        preference_order = ROOM_PREFERENCE_ORDER
     # TODO: BookableRoom has to use the enum!
     rooms = [BookableRoom(Room.from_name(name), value) for name, value in category_schedule.activities.items()]
 
@@ -142,8 +144,8 @@ def schedule_rooms(category_schedule: Schedule, from_time: RoomTime, duration: i
         func = restriction.to_filter()
         rooms = [room for room in rooms if func(room.room)]
 
-    # Order rooms after preference, note: not all rooms are included in ROOM_PREFERENCE_ORDER
-    rooms = sorted(rooms, key=lambda room: ROOM_PREFERENCE_ORDER.index(room.room) if room.room in ROOM_PREFERENCE_ORDER else len(ROOM_PREFERENCE_ORDER))
+    # Order rooms after preference, note: not all rooms are included in the preference order
+    rooms = sorted(rooms, key=lambda room: preference_order.index(room.room) if room.room in preference_order else len(preference_order))
 
     times: List[Tuple[RoomTime, int]] = [(from_time, duration)] # list of start times and durations
     if breaks:
@@ -0,0 +1,90 @@
+"""
+A discord bot capable of booking student group rooms and staff rooms via Daisy (administration tool for Department of Computer and Systems Sciences at Stockholm University)
+Copyright (C) 2024 Edwin Sundberg
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import asyncio
+import datetime
+import logging
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+import attr
+
+import metrics
+from daisy import Daisy
+from parse import parse_daisy_schedule
+from ratelimit import Priority
+from scheduler import schedule_rooms
+from schemas import Break, BookingSlot, Room, RoomActivity, RoomCategory, RoomRestriction, RoomTime, Schedule
+from utils import run_async, run_cpu
+
+
+# Called with every freshly fetched schedule
+SCHEDULE_OBSERVERS: List[Callable[[Schedule], None]] = []
+
+# Concurrent callers asking for the same schedule share the fetch and the parse
+_in_flight: Dict[Tuple[int, datetime.date, RoomCategory], "asyncio.Future[Schedule]"] = {}
+
+
+async def _fetch_and_parse(daisy: Daisy, date: datetime.date, room_category: RoomCategory, priority: Priority) -> Schedule:
+    raw = await run_async(daisy.get_raw_schedule_for_category, date, room_category, priority)
+    with metrics.timed("parse"):
+        schedule = await run_cpu(parse_daisy_schedule, raw)
+    for observer in SCHEDULE_OBSERVERS:
+        try:
+            observer(schedule)
+        except Exception: # pylint: disable=broad-except
+            logging.exception("Schedule observer failed")
+    return schedule
+
+
+async def fetch_schedule(daisy: Daisy, date: datetime.date, room_category: RoomCategory, priority: Priority = Priority.INTERACTIVE) -> Schedule:
+    """Fetches a schedule on the I/O lane and parses it on the CPU lane"""
+    key = (id(daisy), date, room_category)
+    future = _in_flight.get(key)
+    if future is None:
+        future = asyncio.ensure_future(_fetch_and_parse(daisy, date, room_category, priority))
+        _in_flight[key] = future
+        future.add_done_callback(lambda _: _in_flight.pop(key, None))
+    # Shielded so that one cancelled caller does not cancel the fetch for everyone else
+    return await asyncio.shield(future)
+
+
+async def plan_slots(schedule: Schedule, from_time: RoomTime, duration: int, breaks: List[Break], room_restrictions: List[RoomRestriction], preference_order: Optional[List[Room]] = None) -> List[BookingSlot]:
+    with metrics.timed("schedule_rooms"):
+        return await run_cpu(schedule_rooms, schedule, from_time, duration, breaks, room_restrictions, preference_order)
+
+
+def taken_rooms(schedule: Schedule, from_time: RoomTime, to_time: RoomTime) -> Set[Room]:
+    """Rooms with any activity between from_time and to_time"""
+    hours = set(range(from_time.value, to_time.value))
+    return {
+        Room.from_name(name) for name, activities in schedule.activities.items()
+        if any(hours & set(range(activity.time_slot_start.value, activity.time_slot_end.value)) for activity in activities)
+    }
+
+
+def plan_is_free(schedule: Schedule, slots: List[BookingSlot]) -> bool:
+    """Whether every planned slot is still free, only the planned rooms and hours are looked at"""
+    return not any(slot.room in taken_rooms(schedule, slot.from_time, slot.to_time) for slot in slots)
+
+
+def reserve(schedule: Schedule, slots: List[BookingSlot]) -> Schedule:
+    """The schedule with `slots` marked as taken, so later requests are planned around them"""
+    names = {Room.from_name(name): name for name in schedule.activities}
+    activities = {name: list(entries) for name, entries in schedule.activities.items()}
+    for slot in slots:
+        activities[names[slot.room]].append(RoomActivity(slot.from_time, slot.to_time, "Planned"))
+    return attr.evolve(schedule, activities=activities)
@@ -17,7 +17,7 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 import datetime
 from enum import Enum
-from typing import Callable, Dict, List
+from typing import Any, Callable, Dict, List, Optional
 
 import attr
 
@@ -301,3 +301,25 @@ class Schedule:
 class Break:
     start_time: RoomTime
     duration: int
+
+@attr.s(auto_attribs=True, frozen=True, slots=True)
+class RoomRequest:
+    title: Optional[str]
+    date: datetime.date
+    from_time: RoomTime
+    duration: int
+    breaks: List[Break]
+    room_restrictions: List[RoomRestriction]
+    room_category: RoomCategory
+
+    @classmethod
+    def from_json(cls, data: Dict[str, Any]) -> "RoomRequest":
+        return cls(
+            title=data.get("title"),
+            date=datetime.datetime.strptime(data["date"], "%Y-%m-%d").date(),
+            from_time=RoomTime(data["from_time"]),
+            duration=data["duration"],
+            breaks=[Break(start_time=RoomTime(b["from_time"]), duration=b["duration"]) for b in data.get("breaks", [])],
+            room_restrictions=[RoomRestriction(r) for r in data.get("room_filters", [])],
+            room_category=RoomCategory(int(data.get("room_category", RoomCategory.BOOKABLE_GROUP_ROOMS.value)) if data.get("room_category") != 0 and isinstance(data.get("room_category"), int) else RoomCategory.BOOKABLE_GROUP_ROOMS),
+        )
@@ -0,0 +1,296 @@
+"""
+A discord bot capable of booking student group rooms and staff rooms via Daisy (administration tool for Department of Computer and Systems Sciences at Stockholm University)
+Copyright (C) 2024 Edwin Sundberg
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import asyncio
+import datetime
+import json
+import logging
+import re
+import sqlite3
+import threading
+from collections import defaultdict
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+import attr
+
+import fastpath
+from daisy import BookingError, Daisy
+from ratelimit import Priority
+from scheduler import ROOM_PREFERENCE_ORDER
+from schedules import fetch_schedule, plan_slots, reserve
+from schemas import BookingSlot, Room, RoomCategory, RoomRestriction, RoomTime
+from utils import run_async
+
+
+@attr.s(auto_attribs=True, frozen=True, slots=True)
+class Series:
+    user_id: int
+    # 0 is Monday
+    weekday: int
+    from_time: RoomTime
+    duration: int
+    # None when none was given, booked as "Meeting"
+    title: Optional[str]
+    end_date: datetime.date
+    room_restrictions: List[RoomRestriction] = attr.Factory(list)
+    preferred_room: Optional[Room] = None
+    room_category: RoomCategory = RoomCategory.BOOKABLE_GROUP_ROOMS
+    series_id: Optional[int] = None
+    # Room of the latest booked occurrence, tried first to keep the series in the same room
+    last_room: Optional[Room] = None
+    # Occurrences up to and including this date have been handled
+    planned_until: Optional[datetime.date] = None
+
+    def due(self, today: datetime.date, window_end: datetime.date) -> List[datetime.date]:
+        """Occurrences that are bookable but not yet handled"""
+        start = today if self.planned_until is None else max(today, self.planned_until + datetime.timedelta(days=1))
+        start += datetime.timedelta(days=(self.weekday - start.weekday()) % 7)
+        dates = []
+        while start <= min(window_end, self.end_date):
+            dates.append(start)
+            start += datetime.timedelta(days=7)
+        return dates
+
+    def preference_order(self) -> List[Room]:
+        first = [room for room in (self.last_room, self.preferred_room) if room is not None]
+        return list(dict.fromkeys(first + ROOM_PREFERENCE_ORDER))
+
+    def describe(self) -> str:
+        room = f" in {self.preferred_room.name}" if self.preferred_room is not None else ""
+        return (
+            f"#{self.series_id} {self.title or 'Meeting'}: {fastpath.WEEKDAYS[self.weekday].capitalize()}s "
+            f"{self.from_time.value:02}:00-{self.from_time.value + self.duration:02}:00{room} until {self.end_date.isoformat()}"
+        )
+
+
+class SeriesStore:
+    """Series and the outcome of each occurrence, in SQLite so they survive restarts"""
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS series ("
+            "series_id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL, weekday INTEGER NOT NULL, from_time INTEGER NOT NULL, "
+            "duration INTEGER NOT NULL, title TEXT NOT NULL, end_date TEXT NOT NULL, room_restrictions TEXT NOT NULL, preferred_room TEXT, "
+            "room_category INTEGER NOT NULL, last_room TEXT, planned_until TEXT)"
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS occurrences ("
+            "series_id INTEGER NOT NULL, date TEXT NOT NULL, slots TEXT NOT NULL, error TEXT, PRIMARY KEY (series_id, date))"
+        )
+        self._db.commit()
+
+    @staticmethod
+    def _from_row(row: Tuple) -> Series:
+        return Series(
+            series_id=row[0],
+            user_id=row[1],
+            weekday=row[2],
+            from_time=RoomTime(row[3]),
+            duration=row[4],
+            title=row[5],
+            end_date=datetime.date.fromisoformat(row[6]),
+            room_restrictions=[RoomRestriction(r) for r in json.loads(row[7])],
+            preferred_room=Room[row[8]] if row[8] else None,
+            room_category=RoomCategory(row[9]),
+            last_room=Room[row[10]] if row[10] else None,
+            planned_until=datetime.date.fromisoformat(row[11]) if row[11] else None,
+        )
+
+    def add(self, series: Series) -> Series:
+        with self._lock:
+            cursor = self._db.execute(
+                "INSERT INTO series (user_id, weekday, from_time, duration, title, end_date, room_restrictions, preferred_room, room_category) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    series.user_id, series.weekday, series.from_time.value, series.duration, series.title or "Meeting", series.end_date.isoformat(),
+                    json.dumps([r.value for r in series.room_restrictions]), series.preferred_room.name if series.preferred_room else None,
+                    series.room_category.value,
+                ),
+            )
+            self._db.commit()
+        return attr.evolve(series, series_id=cursor.lastrowid)
+
+    def remove(self, series_id: int, user_id: int) -> bool:
+        with self._lock:
+            cursor = self._db.execute("DELETE FROM series WHERE series_id = ? AND user_id = ?", (series_id, user_id))
+            self._db.commit()
+        return cursor.rowcount > 0
+
+    def list(self, user_id: Optional[int] = None) -> List[Series]:
+        with self._lock:
+            if user_id is None:
+                rows = self._db.execute("SELECT * FROM series ORDER BY series_id").fetchall()
+            else:
+                rows = self._db.execute("SELECT * FROM series WHERE user_id = ? ORDER BY series_id", (user_id,)).fetchall()
+        return [self._from_row(row) for row in rows]
+
+    def record(self, series: Series, date: datetime.date, slots: List[BookingSlot], error: Optional[str]) -> Series:
+        """Stores the outcome of an occurrence and advances the series past it"""
+        last_room = slots[0].room if slots and error is None else series.last_room
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO occurrences (series_id, date, slots, error) VALUES (?, ?, ?, ?)",
+                (series.series_id, date.isoformat(), json.dumps([[s.room.name, s.from_time.value, s.to_time.value] for s in slots]), error),
+            )
+            self._db.execute(
+                "UPDATE series SET last_room = ?, planned_until = ? WHERE series_id = ?",
+                (last_room.name if last_room else None, date.isoformat(), series.series_id),
+            )
+            self._db.commit()
+        return attr.evolve(series, last_room=last_room, planned_until=date)
+
+
+class SeriesEngine:
+    """
+    Books the occurrences of every series as their dates enter the bookable window
+
+    Run periodically, each run only plans the dates that became bookable since the previous one. Occurrences on the
+    same day share one schedule fetch and are planned around each other.
+    """
+    def __init__(self, store: SeriesStore, bookable_days: int = fastpath.BOOKABLE_DAYS):
+        self.store = store
+        self.bookable_days = bookable_days
+        self.booked = 0
+        self.failed = 0
+        # Overlapping runs would book the same occurrence twice
+        self._lock = asyncio.Lock()
+
+    async def run_once(self, daisy_for: Callable[[int], Optional[Daisy]], today: Optional[datetime.date] = None) -> int:
+        """Handles every due occurrence, returns how many were handled. daisy_for gives the client of a user (None if unknown)"""
+        async with self._lock:
+            return await self._run(daisy_for, today or datetime.date.today())
+
+    async def _run(self, daisy_for: Callable[[int], Optional[Daisy]], today: datetime.date) -> int:
+        window_end = today + datetime.timedelta(days=self.bookable_days - 1)
+        series_by_id = {series.series_id: series for series in self.store.list()}
+
+        # date -> category -> series ids
+        due: Dict[datetime.date, Dict[RoomCategory, List[int]]] = defaultdict(lambda: defaultdict(list))
+        for series in series_by_id.values():
+            for date in series.due(today, window_end):
+                due[date][series.room_category].append(series.series_id) # type: ignore
+
+        handled = 0
+        # A series that failed for an unexpected reason is retried from that date on the next run
+        stalled: Set[int] = set()
+
+        async def handle(date: datetime.date, category: RoomCategory, ids: List[int]) -> int:
+            ids = [i for i in ids if i not in stalled and daisy_for(series_by_id[i].user_id) is not None]
+            if not ids:
+                return 0
+            schedule = await fetch_schedule(daisy_for(series_by_id[ids[0]].user_id), date, category, Priority.BACKGROUND) # type: ignore
+            count = 0
+            for series_id in ids:
+                series = series_by_id[series_id]
+                daisy: Daisy = daisy_for(series.user_id) # type: ignore
+                slots = await plan_slots(schedule, series.from_time, series.duration, [], series.room_restrictions, series.preference_order())
+                error: Optional[str] = None if slots else "No free room"
+                try:
+                    if slots:
+                        await run_async(daisy.book_slots, category, slots, date, series.title or "Meeting")
+                except BookingError as e:
+                    error = str(e)
+                except Exception: # pylint: disable=broad-except
+                    logging.exception("Booking series %s on %s failed", series_id, date)
+                    stalled.add(series_id)
+                    continue
+                schedule = reserve(schedule, slots)
+                series_by_id[series_id] = self.store.record(series, date, slots, error)
+                if error is None:
+                    self.booked += 1
+                else:
+                    self.failed += 1
+                count += 1
+            return count
+
+        for date in sorted(due):
+            try:
+                counts = await asyncio.gather(*(handle(date, category, ids) for category, ids in due[date].items()))
+            except Exception: # pylint: disable=broad-except
+                # e.x. the schedule could not be fetched, the whole day is retried on the next run
+                logging.exception("Planning series occurrences on %s failed", date)
+                stalled.update(i for ids in due[date].values() for i in ids)
+                continue
+            handled += sum(counts)
+        return handled
+
+
+SERIES_PATTERN = re.compile(r"\buntil\s+(\d{4}-\d{1,2}-\d{1,2})\b")
+ROOM_PATTERN = re.compile(r"\broom\s+(g10|g5)[:_ ]?(\d+)\b")
+SERIES_WORDS = {"every", "weekly", "each"}
+
+
+def parse_series(message: str, user_id: int, today: datetime.date) -> Optional[Series]:
+    """
+    Parses "<weekday> XX-YY until YYYY-MM-DD [g10/g5/green/red] [room G10:2] ["title"]", None if the message does not match
+    """
+    titles = fastpath.TITLE_PATTERN.findall(message)
+    if len(titles) > 1:
+        return None
+    title = (titles[0][0] or titles[0][1]).strip() if titles else None
+    rest = fastpath.TITLE_PATTERN.sub(" ", message).lower()
+
+    until = SERIES_PATTERN.findall(rest)
+    if len(until) != 1:
+        return None
+    try:
+        end_date = datetime.date.fromisoformat("-".join(part.zfill(2) for part in until[0].split("-")))
+    except ValueError:
+        return None
+    rest = SERIES_PATTERN.sub(" ", rest)
+
+    preferred_room: Optional[Room] = None
+    rooms = ROOM_PATTERN.findall(rest)
+    if len(rooms) > 1:
+        return None
+    if rooms:
+        preferred_room = Room.__members__.get(f"{rooms[0][0].upper()}_{rooms[0][1]}")
+        if preferred_room is None:
+            return None
+    rest = ROOM_PATTERN.sub(" ", rest)
+
+    hours = fastpath.HOURS_PATTERN.findall(rest)
+    if len(hours) != 1:
+        return None
+    from_time, to_time = int(hours[0][0]), int(hours[0][1])
+    if not 4 <= from_time < to_time <= 23 or to_time - from_time > 4:
+        return None
+    rest = fastpath.HOURS_PATTERN.sub(" ", rest)
+
+    weekdays: List[int] = []
+    filters: List[RoomRestriction] = []
+    for word in fastpath.WORD_PATTERN.findall(rest):
+        if word.rstrip("s") in fastpath.WEEKDAYS[:5]:
+            weekdays.append(fastpath.WEEKDAYS.index(word.rstrip("s")))
+        elif word in fastpath.FILTER_WORDS:
+            filters.append(fastpath.FILTER_WORDS[word])
+        elif word not in fastpath.FILLER_WORDS and word not in SERIES_WORDS:
+            return None
+    if len(weekdays) != 1 or end_date < today:
+        return None
+
+    return Series(
+        user_id=user_id,
+        weekday=weekdays[0],
+        from_time=RoomTime(from_time),
+        duration=to_time - from_time,
+        title=title or None,
+        end_date=end_date,
+        room_restrictions=filters,
+        preferred_room=preferred_room,
+    )
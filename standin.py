@@ -0,0 +1,439 @@
+"""
+A discord bot capable of booking student group rooms and staff rooms via Daisy (administration tool for Department of Computer and Systems Sciences at Stockholm University)
+Copyright (C) 2024 Edwin Sundberg
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import argparse
+import datetime
+import gzip
+import html
+import json
+import logging
+import random
+import re
+import secrets
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+import attr
+
+from scheduler import ROOM_PREFERENCE_ORDER
+
+# Every category is served with the bookable group rooms, the bot treats all schedules alike
+ROOMS = [room for room in ROOM_PREFERENCE_ORDER if room.name.startswith(("G10_", "G5_"))]
+
+# Rows of a schedule page, 08-09 to 20-21
+FIRST_HOUR = 8
+LAST_HOUR = 21
+
+LOGIN_PAGE = "<html><body><form action=\"/login.jspa\"><a href=\"/login.jspa\">Log in</a></form></body></html>"
+
+WEEKDAYS = ["monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday"]
+
+# (from hour, to hour, title)
+Booking = Tuple[int, int, str]
+
+
+@attr.s(auto_attribs=True, frozen=True, slots=True)
+class StandInConfig:
+    # Mean seconds before a response, each request varies by +-jitter of it
+    daisy_latency: float = 0.05
+    idp_latency: float = 0.1
+    # Seconds until the first token, then per streamed token
+    llm_latency: float = 0.5
+    llm_token_delay: float = 0.005
+    jitter: float = 0.5
+    # Share of requests answered with 503
+    error_rate: float = 0.0
+    # Seconds a signed in session stays valid
+    session_ttl: float = 3600
+    # Share of room hours that are booked by someone else
+    occupancy: float = 0.3
+    seed: int = 0
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients dropping keep-alive connections are expected under load
+        logging.debug("Stand-in request from %s failed", client_address, exc_info=True)
+
+
+@attr.s(auto_attribs=True, slots=True)
+class _Session:
+    created: float
+    authenticated_at: Optional[float] = None
+    staff: bool = False
+
+
+class StandIn:
+    """
+    In-process stand-in for Daisy, the SU IdP login chain and the LLM api, for load tests without the real services
+
+    Serves index.jspa, the Shibboleth / IdP form chain daisy_login walks through, schema.LokalSchema (session checks and
+    schedules), bokning.jspa (booking user and bookings) and /llm/<model> with canned completions. Schedules are random
+    but stable per date and room, bookings made against it show up in later schedules and conflicting bookings are rejected.
+    """
+    def __init__(self, config: StandInConfig = StandInConfig()):
+        self.config = config
+        self._lock = threading.Lock()
+        self._random = random.Random(config.seed)
+        self._sessions: Dict[str, _Session] = {}
+        # (date, category) -> room name -> bookings
+        self._schedules: Dict[Tuple[str, str], Dict[str, List[Booking]]] = {}
+        self.requests: Dict[str, int] = {}
+        self.bookings = 0
+        self.errors = 0
+        self._server: Optional[_Server] = None
+        self.base_url = ""
+
+    def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        """Serves from a daemon thread and returns the base URL, port 0 picks a free one"""
+        stand_in = self
+
+        class Handler(_Handler):
+            server_state = stand_in
+
+        self._server = _Server((host, port), Handler)
+        self.base_url = f"http://{host}:{self._server.server_address[1]}"
+        threading.Thread(target=self._server.serve_forever, name="standin", daemon=True).start()
+        return self.base_url
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def env(self) -> Dict[str, str]:
+        """Environment variables pointing the bot at this server"""
+        return {
+            "DAISY_BASE_URL": self.base_url,
+            "IDP_BASE_URL": self.base_url,
+            "CF_API_BASE_URL": f"{self.base_url}/llm/",
+        }
+
+    def delay(self, mean: float):
+        if mean > 0:
+            with self._lock:
+                factor = self._random.uniform(1 - self.config.jitter, 1 + self.config.jitter)
+            time.sleep(max(mean * factor, 0))
+
+    def should_fail(self) -> bool:
+        with self._lock:
+            failed = self._random.random() < self.config.error_rate
+            self.errors += failed
+            return failed
+
+    def count(self, path: str):
+        with self._lock:
+            self.requests[path] = self.requests.get(path, 0) + 1
+
+    def new_session(self) -> str:
+        jsessionid = secrets.token_hex(16).upper()
+        with self._lock:
+            self._sessions[jsessionid] = _Session(time.monotonic())
+        return jsessionid
+
+    def authenticate(self, jsessionid: Optional[str], staff: bool) -> bool:
+        with self._lock:
+            session = self._sessions.get(jsessionid or "")
+            if session is None:
+                return False
+            session.authenticated_at = time.monotonic()
+            session.staff = staff
+            return True
+
+    def is_signed_in(self, jsessionid: Optional[str]) -> bool:
+        with self._lock:
+            session = self._sessions.get(jsessionid or "")
+            return (
+                session is not None and session.authenticated_at is not None
+                and time.monotonic() - session.authenticated_at < self.config.session_ttl
+            )
+
+    def _day(self, date: str, category: str) -> Dict[str, List[Booking]]:
+        key = (date, category)
+        if key not in self._schedules:
+            day: Dict[str, List[Booking]] = {}
+            for room in ROOMS:
+                rng = random.Random(f"{self.config.seed}-{date}-{category}-{room.name}")
+                bookings: List[Booking] = []
+                hour = FIRST_HOUR
+                while hour < LAST_HOUR:
+                    if rng.random() < self.config.occupancy / 2:
+                        end = min(hour + rng.randint(1, 3), LAST_HOUR)
+                        bookings.append((hour, end, rng.choice(["Lecture", "Group work", "Seminar", "Meeting"])))
+                        hour = end
+                    else:
+                        hour += 1
+                day[_room_name(room.name)] = bookings
+            self._schedules[key] = day
+        return self._schedules[key]
+
+    def schedule_page(self, date: str, category: str) -> str:
+        with self._lock:
+            day = {room: list(bookings) for room, bookings in self._day(date, category).items()}
+        rooms = list(day)
+        rows = [
+            f"<tr><td></td><td><b>Category {html.escape(category)}</b>"
+            f"<a href=\"schema.LokalSchema?view=1&amp;lokalkategori={html.escape(category)}\">Change</a> {date}</td></tr>",
+            "<tr><td></td>" + "".join(f"<td>{room}</td>" for room in rooms) + "</tr>",
+        ]
+        covered = {room: 0 for room in rooms}
+        for hour in range(FIRST_HOUR, LAST_HOUR):
+            cells = [f"<td>{hour:02}-{hour + 1:02}</td>"]
+            for room in rooms:
+                if covered[room] > hour:
+                    continue
+                booking = next((b for b in day[room] if b[0] == hour), None)
+                if booking is None:
+                    cells.append("<td></td>")
+                    continue
+                covered[room] = booking[1]
+                cells.append(
+                    f"<td rowspan=\"{booking[1] - booking[0]}\"><a href=\"#\">{html.escape(booking[2])}</a>"
+                    f"<br><span class=\"mini\">Time: {booking[0]:02}:00-{booking[1]:02}:00</span></td>"
+                )
+            rows.append("<tr>" + "".join(cells) + "</tr>")
+        return "<html><body><table class=\"bgTabell\">" + "".join(rows) + "</table></body></html>"
+
+    def book(self, date: str, category: str, room_id: str, from_hour: int, to_hour: int, title: str) -> Optional[str]:
+        """Records a booking, returns the error message Daisy would show if it is not possible"""
+        room = next((room for room in ROOMS if str(room.value) == room_id), None)
+        if room is None:
+            return "Unknown room."
+        if not FIRST_HOUR <= from_hour < to_hour <= LAST_HOUR:
+            return "Invalid time."
+        with self._lock:
+            bookings = self._day(date, category)[_room_name(room.name)]
+            if any(start < to_hour and from_hour < end for start, end, _ in bookings):
+                return "The room is already booked at this time."
+            bookings.append((from_hour, to_hour, title))
+            self.bookings += 1
+        return None
+
+
+def _room_name(name: str) -> str:
+    return name.replace("_", ":")
+
+
+def _form(action: str, fields: Dict[str, str]) -> str:
+    inputs = "".join(f"<input type=\"hidden\" name=\"{html.escape(k)}\" value=\"{html.escape(v)}\">" for k, v in fields.items())
+    return f"<html><body><form method=\"post\" action=\"{html.escape(action)}\">{inputs}</form></body></html>"
+
+
+def canned_completion(messages: List[Dict[str, str]], today: Optional[datetime.date] = None) -> str:
+    """A valid response for the last user message, hours as "XX-YY" or "between XX and YY" and an optional weekday"""
+    today = today or datetime.date.today()
+    text = next((m.get("content", "") for m in reversed(messages) if m.get("role") == "user"), "").lower()
+    match = re.search(r"(\d{1,2})\s*-\s*(\d{1,2})", text) or re.search(r"between (\d{1,2}) and (\d{1,2})", text)
+    from_hour, to_hour = (int(match.group(1)), int(match.group(2))) if match else (13, 15)
+    date = today + datetime.timedelta(days=1)
+    for i, name in enumerate(WEEKDAYS):
+        if name in text:
+            date = today + datetime.timedelta(days=(i - today.weekday()) % 7 or 7)
+            break
+    while date.weekday() >= 5:
+        date += datetime.timedelta(days=1)
+    return json.dumps({
+        "requests": [{"date": date.isoformat(), "from_time": from_hour, "duration": max(min(to_hour - from_hour, 4), 1)}],
+        "conversations_response": "Here is what I found",
+    })
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_state: StandIn
+
+    def _cookie(self) -> Optional[str]:
+        match = re.search(r"JSESSIONID=([^;\s]+)", self.headers.get("Cookie", ""))
+        return match.group(1) if match else None
+
+    def _body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get("Content-Length") or 0))
+
+    def _form(self) -> Dict[str, str]:
+        return {k: v[0] for k, v in parse_qs(self._body().decode("utf-8"), keep_blank_values=True).items()}
+
+    def _send(self, status: int, body: str, content_type: str = "text/html; charset=utf-8", headers: Optional[Dict[str, str]] = None):
+        data = body.encode("utf-8")
+        self.send_response(status)
+        if "gzip" in self.headers.get("Accept-Encoding", "") and len(data) > 512:
+            data = gzip.compress(data, compresslevel=5)
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _handle(self, method: str):
+        state = self.server_state
+        url = urlsplit(self.path)
+        path = url.path
+        state.count(path if not path.startswith("/llm/") else "/llm")
+        state.delay(state.config.idp_latency if path.startswith(("/idp/", "/Shibboleth.sso/")) else 0 if path.startswith("/llm/") else state.config.daisy_latency)
+        if state.should_fail():
+            self._body()
+            self._send(503, "<html><body>Service Unavailable</body></html>")
+            return
+
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        if path == "/index.jspa":
+            self._send(200, "<html><body>Daisy</body></html>", headers={"Set-Cookie": f"JSESSIONID={state.new_session()}; Path=/"})
+        elif path == "/Shibboleth.sso/Login":
+            self._send(302, "", headers={"Location": f"{state.base_url}/idp/profile/SAML2/Redirect/SSO?execution=e1s1&target={query.get('target', '')}"})
+        elif path == "/idp/profile/SAML2/Redirect/SSO" and method == "GET":
+            self._send(200, _form("/idp/profile/SAML2/Redirect/SSO?execution=e1s2", {"csrf_token": secrets.token_hex(8), "RelayState": query.get("target", "")}))
+        elif path == "/idp/profile/SAML2/Redirect/SSO" and query.get("execution") == "e1s2":
+            form = self._form()
+            self._send(200, _form("/idp/profile/SAML2/Redirect/SSO?execution=e1s3", {
+                "csrf_token": form.get("csrf_token", ""), "RelayState": form.get("RelayState", ""),
+                "j_username": "", "j_password": "", "_eventId_authn/SPNEGO": "",
+            }))
+        elif path == "/idp/profile/SAML2/Redirect/SSO" and query.get("execution") == "e1s3":
+            form = self._form()
+            if not form.get("j_username") or not form.get("j_password"):
+                self._send(401, "<html><body>Invalid credentials</body></html>")
+                return
+            self._send(200, _form(f"{state.base_url}/Shibboleth.sso/SAML2/POST", {
+                "RelayState": form.get("RelayState", ""), "SAMLResponse": secrets.token_hex(32),
+            }))
+        elif path == "/Shibboleth.sso/SAML2/POST":
+            form = self._form()
+            state.authenticate(self._cookie(), "employee" in form.get("RelayState", ""))
+            self._send(200, "<html><body>Welcome</body></html>")
+        elif path == "/servlet/schema.LokalSchema":
+            form = self._form() if method == "POST" else {}
+            if not state.is_signed_in(self._cookie()):
+                self._send(200, LOGIN_PAGE)
+            elif method == "GET":
+                self._send(200, "<html><body>Room schedule</body></html>")
+            else:
+                date = f"{form.get('year')}-{form.get('month')}-{form.get('day')}"
+                self._send(200, state.schedule_page(date, form.get("lokalkategori", "")))
+        elif path == "/common/schema/bokning.jspa" and method == "POST":
+            form = self._form()
+            if not state.is_signed_in(self._cookie()):
+                self._send(200, LOGIN_PAGE)
+                return
+            error = None
+            if not form.get("laggTillPersonID"):
+                if not form.get("namn"):
+                    error = "You have to enter a title."
+                else:
+                    error = state.book(
+                        f"{form.get('year')}-{form.get('month')}-{form.get('day')}", form.get("lokalkategoriID", ""), form.get("lokalID", ""),
+                        int(form.get("from", "0")[:2]), int(form.get("to", "0")[:2]), form["namn"],
+                    )
+            if error is not None:
+                self._send(200, f"<html><body><ul class=\"errorMessage\"><li><span>{html.escape(error)}</span></li></ul></body></html>")
+            else:
+                self._send(200, "<html><body>Booking saved</body></html>")
+        elif path.startswith("/llm/") and method == "POST":
+            self._llm(json.loads(self._body() or b"{}"))
+        else:
+            self._body()
+            self._send(404, "<html><body>Not found</body></html>")
+
+    def _llm(self, request: Dict):
+        state = self.server_state
+        state.delay(state.config.llm_latency)
+        completion = canned_completion(request.get("messages", []))
+        if not request.get("stream"):
+            self._send(200, json.dumps({"result": {"response": completion}, "success": True}), "application/json")
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+        for i in range(0, len(completion), 4):
+            self.wfile.write(f"data: {json.dumps({'response': completion[i:i + 4]})}\n\n".encode("utf-8"))
+            self.wfile.flush()
+            if state.config.llm_token_delay > 0:
+                time.sleep(state.config.llm_token_delay)
+        self.wfile.write(b"data: [DONE]\n\n")
+
+    def do_GET(self): # pylint: disable=invalid-name
+        self._handle("GET")
+
+    def do_POST(self): # pylint: disable=invalid-name
+        self._handle("POST")
+
+    def do_HEAD(self): # pylint: disable=invalid-name
+        self.send_response(200)
+        self.send_header("Date", self.date_time_string())
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args): # pylint: disable=redefined-builtin
+        logging.debug("%s - %s", self.address_string(), format % args)
+
+
+def add_config_arguments(parser: argparse.ArgumentParser):
+    defaults = StandInConfig()
+    parser.add_argument("--daisy-latency", type=float, default=defaults.daisy_latency, help="mean seconds per Daisy request")
+    parser.add_argument("--idp-latency", type=float, default=defaults.idp_latency, help="mean seconds per login step")
+    parser.add_argument("--llm-latency", type=float, default=defaults.llm_latency, help="mean seconds until the first LLM token")
+    parser.add_argument("--llm-token-delay", type=float, default=defaults.llm_token_delay, help="seconds between streamed LLM tokens")
+    parser.add_argument("--jitter", type=float, default=defaults.jitter, help="relative latency variation")
+    parser.add_argument("--error-rate", type=float, default=defaults.error_rate, help="share of requests answered with 503")
+    parser.add_argument("--session-ttl", type=float, default=defaults.session_ttl, help="seconds a Daisy session stays signed in")
+    parser.add_argument("--occupancy", type=float, default=defaults.occupancy, help="share of room hours already booked")
+    parser.add_argument("--seed", type=int, default=defaults.seed)
+
+
+def config_from_arguments(args: argparse.Namespace) -> StandInConfig:
+    return StandInConfig(
+        daisy_latency=args.daisy_latency,
+        idp_latency=args.idp_latency,
+        llm_latency=args.llm_latency,
+        llm_token_delay=args.llm_token_delay,
+        jitter=args.jitter,
+        error_rate=args.error_rate,
+        session_ttl=args.session_ttl,
+        occupancy=args.occupancy,
+        seed=args.seed,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stand-in Daisy, IdP and LLM server for local load tests")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8090)
+    add_config_arguments(parser)
+    args = parser.parse_args()
+
+    stand_in = StandIn(config_from_arguments(args))
+    stand_in.start(args.host, args.port)
+    print("Serving, point the bot at it with:")
+    for key, value in stand_in.env().items():
+        print(f"export {key}={value}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        stand_in.stop()
+
+
+if __name__ == "__main__":
+    main()
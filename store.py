@@ -0,0 +1,126 @@
+"""
+A discord bot capable of booking student group rooms and staff rooms via Daisy (administration tool for Department of Computer and Systems Sciences at Stockholm University)
+Copyright (C) 2024 Edwin Sundberg
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import json
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+import attr
+
+
+@attr.s(auto_attribs=True, frozen=True, slots=True)
+class Turn:
+    message_id: int
+    parent_id: Optional[int]
+    role: str
+    content: str
+    requests: List[Dict[str, Any]]
+
+    def to_history(self) -> Dict[str, str]:
+        if self.role == "assistant":
+            return {"role": "assistant", "content": json.dumps({"conversations_response": self.content, "requests": self.requests})}
+        return {"role": "user", "content": self.content}
+
+
+class ConversationStore:
+    """
+    Conversation turns keyed by discord message id
+
+    Keeps at most `max_turns` turns in memory (LRU), if `path` is given turns are also persisted to SQLite
+    so threads survive restarts and evictions.
+    """
+    def __init__(self, max_turns: int = 2048, path: Optional[str] = None):
+        self.max_turns = max(max_turns, 1)
+        self._turns: "OrderedDict[int, Turn]" = OrderedDict()
+        self._lock = threading.Lock()
+        # Separate, so remembering a turn on the event loop never waits for SQLite
+        self._db_lock = threading.Lock()
+        self._db: Optional[sqlite3.Connection] = None
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS turns ("
+                "message_id INTEGER PRIMARY KEY, parent_id INTEGER, role TEXT NOT NULL, content TEXT NOT NULL, requests TEXT NOT NULL)"
+            )
+            self._db.commit()
+
+    def _remember(self, turn: Turn):
+        self._turns[turn.message_id] = turn
+        self._turns.move_to_end(turn.message_id)
+        while len(self._turns) > self.max_turns:
+            self._turns.popitem(last=False)
+
+    def add(self, turn: Turn):
+        self.remember(turn)
+        self.persist(turn)
+
+    def remember(self, turn: Turn):
+        """Only the in-memory part of add, cheap enough for the event loop"""
+        with self._lock:
+            self._remember(turn)
+
+    def persist(self, turn: Turn):
+        """Only the SQLite part of add, blocking"""
+        if self._db is None:
+            return
+        with self._db_lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO turns (message_id, parent_id, role, content, requests) VALUES (?, ?, ?, ?, ?)",
+                (turn.message_id, turn.parent_id, turn.role, turn.content, json.dumps(turn.requests)),
+            )
+            self._db.commit()
+
+    def get(self, message_id: int) -> Optional[Turn]:
+        with self._lock:
+            turn = self._turns.get(message_id)
+            if turn is not None:
+                self._turns.move_to_end(message_id)
+                return turn
+        if self._db is None:
+            return None
+        with self._db_lock:
+            row = self._db.execute(
+                "SELECT message_id, parent_id, role, content, requests FROM turns WHERE message_id = ?", (message_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        turn = Turn(row[0], row[1], row[2], row[3], json.loads(row[4]))
+        self.remember(turn)
+        return turn
+
+    def thread(self, message_id: int, max_depth: int = 100) -> Tuple[List[Turn], Optional[int]]:
+        """
+        Walks the reply chain ending in message_id
+
+        Returns:
+            The known turns, oldest first, and the id of the first message that is not in the store (None if the chain is complete)
+        """
+        turns: List[Turn] = []
+        next_id: Optional[int] = message_id
+        while next_id is not None and len(turns) < max_depth:
+            turn = self.get(next_id)
+            if turn is None:
+                break
+            turns.append(turn)
+            next_id = turn.parent_id
+        turns.reverse()
+        return turns, next_id if len(turns) < max_depth else None
+
+    def __len__(self) -> int:
+        return len(self._turns)
@@ -0,0 +1,225 @@
+"""
+A discord bot capable of booking student group rooms and staff rooms via Daisy (administration tool for Department of Computer and Systems Sciences at Stockholm University)
+Copyright (C) 2024 Edwin Sundberg
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import datetime
+import json
+import re
+from typing import Any, Dict, List
+
+from schemas import RoomCategory, RoomRestriction
+
+# "repaired": outputs that strict parsing would have rejected, i.e. LLM round trips saved
+# "unrecoverable": outputs that still had to be retried
+COUNTERS: Dict[str, int] = {"strict": 0, "repaired": 0, "unrecoverable": 0}
+
+LITERALS = {"True": "true", "False": "false", "None": "null", "true": "true", "false": "false", "null": "null"}
+
+# Unicode aware, the model answers in Swedish too
+IDENTIFIER_PATTERN = re.compile(r"[^\W\d]\w*")
+
+
+class StructuredOutputError(ValueError):
+    """Raised when the model output can not be turned into valid requests, `errors` holds one entry per offending field"""
+    def __init__(self, message: str, errors: List[str]):
+        super().__init__(f"{message}: {'; '.join(errors)}" if errors else message)
+        self.errors = errors
+
+
+def find_outermost_object(text: str) -> str:
+    """Returns the first balanced {...} in text, ignoring any prose around it"""
+    start = text.find("{")
+    if start < 0:
+        raise StructuredOutputError("No JSON object found", [])
+    depth = 0
+    quote = None
+    escape = False
+    for i in range(start, len(text)):
+        char = text[i]
+        if quote is not None:
+            if escape:
+                escape = False
+            elif char == "\\":
+                escape = True
+            elif char == quote:
+                quote = None
+            continue
+        if char in "\"'":
+            quote = char
+        elif char in "{[":
+            depth += 1
+        elif char in "}]":
+            depth -= 1
+            if depth == 0:
+                return text[start:i + 1]
+    raise StructuredOutputError("Unterminated JSON object", [])
+
+
+def repair_json(text: str) -> str:
+    """
+    Rewrites common model mistakes: single quoted strings, bare keys, Python literals and trailing commas
+
+    Raises:
+        StructuredOutputError: If a bare word can not be read as an identifier
+    """
+    out: List[str] = []
+    i = 0
+    while i < len(text):
+        char = text[i]
+        if char in "\"'":
+            j = i + 1
+            content: List[str] = []
+            while j < len(text) and text[j] != char:
+                if text[j] == "\\" and j + 1 < len(text):
+                    content.append(text[j:j + 2])
+                    j += 2
+                    continue
+                content.append(text[j])
+                j += 1
+            value = "".join(content)
+            if char == "'":
+                value = value.replace("\\'", "'").replace('"', '\\"')
+            out.append(f'"{value}"')
+            i = j + 1
+        elif char == ",":
+            j = i + 1
+            while j < len(text) and text[j].isspace():
+                j += 1
+            if j < len(text) and text[j] in "}]":
+                i += 1
+                continue
+            out.append(char)
+            i += 1
+        elif char.isalpha() or char == "_":
+            match = IDENTIFIER_PATTERN.match(text, i)
+            if match is None:
+                raise StructuredOutputError("Invalid bare word", [f"at {i}: {text[i:i + 20]!r}"])
+            word = match.group(0)
+            j = i + len(word)
+            while j < len(text) and text[j].isspace():
+                j += 1
+            if j < len(text) and text[j] == ":":
+                out.append(f'"{word}"')
+            else:
+                out.append(LITERALS.get(word, word))
+            i += len(word)
+        else:
+            out.append(char)
+            i += 1
+    return "".join(out)
+
+
+def parse_response(text: str) -> Dict[str, Any]:
+    """
+    Extracts the response object from model output, repairing it if needed
+
+    Raises:
+        StructuredOutputError: If no object could be recovered
+    """
+    try:
+        out_json = json.loads(text.lstrip())
+        if isinstance(out_json, dict):
+            COUNTERS["strict"] += 1
+            return out_json
+    except json.JSONDecodeError:
+        pass
+
+    try:
+        out_json = json.loads(repair_json(find_outermost_object(text)), strict=False)
+    except json.JSONDecodeError as e:
+        COUNTERS["unrecoverable"] += 1
+        raise StructuredOutputError("Invalid JSON", [str(e)]) from e
+    except StructuredOutputError:
+        COUNTERS["unrecoverable"] += 1
+        raise
+    if not isinstance(out_json, dict):
+        COUNTERS["unrecoverable"] += 1
+        raise StructuredOutputError("Expected JSON object", [])
+    COUNTERS["repaired"] += 1
+    return out_json
+
+
+def _as_int(value: Any) -> Any:
+    if isinstance(value, str) and value.strip().isdigit():
+        return int(value.strip())
+    return value
+
+
+def _validate_hours(entry: Dict[str, Any], path: str, errors: List[str]):
+    entry["from_time"] = _as_int(entry.get("from_time"))
+    entry["duration"] = _as_int(entry.get("duration"))
+    if not isinstance(entry["from_time"], int) or not 4 <= entry["from_time"] <= 23:
+        errors.append(f"{path}.from_time: expected int 4 to 23, got {entry['from_time']!r}")
+    if not isinstance(entry["duration"], int) or entry["duration"] < 1:
+        errors.append(f"{path}.duration: expected positive int, got {entry['duration']!r}")
+
+
+def validate_requests(raw_requests: Any) -> List[Dict[str, Any]]:
+    """
+    Validates (and where unambiguous, coerces) raw requests against what RoomRequest.from_json accepts
+
+    Raises:
+        StructuredOutputError: With one error per invalid field
+    """
+    if not isinstance(raw_requests, list):
+        raise StructuredOutputError("Invalid requests", [f"requests: expected list, got {type(raw_requests).__name__}"])
+
+    errors: List[str] = []
+    valid_categories = {c.value for c in RoomCategory}
+    valid_filters = {r.value for r in RoomRestriction}
+    requests = []
+    for i, raw in enumerate(raw_requests):
+        path = f"requests[{i}]"
+        if not isinstance(raw, dict):
+            errors.append(f"{path}: expected object")
+            continue
+        request = dict(raw)
+        try:
+            datetime.datetime.strptime(str(request.get("date")), "%Y-%m-%d")
+        except ValueError:
+            errors.append(f"{path}.date: expected YYYY-MM-DD, got {request.get('date')!r}")
+        _validate_hours(request, path, errors)
+        if request.get("title") is not None and not isinstance(request["title"], str):
+            request["title"] = str(request["title"])
+
+        breaks = request.get("breaks") or []
+        if not isinstance(breaks, list):
+            errors.append(f"{path}.breaks: expected list")
+            breaks = []
+        request["breaks"] = [dict(b) if isinstance(b, dict) else b for b in breaks]
+        for j, break_ in enumerate(request["breaks"]):
+            if not isinstance(break_, dict):
+                errors.append(f"{path}.breaks[{j}]: expected object")
+                continue
+            _validate_hours(break_, f"{path}.breaks[{j}]", errors)
+
+        filters = request.get("room_filters") or []
+        if not isinstance(filters, list):
+            filters = [filters]
+        request["room_filters"] = [_as_int(f) for f in filters]
+        for j, room_filter in enumerate(request["room_filters"]):
+            if room_filter not in valid_filters:
+                errors.append(f"{path}.room_filters[{j}]: unknown filter {room_filter!r}")
+
+        if "room_category" in request and request["room_category"] is not None:
+            request["room_category"] = _as_int(request["room_category"])
+            if request["room_category"] != 0 and request["room_category"] not in valid_categories:
+                errors.append(f"{path}.room_category: unknown category {request['room_category']!r}")
+        requests.append(request)
+
+    if errors:
+        raise StructuredOutputError("Invalid requests", errors)
+    return requests
@@ -0,0 +1,218 @@
+"""
+A discord bot capable of booking student group rooms and staff rooms via Daisy (administration tool for Department of Computer and Systems Sciences at Stockholm University)
+Copyright (C) 2024 Edwin Sundberg
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import asyncio
+import contextlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import AsyncIterator, Deque, Dict, List, Optional
+
+import attr
+
+from daisy import Daisy
+from scheduler import ROOM_PREFERENCE_ORDER
+from schemas import Room, RoomRestriction
+
+
+@attr.s(auto_attribs=True, frozen=True, slots=True)
+class Preferences:
+    default_title: Optional[str] = None
+    # Applied when a request has no room filters of its own
+    room_filters: List[RoomRestriction] = attr.Factory(list)
+    # Rooms tried first, the rest follow in the standard preference order
+    preferred_rooms: List[Room] = attr.Factory(list)
+
+    def preference_order(self) -> Optional[List[Room]]:
+        if not self.preferred_rooms:
+            return None
+        return self.preferred_rooms + [room for room in ROOM_PREFERENCE_ORDER if room not in self.preferred_rooms]
+
+    @classmethod
+    def from_json(cls, data: Dict) -> "Preferences":
+        return cls(
+            default_title=data.get("default_title"),
+            room_filters=[RoomRestriction(int(r)) for r in data.get("room_filters", [])],
+            preferred_rooms=[Room[name] for name in data.get("preferred_rooms", [])],
+        )
+
+
+@attr.s(auto_attribs=True, frozen=True, slots=True)
+class UserProfile:
+    discord_id: int
+    su_username: str = attr.ib(repr=False)
+    su_password: str = attr.ib(repr=False)
+    search_term: str
+    lagg_till_person_id: int
+    staff: bool = False
+    preferences: Preferences = attr.Factory(Preferences)
+
+    @classmethod
+    def from_json(cls, data: Dict) -> "UserProfile":
+        return cls(
+            discord_id=int(data["discord_id"]),
+            su_username=data["su_username"],
+            su_password=data["su_password"],
+            search_term=data["search_term"],
+            lagg_till_person_id=int(data["lagg_till_person_id"]),
+            staff=bool(data.get("staff", False)),
+            preferences=Preferences.from_json(data.get("preferences", {})),
+        )
+
+
+def load_profiles() -> Dict[int, UserProfile]:
+    """
+    Loads the authorised users from USERS_FILE (a JSON list of profiles)
+
+    Without USERS_FILE the single owner configured through the original environment variables is used.
+    """
+    path = os.getenv("USERS_FILE")
+    if path:
+        with open(path, encoding="utf-8") as file:
+            profiles = [UserProfile.from_json(entry) for entry in json.load(file)]
+        return {profile.discord_id: profile for profile in profiles}
+
+    owner = UserProfile(
+        discord_id=int(os.getenv("DISCORD_OWNER_ID")), # type: ignore
+        su_username=os.getenv("SU_USERNAME"), # type: ignore
+        su_password=os.getenv("SU_PASSWORD"), # type: ignore
+        search_term=os.getenv("SECOND_USER_SEARCH_TERM"), # type: ignore
+        lagg_till_person_id=int(os.getenv("SECOND_USER_ID")), # type: ignore
+        staff=bool(int(os.getenv("SU_STAFF", "0"))),
+    )
+    return {owner.discord_id: owner}
+
+
+class SessionPool:
+    """
+    Bounded pool of Daisy clients, one per user
+
+    The least recently used client is evicted when the pool is full, clients idle for longer than `idle_timeout` seconds are evicted by `evict_idle`.
+    An evicted user simply signs in again on their next request.
+    """
+    def __init__(self, max_sessions: int = 8, idle_timeout: int = 3600):
+        self.max_sessions = max(max_sessions, 1)
+        self.idle_timeout = idle_timeout
+        self._sessions: "OrderedDict[int, Daisy]" = OrderedDict()
+        self._last_used: Dict[int, float] = {}
+        self._lock = threading.Lock()
+        self.evictions = 0
+
+    def get(self, profile: UserProfile) -> Daisy:
+        with self._lock:
+            daisy = self._sessions.get(profile.discord_id)
+            if daisy is None:
+                daisy = Daisy(
+                    profile.su_username,
+                    profile.su_password,
+                    profile.search_term,
+                    profile.lagg_till_person_id,
+                    staff=profile.staff,
+                )
+                self._sessions[profile.discord_id] = daisy
+            self._sessions.move_to_end(profile.discord_id)
+            self._last_used[profile.discord_id] = time.monotonic()
+            while len(self._sessions) > self.max_sessions:
+                evicted, _ = self._sessions.popitem(last=False)
+                del self._last_used[evicted]
+                self.evictions += 1
+            return daisy
+
+    def evict_idle(self):
+        cutoff = time.monotonic() - self.idle_timeout
+        with self._lock:
+            for discord_id in [i for i, used in self._last_used.items() if used < cutoff]:
+                del self._sessions[discord_id]
+                del self._last_used[discord_id]
+                self.evictions += 1
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+
+class FairScheduler:
+    """
+    Limits concurrent work globally and per user, handing out free slots round-robin between users that are waiting
+
+    A user sending many messages at once can therefore not starve everyone else.
+    """
+    def __init__(self, max_concurrent: int = 4, per_user: int = 1):
+        self.max_concurrent = max(max_concurrent, 1)
+        self.per_user = max(per_user, 1)
+        self._active = 0
+        self._active_per_user: Dict[int, int] = {}
+        self._waiting: Dict[int, Deque["asyncio.Future[None]"]] = {}
+        self._order: Deque[int] = deque()
+
+    def _dispatch(self):
+        checked = 0
+        while self._active < self.max_concurrent and self._order and checked < len(self._order):
+            user_id = self._order[0]
+            self._order.rotate(-1)
+            waiters = self._waiting.get(user_id)
+            if not waiters:
+                self._order.remove(user_id)
+                self._waiting.pop(user_id, None)
+                checked = 0
+                continue
+            if self._active_per_user.get(user_id, 0) >= self.per_user:
+                checked += 1
+                continue
+            waiter = waiters.popleft()
+            if waiter.done():
+                continue
+            waiter.set_result(None)
+            self._active += 1
+            self._active_per_user[user_id] = self._active_per_user.get(user_id, 0) + 1
+            checked = 0
+
+    def _release(self, user_id: int):
+        self._active -= 1
+        self._active_per_user[user_id] -= 1
+        if not self._active_per_user[user_id]:
+            del self._active_per_user[user_id]
+        self._dispatch()
+
+    @property
+    def waiting(self) -> int:
+        return sum(len(waiters) for waiters in self._waiting.values())
+
+    @property
+    def active(self) -> int:
+        return self._active
+
+    @contextlib.asynccontextmanager
+    async def slot(self, user_id: int) -> AsyncIterator[None]:
+        waiter: "asyncio.Future[None]" = asyncio.get_running_loop().create_future()
+        if user_id not in self._waiting:
+            self._waiting[user_id] = deque()
+            self._order.append(user_id)
+        self._waiting[user_id].append(waiter)
+        self._dispatch()
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # Got the slot just as we were cancelled
+                self._release(user_id)
+            raise
+        try:
+            yield
+        finally:
+            self._release(user_id)
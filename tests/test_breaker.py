@@ -0,0 +1,115 @@
+import random
+import unittest
+
+from breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, CircuitOpenError
+
+
+class _Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class _MaxJitter(random.Random):
+    """Always the full backoff, so the open periods are exact"""
+    def uniform(self, a: float, b: float) -> float:
+        return b
+
+
+def _fail():
+    raise ConnectionError("down")
+
+
+class CircuitBreakerTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = _Clock()
+        self.breaker = CircuitBreaker("test", window=60, min_calls=4, failure_ratio=0.5, slow_call=10, base_backoff=5, max_backoff=15, clock=self.clock, rng=_MaxJitter())
+
+    def _fail_calls(self, count: int):
+        for _ in range(count):
+            with self.assertRaises(ConnectionError):
+                self.breaker.call(_fail)
+
+    def _open(self):
+        self.breaker.call(lambda: None)
+        self.breaker.call(lambda: None)
+        self._fail_calls(2)
+        self.assertEqual(self.breaker.state, OPEN)
+
+    def test_stays_closed_below_min_calls_and_ratio(self):
+        self._fail_calls(3)
+        self.assertEqual(self.breaker.state, CLOSED)
+        self.clock.now += 61
+        self._fail_calls(1)
+        for _ in range(3):
+            self.breaker.call(lambda: None)
+        self.assertEqual(self.breaker.state, CLOSED)
+
+    def test_opens_on_failure_ratio_and_fails_fast(self):
+        self._open()
+        with self.assertRaises(CircuitOpenError) as raised:
+            self.breaker.call(lambda: None)
+        self.assertAlmostEqual(raised.exception.retry_in, 5)
+        self.assertEqual(self.breaker.stats()["rejected"], 1)
+
+    def test_slow_calls_count_as_failures(self):
+        def slow():
+            self.clock.now += 11
+        for _ in range(4):
+            self.breaker.call(slow)
+        self.assertEqual(self.breaker.state, OPEN)
+
+    def test_failures_outside_the_window_are_forgotten(self):
+        self._fail_calls(3)
+        self.clock.now += 61
+        self.breaker.call(lambda: None)
+        self.assertEqual(self.breaker.state, CLOSED)
+
+    def test_half_open_probe_success_closes(self):
+        self._open()
+        self.clock.now += 5
+        calls = []
+
+        def probe():
+            self.assertEqual(self.breaker.state, HALF_OPEN)
+            # Only the probe is let through while half-open
+            with self.assertRaises(CircuitOpenError):
+                self.breaker.call(lambda: None)
+            calls.append("probe")
+
+        self.breaker.call(probe)
+        self.assertEqual(calls, ["probe"])
+        self.assertEqual(self.breaker.state, CLOSED)
+        # The backoff starts over
+        self._open()
+        with self.assertRaises(CircuitOpenError) as raised:
+            self.breaker.call(lambda: None)
+        self.assertAlmostEqual(raised.exception.retry_in, 5)
+
+    def test_half_open_probe_failure_reopens_with_doubled_backoff(self):
+        self._open()
+        for backoff in (10, 15, 15):
+            self.clock.now += 15
+            self._fail_calls(1)
+            self.assertEqual(self.breaker.state, OPEN)
+            with self.assertRaises(CircuitOpenError) as raised:
+                self.breaker.call(lambda: None)
+            self.assertAlmostEqual(raised.exception.retry_in, backoff)
+        self.assertEqual(self.breaker.stats()["opened"], 4)
+
+    def test_ignored_exceptions_do_not_count(self):
+        breaker = CircuitBreaker("test", min_calls=1, is_failure=lambda e: not isinstance(e, ValueError), clock=self.clock)
+
+        def invalid():
+            raise ValueError("bad input")
+
+        for _ in range(3):
+            with self.assertRaises(ValueError):
+                breaker.call(invalid)
+        self.assertEqual(breaker.state, CLOSED)
+
+
+if __name__ == "__main__":
+    unittest.main()
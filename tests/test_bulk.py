@@ -0,0 +1,90 @@
+import datetime
+import os
+import tempfile
+import unittest
+
+from bulk import BulkEntry, RejectedEntry, build_report, exit_status, read_csv, read_ics
+from schemas import BookingSlot, Room, RoomCategory, RoomRequest, RoomTime
+
+ICS = """BEGIN:VCALENDAR
+BEGIN:VEVENT
+UID:whole
+DTSTART;TZID=Europe/Stockholm:20240506T130000
+DTEND;TZID=Europe/Stockholm:20240506T150000
+SUMMARY:Seminar
+END:VEVENT
+BEGIN:VEVENT
+UID:half-hour
+DTSTART;TZID=Europe/Stockholm:20240506T133000
+DTEND;TZID=Europe/Stockholm:20240506T140000
+END:VEVENT
+BEGIN:VEVENT
+UID:half-past-end
+DTSTART;TZID=Europe/Stockholm:20240506T130000
+DTEND;TZID=Europe/Stockholm:20240506T143000
+END:VEVENT
+BEGIN:VEVENT
+UID:all-day
+DTSTART;VALUE=DATE:20240507
+DTEND;VALUE=DATE:20240508
+END:VEVENT
+BEGIN:VEVENT
+UID:no-end
+DTSTART;TZID=Europe/Stockholm:20240506T130000
+END:VEVENT
+END:VCALENDAR
+"""
+
+CSV = """date,from,to,duration,title
+2024-05-06,10,12,,Seminar
+2024-05-06,10:30,12,,
+2024-05-06,10,,,
+2024-05-06,12,10,,
+not-a-date,10,12,,
+2024-05-06,10,,2,
+"""
+
+
+class BulkInputTest(unittest.TestCase):
+    def _write(self, suffix: str, content: str) -> str:
+        file = tempfile.NamedTemporaryFile("w", suffix=suffix, delete=False, encoding="utf-8")
+        with file:
+            file.write(content)
+        self.addCleanup(os.remove, file.name)
+        return file.name
+
+    def test_ics_rejects_partial_hours_and_all_day_events(self):
+        path = self._write(".ics", ICS)
+        entries, rejected = read_ics(path, RoomCategory.BOOKABLE_GROUP_ROOMS, [])
+        self.assertEqual([(entry.request.from_time, entry.request.duration) for entry in entries], [(RoomTime(13), 2)])
+        self.assertEqual([entry.source for entry in rejected], [f"{path}:{uid}" for uid in ("half-hour", "half-past-end", "all-day", "no-end")])
+
+    def test_csv_rejects_malformed_rows(self):
+        path = self._write(".csv", CSV)
+        entries, rejected = read_csv(path, RoomCategory.BOOKABLE_GROUP_ROOMS, [])
+        self.assertEqual([entry.source for entry in entries], [f"{path}:2", f"{path}:7"])
+        self.assertEqual([entry.source for entry in rejected], [f"{path}:{line}" for line in range(3, 7)])
+
+
+class ExitStatusTest(unittest.TestCase):
+    def setUp(self):
+        request = RoomRequest(None, datetime.date(2024, 5, 6), RoomTime(10), 2, [], [], RoomCategory.BOOKABLE_GROUP_ROOMS)
+        self.entries = [BulkEntry("a.csv:2", request)]
+        self.full = [[BookingSlot(Room.G10_1, RoomTime(10), RoomTime(12))]]
+        self.partial = [[BookingSlot(Room.G10_1, RoomTime(10), RoomTime(11))]]
+
+    def test_complete_run_succeeds(self):
+        self.assertEqual(exit_status(build_report(self.entries, self.full, None)), 0)
+        self.assertEqual(exit_status(build_report(self.entries, self.full, [[None]])), 0)
+
+    def test_partial_plan_fails(self):
+        self.assertEqual(exit_status(build_report(self.entries, self.partial, None)), 1)
+        self.assertEqual(exit_status(build_report(self.entries, [[]], [[]])), 1)
+
+    def test_failed_booking_and_rejected_input_fail(self):
+        self.assertEqual(exit_status(build_report(self.entries, self.full, [["Room taken"]])), 1)
+        self.assertEqual(exit_status(build_report(self.entries, self.full, [[None]], [RejectedEntry("a.csv:3", "ValueError: bad")])), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
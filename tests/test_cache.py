@@ -0,0 +1,79 @@
+import datetime
+import unittest
+
+from cache import TIMEZONE, DailyTTLCache, completion_key
+
+
+class _Clock:
+    def __init__(self, now: datetime.datetime):
+        self.now = now
+
+    def __call__(self) -> datetime.datetime:
+        return self.now
+
+
+def _at(hour: int, minute: int = 0, day: int = 6) -> datetime.datetime:
+    return TIMEZONE.localize(datetime.datetime(2024, 5, day, hour, minute))
+
+
+class DailyTTLCacheTest(unittest.TestCase):
+    def test_expires_after_ttl(self):
+        clock = _Clock(_at(10))
+        cache: DailyTTLCache[str] = DailyTTLCache(ttl=600, clock=clock)
+        cache.put("a", "value")
+        clock.now = _at(10, 9)
+        self.assertEqual(cache.get("a"), "value")
+        clock.now = _at(10, 10)
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(len(cache), 0)
+
+    def test_expires_at_end_of_day(self):
+        clock = _Clock(_at(23, 50))
+        cache: DailyTTLCache[str] = DailyTTLCache(ttl=3600, clock=clock)
+        cache.put("tomorrow", "2024-05-07")
+        clock.now = _at(23, 59)
+        self.assertEqual(cache.get("tomorrow"), "2024-05-07")
+        # Still well within the ttl, but "tomorrow" means something else now
+        clock.now = _at(0, 0, day=7)
+        self.assertIsNone(cache.get("tomorrow"))
+        self.assertEqual(cache.stats()["evictions"], 1)
+
+    def test_day_boundary_is_local_time(self):
+        # 21:30 UTC is 23:30 in Stockholm, so the day ends at 22:00 UTC rather than midnight UTC
+        clock = _Clock(datetime.datetime(2024, 5, 6, 21, 30, tzinfo=datetime.timezone.utc))
+        cache: DailyTTLCache[str] = DailyTTLCache(ttl=3600, clock=clock)
+        cache.put("a", "value")
+        clock.now = datetime.datetime(2024, 5, 6, 22, 1, tzinfo=datetime.timezone.utc)
+        self.assertIsNone(cache.get("a"))
+
+    def test_least_recently_used_is_evicted(self):
+        cache: DailyTTLCache[int] = DailyTTLCache(max_entries=2, clock=_Clock(_at(10)))
+        cache.put("a", 1)
+        cache.put("b", 2)
+        self.assertEqual(cache.get("a"), 1)
+        cache.put("c", 3)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual((cache.get("a"), cache.get("c")), (1, 3))
+        self.assertEqual(len(cache), 2)
+
+    def test_non_positive_size_disables_the_cache(self):
+        for size in (0, -1):
+            with self.subTest(size=size):
+                cache: DailyTTLCache[int] = DailyTTLCache(max_entries=size, clock=_Clock(_at(10)))
+                cache.put("a", 1)
+                self.assertIsNone(cache.get("a"))
+                self.assertEqual(len(cache), 0)
+                self.assertEqual(cache.stats()["hits"], 0)
+
+
+class CompletionKeyTest(unittest.TestCase):
+    def test_whitespace_is_normalised(self):
+        self.assertEqual(
+            completion_key("m", [{"role": "user", "content": "book  a room\n"}]),
+            completion_key("m", [{"role": "user", "content": "book a room"}]),
+        )
+        self.assertNotEqual(completion_key("m", [{"role": "user", "content": "a"}]), completion_key("n", [{"role": "user", "content": "a"}]))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,90 @@
+import datetime
+import unittest
+
+import pytz
+
+from fastpath import parse_message
+from schemas import RoomRestriction
+
+# A Monday morning
+NOW = pytz.timezone("Europe/Stockholm").localize(datetime.datetime(2024, 5, 6, 9, 30))
+
+
+def _request(message: str, **kwargs):
+    result = parse_message(message, now=NOW, **kwargs)
+    assert result is not None, message
+    return result.requests[0]
+
+
+class RelativeDatesTest(unittest.TestCase):
+    def test_today_tomorrow_and_weekdays(self):
+        self.assertEqual(_request("today 13-15")["date"], "2024-05-06")
+        self.assertEqual(_request("tomorrow 13-15")["date"], "2024-05-07")
+        self.assertEqual(_request("friday 13-15")["date"], "2024-05-10")
+        # The weekday of today is today, not next week
+        self.assertEqual(_request("monday 13-15")["date"], "2024-05-06")
+
+    def test_no_date_means_today(self):
+        self.assertEqual(_request("book a room 13-15")["date"], "2024-05-06")
+
+    def test_explicit_date(self):
+        self.assertEqual(_request("2024-05-08 13-15")["date"], "2024-05-08")
+        self.assertEqual(_request("2024-5-8 13-15")["date"], "2024-05-08")
+
+
+class HoursTest(unittest.TestCase):
+    def test_time_range_and_duration(self):
+        request = _request("tomorrow 10-12")
+        self.assertEqual((request["from_time"], request["duration"]), (10, 2))
+        request = _request("tomorrow 08:00 - 12:00")
+        self.assertEqual((request["from_time"], request["duration"]), (8, 4))
+
+    def test_response_describes_the_booking(self):
+        result = parse_message('tomorrow 10-12 "Study group"', now=NOW)
+        self.assertEqual(result.response, "Study group on Tuesday 2024-05-07, 10:00-12:00") # type: ignore
+        self.assertEqual(result.requests[0]["title"], "Study group") # type: ignore
+
+
+class FiltersTest(unittest.TestCase):
+    def test_filter_words(self):
+        self.assertEqual(_request("tomorrow 10-12 g10")["room_filters"], [RoomRestriction.G10_ROOM.value])
+        self.assertEqual(_request("tomorrow 10-12 g5 green area")["room_filters"], [RoomRestriction.G5_ROOM.value, RoomRestriction.GREEN_AREA.value])
+        self.assertNotIn("room_filters", _request("tomorrow 10-12"))
+
+    def test_conflicting_filters_fall_through(self):
+        self.assertIsNone(parse_message("tomorrow 10-12 g10 g5", now=NOW))
+        self.assertIsNone(parse_message("tomorrow 10-12 green red", now=NOW))
+
+
+class FallThroughTest(unittest.TestCase):
+    def test_ambiguous_messages_are_left_to_the_llm(self):
+        for message in (
+            "tomorrow 10-12 and friday 13-15",
+            "tomorrow 10-12 with a break at 11",
+            "tomorrow afternoon",
+            "tomorrow 10-12 10-12",
+            'tomorrow 10-12 "a" "b"',
+            "tomorrow friday 10-12",
+            "can you find something quiet tomorrow 10-12",
+        ):
+            with self.subTest(message=message):
+                self.assertIsNone(parse_message(message, now=NOW))
+
+    def test_invalid_hours_and_dates_fall_through(self):
+        for message in ("tomorrow 12-10", "tomorrow 10-16", "tomorrow 2-4", "2024-02-30 10-12", "today 8-10", "today 9-10"):
+            with self.subTest(message=message):
+                self.assertIsNone(parse_message(message, now=NOW))
+
+    def test_unbookable_dates_fall_through(self):
+        for message in ("saturday 10-12", "2024-05-05 10-12", "2024-05-31 10-12"):
+            with self.subTest(message=message):
+                self.assertIsNone(parse_message(message, now=NOW))
+        self.assertIsNotNone(parse_message("2024-05-31 10-12", now=NOW, bookable_days=30))
+
+    def test_replies_need_an_explicit_date(self):
+        self.assertIsNone(parse_message("10-12", now=NOW, has_history=True))
+        self.assertIsNotNone(parse_message("tomorrow 10-12", now=NOW, has_history=True))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,42 @@
+import datetime
+import unittest
+
+from feeds import BOOKINGS, CalendarFeeds
+from schemas import RoomActivity, RoomCategory, RoomTime, Schedule
+
+DATE = datetime.date(2024, 5, 6)
+
+
+def _activity(hour: int, event: str) -> RoomActivity:
+    return RoomActivity(RoomTime(hour), RoomTime(hour + 1), event)
+
+
+class BookingsFeedTest(unittest.TestCase):
+    def test_only_recorded_bookings_are_listed(self):
+        feeds = CalendarFeeds()
+        feeds.observe_booking({"year": "2024", "month": "5", "day": "6", "lokalID": "633", "from": "10:00", "to": "12:00", "namn": "Meeting"})
+        # Our booking, listed hour by hour, and other people's meetings in the same and in another room
+        feeds.observe_schedule(Schedule(
+            {
+                "G10:1": [_activity(10, "Meeting"), _activity(11, "Meeting"), _activity(14, "Meeting")],
+                "G10:2": [_activity(10, "Team Meeting")],
+            },
+            "Grupprum", RoomCategory.BOOKABLE_GROUP_ROOMS.value, RoomCategory.BOOKABLE_GROUP_ROOMS, datetime.datetime(2024, 5, 6),
+        ))
+        body = feeds.render(BOOKINGS, today=DATE)[0].decode("utf-8")
+        self.assertEqual(body.count("BEGIN:VEVENT"), 1)
+        self.assertIn("DTSTART;TZID=Europe/Stockholm:20240506T100000", body)
+        self.assertIn("DTEND;TZID=Europe/Stockholm:20240506T120000", body)
+
+
+    def test_timezone_is_defined_before_the_events(self):
+        feeds = CalendarFeeds()
+        feeds.observe_booking({"year": "2024", "month": "5", "day": "6", "lokalID": "633", "from": "10:00", "to": "12:00", "namn": "Meeting"})
+        body = feeds.render(BOOKINGS, today=DATE)[0].decode("utf-8")
+        self.assertIn("BEGIN:VTIMEZONE\r\nTZID:Europe/Stockholm\r\n", body)
+        self.assertLess(body.index("END:VTIMEZONE"), body.index("BEGIN:VEVENT"))
+        self.assertTrue(all(line.endswith("\r") or not line for line in body.split("\n")))
+
+
+if __name__ == "__main__":
+    unittest.main()
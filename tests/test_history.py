@@ -0,0 +1,60 @@
+import datetime
+import unittest
+
+from history import OccupancyHistory
+from schemas import Room, RoomActivity, RoomCategory, RoomTime, Schedule
+
+# History is only read for the past `retention_days`, up to yesterday
+TODAY = datetime.date.today()
+MONDAY = TODAY - datetime.timedelta(days=TODAY.weekday() + 28)
+CATEGORY = RoomCategory.BOOKABLE_GROUP_ROOMS
+
+
+def _schedule(date: datetime.date, busy: dict) -> Schedule:
+    activities = {
+        name: [RoomActivity(RoomTime(10), RoomTime(11), "Meeting")] if is_busy else []
+        for name, is_busy in busy.items()
+    }
+    return Schedule(activities, "Grupprum", CATEGORY.value, CATEGORY, datetime.datetime.combine(date, datetime.time()))
+
+
+class RankTest(unittest.TestCase):
+    def setUp(self):
+        self.history = OccupancyHistory(":memory:")
+        # G10:1 always busy at 10, G10:2 and G10:3 always free, G10:4 never observed
+        for week in range(4):
+            self.history.record(_schedule(MONDAY + datetime.timedelta(weeks=week), {"G10:1": True, "G10:2": False, "G10:3": False}))
+
+    def test_rooms_with_history_are_reordered(self):
+        order = [Room.G10_1, Room.G10_4, Room.G10_2]
+        self.assertEqual(self.history.rank(order, MONDAY, 10, 11, CATEGORY), [Room.G10_2, Room.G10_4, Room.G10_1])
+
+    def test_rooms_without_history_keep_their_place(self):
+        order = [Room.G10_4, Room.G10_1, Room.G10_5, Room.G10_3]
+        self.assertEqual(self.history.rank(order, MONDAY, 10, 11, CATEGORY), [Room.G10_4, Room.G10_3, Room.G10_5, Room.G10_1])
+
+    def test_pinned_rooms_keep_their_place(self):
+        order = [Room.G10_1, Room.G10_4, Room.G10_3, Room.G10_2]
+        self.assertEqual(self.history.rank(order, MONDAY, 10, 11, CATEGORY, pinned=1), [Room.G10_1, Room.G10_4, Room.G10_3, Room.G10_2])
+        self.assertEqual(self.history.rank([Room.G10_2, Room.G10_1, Room.G10_3], MONDAY, 10, 11, CATEGORY, pinned=1), [Room.G10_2, Room.G10_3, Room.G10_1])
+
+
+class BusiestTest(unittest.TestCase):
+    def test_busiest_hour_of_the_range(self):
+        history = OccupancyHistory(":memory:")
+        for week in range(2):
+            history.record(_schedule(MONDAY + datetime.timedelta(weeks=week), {"G10:1": True, "G10:2": False}))
+        self.assertEqual(history.busiest(MONDAY, 9, 12, CATEGORY), 0.5)
+        self.assertEqual(history.busiest(MONDAY, 11, 13, CATEGORY), 0.0)
+        self.assertEqual(history.busiest(MONDAY + datetime.timedelta(days=1), 9, 12, CATEGORY), 0.0)
+
+    def test_contention_is_cached(self):
+        history = OccupancyHistory(":memory:")
+        self.assertEqual(history.busiest(MONDAY, 10, 11, CATEGORY), 0.0)
+        history.record(_schedule(MONDAY, {"G10:1": True}))
+        self.assertEqual(history.busiest(MONDAY, 10, 11, CATEGORY), 0.0)
+        self.assertEqual(history.busiest(MONDAY, 10, 11, CATEGORY, max_age=0), 1.0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,53 @@
+import json
+import unittest
+from typing import Any, List, Tuple
+
+from llm import JSONStreamScanner
+
+RESPONSE = {
+    "conversations_response": 'Booked "G10:1" {for you}, see \\ you',
+    "requests": [{"date": "2024-05-06", "from_time": 10, "duration": 2, "breaks": [{"start_time": 11, "duration": 1}]}],
+    "done": True,
+    "count": 12,
+}
+
+
+class JSONStreamScannerTest(unittest.TestCase):
+    def _scan(self, chunks: List[str]) -> List[Tuple[str, Any]]:
+        fields: List[Tuple[str, Any]] = []
+        scanner = JSONStreamScanner(lambda key, value: fields.append((key, value)))
+        for chunk in chunks:
+            scanner.feed(chunk)
+        return fields
+
+    def test_fields_in_one_chunk(self):
+        self.assertEqual(self._scan([json.dumps(RESPONSE)]), list(RESPONSE.items()))
+
+    def test_fields_split_across_every_character(self):
+        self.assertEqual(self._scan(list(json.dumps(RESPONSE))), list(RESPONSE.items()))
+
+    def test_field_reported_as_soon_as_complete(self):
+        fields: List[Tuple[str, Any]] = []
+        scanner = JSONStreamScanner(lambda key, value: fields.append((key, value)))
+        scanner.feed('{"requests": [{"date": "2024-05-06"}')
+        self.assertEqual(fields, [])
+        scanner.feed('], "conversations_response": "Hej')
+        self.assertEqual(fields, [("requests", [{"date": "2024-05-06"}])])
+
+    def test_braces_and_escaped_quotes_inside_strings(self):
+        text = json.dumps({"a": 'x "}" {', "b": "\\\"", "c": ["]", "}"]})
+        self.assertEqual(self._scan([text[:7], text[7:13], text[13:]]), [("a", 'x "}" {'), ("b", "\\\""), ("c", ["]", "}"])])
+
+    def test_prose_before_the_object_is_ignored(self):
+        text = 'Sure! Here is "the" answer:\n```json\n' + json.dumps({"a": 1}) + "\n```"
+        self.assertEqual(self._scan([text[:20], text[20:]]), [("a", 1)])
+
+    def test_nothing_after_the_object_is_read(self):
+        self.assertEqual(self._scan(['{"a": 1} {"b": 2}']), [("a", 1)])
+
+    def test_invalid_values_are_left_to_the_full_parse(self):
+        self.assertEqual(self._scan(["{'a': 1, \"b\": tru, \"c\": 2}"]), [("c", 2)])
+
+
+if __name__ == "__main__":
+    unittest.main()
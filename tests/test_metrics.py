@@ -0,0 +1,30 @@
+import unittest
+
+from metrics import Registry
+
+
+class RenderPrometheusTest(unittest.TestCase):
+    def test_counter_labels(self):
+        registry = Registry()
+        with registry.timed("parse"):
+            pass
+        registry.inc("daisy_responses_total", "schedule", label_name="endpoint")
+        registry.inc("daisy_wire_bytes_total", "schedule", 120, label_name="endpoint")
+        registry.inc("confirm_replans_total")
+        lines = registry.render_prometheus().splitlines()
+        self.assertIn('stage_calls_total{stage="parse"} 1', lines)
+        self.assertIn('daisy_responses_total{endpoint="schedule"} 1', lines)
+        self.assertIn('daisy_wire_bytes_total{endpoint="schedule"} 120', lines)
+        self.assertIn("confirm_replans_total 1", lines)
+        self.assertIn('stage_latency_seconds_count{stage="parse"} 1', lines)
+
+    def test_summary_counts_stage_errors(self):
+        registry = Registry()
+        with self.assertRaises(ValueError):
+            with registry.timed("parse"):
+                raise ValueError("bad page")
+        self.assertIn("errors=100.0%", registry.summary())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,74 @@
+import threading
+import time
+import unittest
+from typing import List
+
+from ratelimit import Priority, RateLimiter, parse_budgets
+
+
+def _wait_for(condition, timeout: float = 5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("Timed out")
+        time.sleep(0.001)
+
+
+class RateLimiterTest(unittest.TestCase):
+    def _start(self, limiter: RateLimiter, order: List[str], name: str, endpoint: str, priority: Priority) -> threading.Thread:
+        def acquire():
+            limiter.acquire(endpoint, priority)
+            order.append(name)
+
+        queued = limiter.queued
+        thread = threading.Thread(target=acquire)
+        thread.start()
+        _wait_for(lambda: limiter.queued == queued + 1)
+        return thread
+
+    def test_interactive_goes_before_background(self):
+        limiter = RateLimiter(rate=20, burst=1)
+        limiter.acquire("schedule", Priority.INTERACTIVE)
+        order: List[str] = []
+        threads = [
+            self._start(limiter, order, "background", "schedule", Priority.BACKGROUND),
+            self._start(limiter, order, "interactive", "schedule", Priority.INTERACTIVE),
+            self._start(limiter, order, "booking", "booking", Priority.BOOKING),
+        ]
+        for thread in threads:
+            thread.join()
+        self.assertEqual(order, ["booking", "interactive", "background"])
+        self.assertEqual(limiter.wait_stats["BACKGROUND"][0], 1)
+
+    def test_endpoint_budget_is_enforced(self):
+        limiter = RateLimiter(rate=1000, burst=1000, endpoint_budgets={"login": (10, 2)})
+        start = time.monotonic()
+        for _ in range(4):
+            limiter.acquire("login")
+        # Two from the burst, then one every 100ms
+        self.assertGreaterEqual(time.monotonic() - start, 0.18)
+        # Other endpoints only use the global budget
+        start = time.monotonic()
+        for _ in range(4):
+            limiter.acquire("schedule")
+        self.assertLess(time.monotonic() - start, 0.05)
+
+    def test_throttled_endpoint_does_not_hold_back_others(self):
+        limiter = RateLimiter(rate=1000, burst=1000, endpoint_budgets={"login": (2, 1)})
+        limiter.acquire("login")
+        order: List[str] = []
+        login = self._start(limiter, order, "login", "login", Priority.BOOKING)
+        # Queued behind a higher priority login that has to wait for its budget
+        self.assertLess(limiter.acquire("schedule", Priority.BACKGROUND), 0.05)
+        order.append("schedule")
+        self.assertEqual(order, ["schedule"])
+        login.join()
+        self.assertEqual(order, ["schedule", "login"])
+
+    def test_parse_budgets(self):
+        self.assertEqual(parse_budgets("login=0.2:2, schedule=3:6,"), {"login": (0.2, 2.0), "schedule": (3.0, 6.0)})
+        self.assertEqual(parse_budgets(""), {})
+
+
+if __name__ == "__main__":
+    unittest.main()
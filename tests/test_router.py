@@ -0,0 +1,107 @@
+import random
+import unittest
+
+from router import COMPLEX, SIMPLE, ModelRouter, classify
+
+FAST, MEDIUM, STRONG = "@cf/fast", "@cf/medium", "@cf/strong"
+
+
+class _Never(random.Random):
+    """Never explores"""
+    def random(self) -> float:
+        return 1.0
+
+
+class _Always(random.Random):
+    """Always explores"""
+    def random(self) -> float:
+        return 0.0
+
+
+def _router(rng: random.Random = _Never()) -> ModelRouter:
+    return ModelRouter([FAST, MEDIUM, STRONG], min_samples=3, min_success=0.9, explore=0.05, rng=rng)
+
+
+def _record(router: ModelRouter, model: str, kind: str, seconds: float, valid: int, invalid: int = 0):
+    for _ in range(valid):
+        router.record(model, kind, seconds, True)
+    for _ in range(invalid):
+        router.record(model, kind, seconds, False)
+
+
+class ClassifyTest(unittest.TestCase):
+    def test_single_request_is_simple(self):
+        self.assertEqual(classify("book a room tomorrow 10-12"), SIMPLE)
+        self.assertEqual(classify("a room on 2024-05-06 from 13 to 15"), SIMPLE)
+
+    def test_multiple_requests_are_complex(self):
+        self.assertEqual(classify("book a room tomorrow 10-12 and friday 13-15"), COMPLEX)
+        self.assertEqual(classify("tomorrow 10-16 with a lunch break"), COMPLEX)
+        self.assertEqual(classify("monday 10-12, tuesday 13-15"), COMPLEX)
+
+    def test_replies_and_long_messages_are_complex(self):
+        self.assertEqual(classify("tomorrow 10-12", has_history=True), COMPLEX)
+        self.assertEqual(classify("could you please find us a room " * 5), COMPLEX)
+        self.assertEqual(classify("2024-05-06 10-12 2024-05-07"), COMPLEX)
+
+
+class ModelRouterTest(unittest.TestCase):
+    def test_falls_back_to_strongest_without_data(self):
+        router = _router()
+        self.assertEqual(router.choose(SIMPLE), STRONG)
+        self.assertEqual(router.choose(COMPLEX), STRONG)
+        # Too few samples to trust the fast model yet
+        _record(router, FAST, SIMPLE, 0.2, valid=2)
+        self.assertEqual(router.choose(SIMPLE), STRONG)
+
+    def test_simple_goes_to_fastest_reliable_model(self):
+        router = _router()
+        _record(router, FAST, SIMPLE, 0.2, valid=3, invalid=2)
+        _record(router, MEDIUM, SIMPLE, 0.5, valid=5)
+        _record(router, STRONG, SIMPLE, 2.0, valid=5)
+        # FAST is fastest but only 60% valid
+        self.assertEqual(router.choose(SIMPLE), MEDIUM)
+        _record(router, FAST, SIMPLE, 0.2, valid=45)
+        self.assertEqual(router.choose(SIMPLE), FAST)
+
+    def test_complex_goes_to_most_reliable_model(self):
+        router = _router()
+        _record(router, FAST, COMPLEX, 0.2, valid=5)
+        _record(router, STRONG, COMPLEX, 2.0, valid=5)
+        # Equally reliable, the stronger one wins
+        self.assertEqual(router.choose(COMPLEX), STRONG)
+        _record(router, STRONG, COMPLEX, 2.0, valid=0, invalid=5)
+        self.assertEqual(router.choose(COMPLEX), FAST)
+
+    def test_failure_escalates_to_next_stronger_model(self):
+        router = _router()
+        self.assertEqual(router.choose(SIMPLE, failed=FAST), MEDIUM)
+        self.assertEqual(router.choose(SIMPLE, failed=MEDIUM), STRONG)
+        # Nothing stronger, the strongest is retried
+        self.assertEqual(router.choose(SIMPLE, failed=STRONG), STRONG)
+        self.assertEqual(router.escalations, 3)
+
+    def test_escalation_skips_models_in_flight(self):
+        router = _router()
+        self.assertEqual(router.choose(SIMPLE, exclude=[MEDIUM], failed=FAST), STRONG)
+
+    def test_models_in_flight_are_avoided(self):
+        router = _router()
+        _record(router, FAST, SIMPLE, 0.2, valid=5)
+        _record(router, MEDIUM, SIMPLE, 0.5, valid=5)
+        self.assertEqual(router.choose(SIMPLE, exclude=[FAST]), MEDIUM)
+        self.assertEqual(router.choose(SIMPLE, exclude=[STRONG]), FAST)
+        # Without data the strongest one that is not in flight
+        self.assertEqual(_router().choose(COMPLEX, exclude=[STRONG]), MEDIUM)
+        # All in flight, any may be used again
+        self.assertEqual(router.choose(SIMPLE, exclude=[FAST, MEDIUM, STRONG]), FAST)
+
+    def test_exploration_picks_least_sampled_other_model(self):
+        router = _router(_Always())
+        _record(router, FAST, SIMPLE, 0.2, valid=5)
+        _record(router, STRONG, SIMPLE, 2.0, valid=1)
+        self.assertEqual(router.choose(SIMPLE), MEDIUM)
+
+
+if __name__ == "__main__":
+    unittest.main()
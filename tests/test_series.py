@@ -0,0 +1,18 @@
+import datetime
+import unittest
+
+from series import parse_series
+
+TODAY = datetime.date(2024, 5, 6)
+
+
+class ParseSeriesTest(unittest.TestCase):
+    def test_title_is_none_when_not_given(self):
+        self.assertIsNone(parse_series("every monday 10-12 until 2024-06-30", 1, TODAY).title) # type: ignore
+
+    def test_explicit_default_title_is_kept(self):
+        self.assertEqual(parse_series('every monday 10-12 until 2024-06-30 "Meeting"', 1, TODAY).title, "Meeting") # type: ignore
+
+
+if __name__ == "__main__":
+    unittest.main()
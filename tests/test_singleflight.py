@@ -0,0 +1,74 @@
+import threading
+import time
+import unittest
+from typing import Any, List
+
+from singleflight import SingleFlight
+
+
+def _wait_for(condition, timeout: float = 5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("Timed out")
+        time.sleep(0.001)
+
+
+class SingleFlightTest(unittest.TestCase):
+    def _run_concurrently(self, flight: SingleFlight, key: str, func, callers: int) -> List[Any]:
+        """Starts `callers` threads, the leader's call blocks until the others are waiting on it"""
+        release = threading.Event()
+        outcomes: List[Any] = [None] * callers
+
+        def blocking():
+            release.wait()
+            return func()
+
+        def call(i: int):
+            try:
+                outcomes[i] = flight.do(key, blocking)
+            except Exception as e: # pylint: disable=broad-except
+                outcomes[i] = e
+
+        threads = [threading.Thread(target=call, args=(i,)) for i in range(callers)]
+        for thread in threads:
+            thread.start()
+        _wait_for(lambda: flight.shared == callers - 1)
+        release.set()
+        for thread in threads:
+            thread.join()
+        return outcomes
+
+    def test_duplicate_calls_are_coalesced(self):
+        flight = SingleFlight()
+        calls: List[int] = []
+
+        def fetch():
+            calls.append(1)
+            return {"schedule": len(calls)}
+
+        outcomes = self._run_concurrently(flight, "schedule", fetch, 5)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(outcomes, [{"schedule": 1}] * 5)
+        self.assertEqual((flight.calls, flight.shared), (1, 4))
+
+    def test_exception_reaches_every_waiter(self):
+        flight = SingleFlight()
+        error = ConnectionError("Daisy is down")
+
+        def fail():
+            raise error
+
+        outcomes = self._run_concurrently(flight, "schedule", fail, 4)
+        self.assertTrue(all(outcome is error for outcome in outcomes))
+
+    def test_later_and_different_calls_are_not_shared(self):
+        flight = SingleFlight()
+        self.assertEqual(flight.do("a", lambda: 1), 1)
+        self.assertEqual(flight.do("a", lambda: 2), 2)
+        self.assertEqual(flight.do("b", lambda: 3), 3)
+        self.assertEqual((flight.calls, flight.shared), (3, 0))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,32 @@
+import os
+import tempfile
+import unittest
+
+from store import ConversationStore, Turn
+
+
+class ConversationStoreTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "conversations.db")
+
+    def test_remembered_turns_are_only_kept_in_memory(self):
+        store = ConversationStore(max_turns=1, path=self.path)
+        store.remember(Turn(1, None, "user", "tomorrow 10-12", []))
+        store.remember(Turn(2, 1, "assistant", "Booked", []))
+        self.assertEqual(store.thread(2), ([Turn(2, 1, "assistant", "Booked", [])], 1))
+
+    def test_persisted_turns_are_read_back_after_eviction_and_restart(self):
+        store = ConversationStore(max_turns=1, path=self.path)
+        for turn in (Turn(1, None, "user", "tomorrow 10-12", []), Turn(2, 1, "assistant", "Booked", [{"date": "2024-05-07"}])):
+            store.remember(turn)
+            store.persist(turn)
+        turns, missing = ConversationStore(max_turns=1, path=self.path).thread(2)
+        self.assertEqual([turn.message_id for turn in turns], [1, 2])
+        self.assertEqual(turns[1].requests, [{"date": "2024-05-07"}])
+        self.assertIsNone(missing)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,21 @@
+import unittest
+
+import structured
+from structured import StructuredOutputError, parse_response
+
+
+class RepairJsonTest(unittest.TestCase):
+    def test_non_ascii_bare_key_is_quoted(self):
+        self.assertEqual(parse_response("{svär: 'hej', år: True}"), {"svär": "hej", "år": True})
+
+    def test_non_ascii_bare_value_is_unrecoverable(self):
+        for text in ('{"a": då}', '{"conversations_response": Hej då, "requests": []}'):
+            with self.subTest(text=text):
+                before = structured.COUNTERS["unrecoverable"]
+                with self.assertRaises(StructuredOutputError):
+                    parse_response(text)
+                self.assertEqual(structured.COUNTERS["unrecoverable"], before + 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,145 @@
+"""
+A discord bot capable of booking student group rooms and staff rooms via Daisy (administration tool for Department of Computer and Systems Sciences at Stockholm University)
+Copyright (C) 2024 Edwin Sundberg
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import http.cookiejar
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.request import ACCEPT_ENCODING as _URLLIB3_ACCEPT_ENCODING
+
+import metrics
+
+# Overridable to point the bot at a stand-in server (see standin.py)
+DAISY_BASE_URL = os.getenv("DAISY_BASE_URL", "https://daisy.dsv.su.se").rstrip("/")
+IDP_BASE_URL = os.getenv("IDP_BASE_URL", "https://idp.it.su.se").rstrip("/")
+
+# Only the codecs urllib3 can decode here, br and zstd are added by it once brotli / zstandard are installed
+ACCEPT_ENCODING = ", ".join(encoding.strip() for encoding in _URLLIB3_ACCEPT_ENCODING.split(","))
+
+
+def counter(endpoint: str) -> Callable[..., requests.Response]:
+    """
+    Response hook counting bytes received on the wire (compressed) and after decoding for an endpoint
+
+    The body is read inside the hook, requests runs hooks before reading it otherwise.
+    """
+    def hook(response: requests.Response, *args: Any, **kwargs: Any) -> requests.Response:
+        decoded = len(response.content)
+        wire = response.raw.tell() if response.raw is not None and hasattr(response.raw, "tell") else decoded
+        metrics.inc("daisy_wire_bytes_total", endpoint, wire, label_name="endpoint")
+        metrics.inc("daisy_decoded_bytes_total", endpoint, decoded, label_name="endpoint")
+        metrics.inc("daisy_responses_total", endpoint, label_name="endpoint")
+        return response
+    return hook
+
+
+def instrument(session: requests.Session, endpoint: str):
+    """Counts the traffic of a session that is not sent through the transport (the login flow)"""
+    session.headers["Accept-Encoding"] = ACCEPT_ENCODING
+    session.hooks["response"].append(counter(endpoint))
+
+
+class _NoCookies(http.cookiejar.DefaultCookiePolicy):
+    def set_ok(self, cookie, request):
+        return False
+
+
+class Transport:
+    """
+    Pooled keep-alive connections to Daisy, with conditional requests for pages that carry validators
+
+    The JSESSIONID is always sent explicitly in a Cookie header, so the shared session never stores cookies itself.
+    When a response had an ETag or Last-Modified, the next identical request asks for it with If-None-Match /
+    If-Modified-Since and a 304 is answered from the cached body.
+    """
+    def __init__(self, pool_size: int = 16, cache_size: int = 64):
+        self.session = requests.Session()
+        self.session.cookies.set_policy(_NoCookies())
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.cache_size = cache_size
+        self._lock = threading.Lock()
+        # request key -> (validator headers, body, encoding, response headers)
+        self._validated: "OrderedDict[Tuple[Any, ...], Tuple[Dict[str, str], bytes, Optional[str], Dict[str, str]]]" = OrderedDict()
+        self.not_modified = 0
+
+    @staticmethod
+    def _key(method: str, url: str, headers: Dict[str, str], data: Any) -> Tuple[Any, ...]:
+        body = tuple(sorted((str(k), str(v)) for k, v in data.items())) if isinstance(data, dict) else data
+        return (method, url, headers.get("Cookie"), body)
+
+    def request(self, method: str, url: str, endpoint: str, session: Optional[requests.Session] = None, conditional: bool = False, **kwargs: Any) -> requests.Response:
+        """
+        Sends a request, `session` is used instead of the pooled one when given (release bookings keep their own connection)
+
+        Only requests made with `conditional` are revalidated, bookings never are.
+        """
+        headers: Dict[str, str] = dict(kwargs.pop("headers", None) or {})
+        headers["Accept-Encoding"] = ACCEPT_ENCODING
+        key = self._key(method, url, headers, kwargs.get("data")) if conditional and self.cache_size > 0 else None
+        cached = None
+        if key is not None:
+            with self._lock:
+                cached = self._validated.get(key)
+                if cached is not None:
+                    self._validated.move_to_end(key)
+            if cached is not None:
+                headers.update(cached[0])
+
+        response = (session or self.session).request(method, url, headers=headers, hooks={"response": [counter(endpoint)]}, **kwargs)
+
+        if key is None:
+            return response
+        if response.status_code == 304 and cached is not None:
+            self.not_modified += 1
+            metrics.inc("daisy_not_modified_total", endpoint, label_name="endpoint")
+            return self._from_cache(response, cached)
+        validators = {}
+        if "ETag" in response.headers:
+            validators["If-None-Match"] = response.headers["ETag"]
+        if "Last-Modified" in response.headers:
+            validators["If-Modified-Since"] = response.headers["Last-Modified"]
+        with self._lock:
+            if response.status_code == 200 and validators:
+                self._validated[key] = (validators, response.content, response.encoding, dict(response.headers))
+                self._validated.move_to_end(key)
+                while len(self._validated) > self.cache_size:
+                    self._validated.popitem(last=False)
+            else:
+                self._validated.pop(key, None)
+        return response
+
+    @staticmethod
+    def _from_cache(not_modified: requests.Response, cached: Tuple[Dict[str, str], bytes, Optional[str], Dict[str, str]]) -> requests.Response:
+        response = requests.Response()
+        response.status_code = 200
+        response.headers.update(cached[3])
+        response._content = cached[1] # pylint: disable=protected-access
+        response.encoding = cached[2]
+        response.url = not_modified.url
+        response.request = not_modified.request
+        response.elapsed = not_modified.elapsed
+        return response
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"validated": len(self._validated), "not_modified": self.not_modified}
@@ -16,14 +16,80 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 import asyncio
+import contextvars
 import functools
-from typing import Any, Callable, TypeVar
+import multiprocessing
+import os
+import threading
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional, TypeVar
 
 T = TypeVar("T")
 
+# forkserver is not available on Windows
+_START_METHOD = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+
+
+class Lane:
+    """
+    An executor dedicated to one kind of workload, so that e.g. slow LLM calls can not starve Daisy requests
+
+    The executor is created on first use, `in_flight` counts submitted but unfinished calls.
+    """
+    def __init__(self, name: str, workers: int, processes: bool = False):
+        self.name = name
+        self.workers = max(workers, 1)
+        self.processes = processes
+        self.in_flight = 0
+        self.completed = 0
+        self._executor: Optional[Executor] = None
+        self._lock = threading.Lock()
+
+    @property
+    def executor(self) -> Executor:
+        with self._lock:
+            if self._executor is None:
+                if self.processes:
+                    # Created after discord, the other lanes and the metrics server started threads, forking then can
+                    # copy a lock (logging, metrics) held by one of them into the workers
+                    self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context(_START_METHOD))
+                else:
+                    self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix=f"lane-{self.name}")
+            return self._executor
+
+    @property
+    def queue_depth(self) -> int:
+        return max(self.in_flight - self.workers, 0)
+
+    async def run(self, func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+        loop = asyncio.get_running_loop()
+        partial_func = functools.partial(func, *args, **kwargs)
+        self.in_flight += 1
+        try:
+            if self.processes:
+                return await loop.run_in_executor(self.executor, partial_func)
+            # Context variables (e.g. the active profile) follow the call into the thread
+            return await loop.run_in_executor(self.executor, contextvars.copy_context().run, partial_func)
+        finally:
+            self.in_flight -= 1
+            self.completed += 1
+
+    def stats(self) -> Dict[str, int]:
+        return {"workers": self.workers, "in_flight": self.in_flight, "queue_depth": self.queue_depth, "completed": self.completed}
+
+
+IO_LANE = Lane("io", int(os.getenv("EXECUTOR_IO_WORKERS", "16")))
+LLM_LANE = Lane("llm", int(os.getenv("EXECUTOR_LLM_WORKERS", "4")))
+# EXECUTOR_CPU_WORKERS=0 runs CPU heavy work in threads instead of processes
+_CPU_WORKERS = int(os.getenv("EXECUTOR_CPU_WORKERS", "2"))
+CPU_LANE = Lane("cpu", _CPU_WORKERS or 2, processes=_CPU_WORKERS > 0)
+
+LANES = {lane.name: lane for lane in (IO_LANE, LLM_LANE, CPU_LANE)}
+
+
 async def run_async(func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
     """
-    Run a synchronous function asynchronously in a separate thread.
+    Run a synchronous (blocking I/O) function asynchronously in a separate thread.
 
     Parameters:
     - func: The synchronous function to be executed.
@@ -34,6 +100,22 @@ async def run_async(func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
     - The result of the synchronous function.
 
     """
-    loop = asyncio.get_event_loop()
-    partial_func = functools.partial(func, **kwargs)
-    return await loop.run_in_executor(None, partial_func, *args)
+    return await IO_LANE.run(func, *args, **kwargs)
+
+
+async def run_llm(func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+    """Like run_async but on the lane reserved for (slow) LLM calls"""
+    return await LLM_LANE.run(func, *args, **kwargs)
+
+
+async def run_cpu(func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+    """
+    Run a CPU heavy function in a separate process so it does not hold the GIL against the event loop.
+
+    func, arguments and return value must be picklable (module level functions and attrs classes are).
+    """
+    return await CPU_LANE.run(func, *args, **kwargs)
+
+
+def lane_stats() -> Dict[str, Dict[str, int]]:
+    return {name: lane.stats() for name, lane in LANES.items()}
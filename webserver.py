@@ -0,0 +1,82 @@
+"""
+A discord bot capable of booking student group rooms and staff rooms via Daisy (administration tool for Department of Computer and Systems Sciences at Stockholm University)
+Copyright (C) 2024 Edwin Sundberg
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Mapping, Optional, Tuple
+
+import attr
+
+
+@attr.s(auto_attribs=True, frozen=True, slots=True)
+class Response:
+    status: int
+    body: bytes
+    content_type: str = "text/plain; charset=utf-8"
+    headers: Dict[str, str] = attr.Factory(dict)
+
+
+# path -> handler(request headers) -> Response
+Handler = Callable[[Mapping[str, str]], Response]
+
+ROUTES: Dict[str, Handler] = {}
+
+
+def route(path: str) -> Callable[[Handler], Handler]:
+    def decorator(handler: Handler) -> Handler:
+        ROUTES[path] = handler
+        return handler
+    return decorator
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self): # pylint: disable=invalid-name
+        handler = ROUTES.get(self.path.split("?")[0])
+        if handler is None:
+            response = Response(404, b"Not found\n")
+        else:
+            try:
+                response = handler(self.headers)
+            except Exception: # pylint: disable=broad-except
+                logging.exception("Handler for %s failed", self.path)
+                response = Response(500, b"Internal error\n")
+        self.send_response(response.status)
+        self.send_header("Content-Type", response.content_type)
+        self.send_header("Content-Length", str(len(response.body)))
+        for key, value in response.headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        if response.status != 304:
+            self.wfile.write(response.body)
+
+    def log_message(self, format, *args): # pylint: disable=redefined-builtin
+        logging.debug("%s - %s", self.address_string(), format % args)
+
+
+_server: Optional[ThreadingHTTPServer] = None
+
+
+def start(host: str, port: int) -> Tuple[str, int]:
+    """Serves ROUTES from a daemon thread, idempotent"""
+    global _server # pylint: disable=global-statement
+    if _server is None:
+        _server = ThreadingHTTPServer((host, port), _RequestHandler)
+        _server.daemon_threads = True
+        threading.Thread(target=_server.serve_forever, name="webserver", daemon=True).start()
+        logging.info("Serving %s on %s:%s", ", ".join(ROUTES), host, _server.server_address[1])
+    return _server.server_address[0], _server.server_address[1]